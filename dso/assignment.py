@@ -0,0 +1,221 @@
+"""Module assignment.py matches the strokes of a level in two phases, instead of letting each reference stroke claim
+its best match in order of id. First all candidate matches of all reference strokes are found and scored, without
+setting match ids, which can be done in parallel. These form a sparse bipartite graph of reference and target strokes.
+Then the conflicts are resolved at once: the selected matches have no stroke in common, and the sum of their
+similarity scores is maximized greedily or, for small connected components of the graph, exactly. Strokes that were
+matched in an earlier level are not assigned again. All selected matches exist, so the output needs no check."""
+
+import multiprocessing  # standard library
+import traceback
+
+from dso import session  # local source
+from structure import DelimitedStrokeRef, DelimitedStrokeTarget, JunctionTarget, Match, score_matches
+from matching import find_matching_candidates
+from parallel import partition_strokes, halo, load_objects
+from spatial_index import load_junction_index
+import local_geometry
+from instrumentation import profile, timed
+
+methods = ['greedy', 'component']
+
+
+@timed
+def stroke_candidates(stroke_ref, tolerance_distance, junction_index=None):
+    """Returns the scored candidate matches of stroke_ref that could be selected, that is with a score of at least 0.
+    Unlike find_best_match, no match is selected."""
+    try:
+        matches = find_matching_candidates(stroke_ref, tolerance_distance, junction_index)
+    except AssertionError as e:
+        print(e)
+        print(traceback.format_exc())
+        print('Something went wrong trying to find a match for stroke', stroke_ref.id)
+        return []
+    score_matches(matches)
+    return [match for match in matches if match.similarity_score >= 0]
+
+
+def candidate_tile(level, tolerance_distance, stroke_ids, extent):
+    """Finds the candidate matches of the input reference strokes, without changing the database. Runs in a worker
+    process, like parallel.match_tile. Returns a list of (reference stroke ids, target stroke ids, similarity score)."""
+    junction_index = None
+    if local_geometry.enabled():
+        junction_index = load_junction_index(JunctionTarget, tolerance_distance,
+                                             extent=halo(extent, tolerance_distance))
+
+    rows = []
+    strokes_ref = session.query(DelimitedStrokeRef).filter(DelimitedStrokeRef.id.in_(stroke_ids))\
+        .order_by(DelimitedStrokeRef.id)
+    for stroke in strokes_ref:
+        for match in stroke_candidates(stroke, tolerance_distance, junction_index):
+            rows.append(([stroke_ref.id for stroke_ref in match.strokes_ref],
+                         [stroke_target.id for stroke_target in match.strokes_target], match.similarity_score))
+    session.rollback()
+    return rows
+
+
+class CandidateGraph:
+    """Candidate matches by their (sorted reference stroke ids, sorted target stroke ids), with their similarity
+    score, and the strokes of the candidates by id. A candidate that is found from several reference strokes is
+    stored once."""
+
+    def __init__(self):
+        self.candidates = {}
+        self.strokes_ref = {}
+        self.strokes_target = {}
+
+    def add(self, ref_ids, target_ids, similarity_score):
+        key = tuple(sorted(set(ref_ids))), tuple(sorted(set(target_ids)))
+        self.candidates[key] = max(similarity_score, self.candidates.get(key, similarity_score))
+
+    def add_match(self, match):
+        """Adds a candidate match and its strokes."""
+        for stroke in match.strokes_ref:
+            self.strokes_ref[stroke.id] = stroke
+        for stroke in match.strokes_target:
+            self.strokes_target[stroke.id] = stroke
+        self.add([stroke.id for stroke in match.strokes_ref], [stroke.id for stroke in match.strokes_target],
+                 match.similarity_score)
+
+    def unclaimed(self):
+        """Returns the candidates of which no stroke has a match yet, as (score, strokes, key), ordered by descending
+        score and then by key, such that the assignment does not depend on the order in which they were found."""
+        rows = []
+        for key, similarity_score in self.candidates.items():
+            ref_ids, target_ids = key
+            if any(self.strokes_ref[stroke_id].match_id is not None for stroke_id in ref_ids) or \
+                    any(self.strokes_target[stroke_id].match_id is not None for stroke_id in target_ids):
+                continue
+            # reference and target strokes are told apart in the set of strokes, since their ids can be equal
+            strokes = frozenset([(0, stroke_id) for stroke_id in ref_ids] +
+                                [(1, stroke_id) for stroke_id in target_ids])
+            rows.append((similarity_score, strokes, key))
+        rows.sort(key=lambda row: (-row[0], row[2]))
+        return rows
+
+    def assign(self, method='greedy', max_component_size=16):
+        """Selects candidates that have no stroke in common. With method 'greedy', candidates are selected in order of
+        descending score. With method 'component', the sum of the scores is maximized exactly within each connected
+        component of at most max_component_size candidates, and greedily in larger components. Returns the keys of
+        the selected candidates."""
+        assert method in methods, 'Unknown assignment method ' + method
+        rows = self.unclaimed()
+        profile.count('assignment_candidates', len(rows))
+        if method == 'greedy':
+            return greedy(rows)
+        selected = []
+        for component in components(rows):
+            if len(component) <= max_component_size:
+                selected += best_packing(component)
+            else:
+                selected += greedy(component)
+        return selected
+
+    def apply(self, keys):
+        """Creates the selected matches and sets the match id of their strokes. Returns the matches."""
+        matches = []
+        for key in sorted(keys):
+            ref_ids, target_ids = key
+            match = Match([self.strokes_ref[stroke_id] for stroke_id in ref_ids],
+                          [self.strokes_target[stroke_id] for stroke_id in target_ids],
+                          similarity_score=self.candidates[key])
+            match.set_stroke_match_id()
+            matches.append(match)
+        return matches
+
+
+def greedy(rows, used=frozenset()):
+    """Selects the candidates in the order of the rows if they have no stroke in common with the strokes used before.
+    Returns the keys of the selected candidates."""
+    used = set(used)
+    selected = []
+    for similarity_score, strokes, key in rows:
+        if not strokes & used:
+            used |= strokes
+            selected.append(key)
+    return selected
+
+
+def components(rows):
+    """Splits the candidate rows in connected components, in which candidates are connected if they have a stroke in
+    common. The order of the rows is kept within each component."""
+    parent = {}
+
+    def root(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for similarity_score, strokes, key in rows:
+        first = root(next(iter(strokes)))
+        for stroke in strokes:
+            parent[root(stroke)] = first
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(root(next(iter(row[1]))), []).append(row)
+    return list(grouped.values())
+
+
+def best_packing(rows):
+    """Selects the candidates with no stroke in common that have the largest sum of scores, with a branch and bound
+    search over the rows ordered by descending score. Candidates with a score of 0 that fit are added afterwards.
+    Returns the keys of the selected candidates."""
+    remaining = [0.0] * (len(rows) + 1)
+    for index in range(len(rows) - 1, -1, -1):
+        remaining[index] = remaining[index + 1] + max(rows[index][0], 0)
+    best = [0.0, []]
+
+    def search(index, used, total, chosen):
+        if total > best[0]:
+            best[:] = [total, list(chosen)]
+        if index == len(rows) or total + remaining[index] <= best[0]:
+            return
+        similarity_score, strokes, key = rows[index]
+        if not strokes & used:
+            chosen.append(index)
+            search(index + 1, used | strokes, total + similarity_score, chosen)
+            chosen.pop()
+        search(index + 1, used, total, chosen)
+
+    search(0, frozenset(), 0.0, [])
+    used = frozenset(stroke for index in best[1] for stroke in rows[index][1])
+    return [rows[index][2] for index in best[1]] + \
+        greedy([row for index, row in enumerate(rows) if index not in best[1]], used)
+
+
+def assignment_matching_process(level, tolerance_distance, method='greedy', workers=1, stroke_ids=None,
+                                junction_index=None, tile_size=5000):
+    """Matches the unmatched reference strokes of a level in two phases, see the module description. With more than
+    one worker, the candidates are found in parallel for spatial partitions of the strokes, which must be committed to
+    the database before. If stroke_ids is given, only these strokes are matched. Returns the selected matches."""
+    graph = CandidateGraph()
+    if workers > 1:
+        tiles = partition_strokes(level, tile_size, stroke_ids)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers) as pool:
+            tile_rows = pool.starmap(candidate_tile, [(level, tolerance_distance, stroke_ids, extent)
+                                                      for stroke_ids, extent in tiles])
+        for rows in tile_rows:
+            for ref_ids, target_ids, similarity_score in rows:
+                graph.add(ref_ids, target_ids, similarity_score)
+        graph.strokes_ref = load_objects(DelimitedStrokeRef, {stroke_id for key in graph.candidates
+                                                              for stroke_id in key[0]})
+        graph.strokes_target = load_objects(DelimitedStrokeTarget, {stroke_id for key in graph.candidates
+                                                                    for stroke_id in key[1]})
+        count = sum(len(stroke_ids) for stroke_ids, extent in tiles)
+    else:
+        strokes_ref = session.query(DelimitedStrokeRef).filter(DelimitedStrokeRef.level == level,
+                                                               DelimitedStrokeRef.match_id == None)\
+            .order_by(DelimitedStrokeRef.id)
+        if stroke_ids is not None:
+            strokes_ref = strokes_ref.filter(DelimitedStrokeRef.id.in_(stroke_ids))
+        if junction_index is None and local_geometry.enabled():
+            junction_index = load_junction_index(JunctionTarget, cell_size=tolerance_distance)
+        count = 0
+        for stroke in strokes_ref:
+            for match in stroke_candidates(stroke, tolerance_distance, junction_index):
+                graph.add_match(match)
+            count += 1
+    print('Strokes analyzed:', count, ', candidates:', len(graph.candidates))
+    profile.count('strokes', count)
+    return graph.apply(graph.assign(method))
@@ -0,0 +1,140 @@
+"""Module benchmark.py times the stages of the matching process on generated networks of several sizes, using the
+in-memory file backend, such that the results only depend on the code and not on a database. For each size and
+stage the time, throughput and peak memory are written as one JSON line, together with the commit, such that runs of
+different commits can be compared. The file backend sends no SQL statements, the statements of a run on the database
+are counted by core.py --profile.
+
+Run for example: python benchmark.py --sizes 10000 100000 --output benchmarks.jsonl"""
+
+import argparse  # standard library
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from dso import tolerance_distance  # local source
+from synthetic import NetworkGenerator
+import files
+from matching import match_exists, match_links
+from structure import Match
+from bulk import LinkWriter
+from metrics import metric_cache
+
+
+class StageTimer:
+    """Measures the time and peak memory of the stages of one benchmark run."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, stage, function, *args):
+        """Runs a stage and records its measurements. The function returns the number of processed items, which is
+        used for the throughput."""
+        if self.trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        items = function(*args)
+        seconds = time.perf_counter() - start_time
+        peak_memory = None
+        if self.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        self.results.append({'stage': stage, 'seconds': round(seconds, 4), 'items': items,
+                             'items_per_second': round(items / seconds, 1) if seconds > 0 else None,
+                             'peak_memory_mb': None if peak_memory is None else round(peak_memory, 2)})
+        return items
+
+
+def match(network_ref, network_target, level, matches):
+    junction_index = network_target.junction_index(tolerance_distance)
+    stroke_count = sum(1 for stroke in network_ref.strokes.values() if stroke.level == level and
+                       stroke.match_id is None)
+    matches += files.matching_process(network_ref, level, junction_index, tolerance_distance)
+    return stroke_count
+
+
+def prepare_lvl2(network_ref, network_target):
+    stroke_count = sum(1 for stroke in network_ref.strokes.values() if stroke.match_id is None) + \
+        sum(1 for stroke in network_target.strokes.values() if stroke.match_id is None)
+    files.prepare_strokes_lvl2(network_ref)
+    files.prepare_strokes_lvl2(network_target)
+    return stroke_count
+
+
+def output(matches, file_path):
+    with LinkWriter(file_path=file_path, to_database=False) as link_writer:
+        for each in matches:
+            if match_exists(each):
+                for row in match_links(each):
+                    link_writer.write(*row)
+    return link_writer.row_count
+
+
+def benchmark(size, seed=0, trace_memory=True):
+    """Runs all stages on a generated pair of networks with about size road sections. Returns a list with the
+    measurements of each stage."""
+    metric_cache.clear()
+    Match.id_iter = itertools.count()
+    timer = StageTimer(trace_memory)
+    networks = {}
+
+    def generate():
+        networks['rows'] = NetworkGenerator(size, seed=seed).networks()
+        return len(networks['rows'][0]) + len(networks['rows'][1])
+
+    def topology():
+        rows_ref, rows_target = networks.pop('rows')
+        networks['ref'] = files.create_network(rows_ref, files.RoadSectionRef, files.JunctionRef,
+                                               files.DelimitedStrokeRef)
+        networks['target'] = files.create_network(rows_target, files.RoadSectionTarget, files.JunctionTarget,
+                                                  files.DelimitedStrokeTarget)
+        return len(rows_ref) + len(rows_target)
+
+    timer.run('generate', generate)
+    timer.run('topology', topology)
+    network_ref, network_target = networks['ref'], networks['target']
+    timer.run('classify_junctions', lambda: files.classify_network(network_ref) +
+              files.classify_network(network_target))
+    timer.run('construct_strokes', lambda: files.construct_network(network_ref) +
+              files.construct_network(network_target))
+    matches = []
+    timer.run('matching_lvl1', match, network_ref, network_target, 1, matches)
+    timer.run('prepare_strokes_lvl2', prepare_lvl2, network_ref, network_target)
+    timer.run('matching_lvl2', match, network_ref, network_target, 2, matches)
+    with tempfile.TemporaryDirectory() as directory:
+        timer.run('generate_output', output, matches, os.path.join(directory, 'linking_table.csv'))
+    return timer.results
+
+
+def current_commit():
+    """Returns the hash of the current commit, or None if it is not known."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the stages of the matching process on generated networks.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='numbers of road sections of the reference network (default: 10000 100000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the network generator (default: 0)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace the memory use, which makes the stages slower')
+    parser.add_argument('--output', help='JSON lines file to which the results are appended')
+    arguments = parser.parse_args()
+
+    commit = current_commit()
+    for size in arguments.sizes:
+        for result in benchmark(size, arguments.seed, not arguments.no_memory):
+            result.update({'commit': commit, 'size': size, 'seed': arguments.seed})
+            line = json.dumps(result)
+            print(line)
+            if arguments.output:
+                with open(arguments.output, 'a') as file:
+                    file.write(line + '\n')
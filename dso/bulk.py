@@ -0,0 +1,180 @@
+"""Module bulk.py contains functions to write many rows to the PostGIS database at once with COPY, instead of a
+separate INSERT or UPDATE statement for each mapped object."""
+
+import csv  # standard library
+import io
+
+from sqlalchemy import text  # 3rd party packages
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+from dso import session  # local source
+import local_geometry
+
+
+def copy_rows(table_name, columns, rows):
+    """Writes the input rows to the table with a single COPY FROM STDIN, in the transaction of the session.
+    None values are written as NULL, geometries are expected as (E)WKB hex strings or EWKT."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    row_count = 0
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+        row_count += 1
+    if row_count == 0:
+        return 0
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table_name, ', '.join(columns)), buffer)
+    cursor.close()
+    return row_count
+
+
+def bulk_update(table_name, key_column, columns, rows):
+    """Updates columns of many rows of a table at once. The rows, with the key as first value, are copied to a
+    temporary table which is then joined in a single UPDATE."""
+    session.flush()
+    temporary_table = table_name + '_bulk_update'
+    session.execute(text('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {}, {} FROM {} WITH NO DATA'.format(
+        temporary_table, key_column, ', '.join(columns), table_name)))
+    row_count = copy_rows(temporary_table, [key_column] + list(columns), rows)
+    if row_count:
+        assignments = ', '.join('{0} = updates.{0}'.format(column) for column in columns)
+        session.execute(text('UPDATE {0} SET {1} FROM {2} updates WHERE {0}.{3} = updates.{3}'.format(
+            table_name, assignments, temporary_table, key_column)))
+    session.execute(text('DROP TABLE {}'.format(temporary_table)))
+    return row_count
+
+
+def expire_loaded(mapped_class, attributes=None):
+    """Expires the loaded instances of a mapped class, such that values written in bulk are reloaded on access."""
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, mapped_class):
+            session.expire(instance, attributes)
+
+
+class IdAllocator:
+    """Allocates ids for the rows of a table in Python. Blocks of ids are reserved from the id sequence of the table,
+    such that rows inserted later by the database do not get the same id."""
+
+    def __init__(self, table_name, block_size=10000):
+        self.table_name = table_name
+        self.block_size = block_size
+        self.sequence = session.execute(text("SELECT pg_get_serial_sequence(:table_name, 'id')"),
+                                        {'table_name': table_name}).scalar()
+        self.reserved = []
+        self.last_id = None
+
+    def reserve(self):
+        """Reserves a new block of ids, from the sequence or, if the id column has no sequence, after the largest id."""
+        if self.sequence:
+            rows = session.execute(text('SELECT nextval(:sequence) FROM generate_series(1, :count)'),
+                                   {'sequence': self.sequence, 'count': self.block_size})
+            self.reserved = sorted((row[0] for row in rows), reverse=True)
+        else:
+            if self.last_id is None:
+                self.last_id = session.execute(text('SELECT coalesce(max(id), 0) FROM ' + self.table_name)).scalar()
+            self.reserved = list(range(self.last_id + self.block_size, self.last_id, -1))
+            self.last_id += self.block_size
+
+    def next(self):
+        """Returns the next free id."""
+        if not self.reserved:
+            self.reserve()
+        return self.reserved.pop()
+
+
+class StrokeWriter:
+    """Buffers the delimited strokes created during a construction stage. At the end of the stage, the strokes and the
+    delimited_stroke_id of their road sections are written with COPY, instead of a flush for each new stroke.
+    Geometries are converted locally, so the local geometry engine is required."""
+
+    columns = ['id', 'geom', 'level', 'begin_junction_id', 'end_junction_id', 'match_id']
+
+    def __init__(self, delimited_stroke_class):
+        assert local_geometry.enabled(), 'StrokeWriter requires the local geometry engine'
+        self.delimited_stroke_class = delimited_stroke_class
+        self.allocator = IdAllocator(delimited_stroke_class.__tablename__)
+        self.strokes = []
+
+    def add(self, delimited_stroke):
+        """Assigns an id to a new delimited stroke and buffers it."""
+        delimited_stroke.id = self.allocator.next()
+        self.strokes.append(delimited_stroke)
+
+    def flush(self, delimited_strokes):
+        """Writes the buffered strokes and the road section assignments, which are taken from the delimited strokes
+        store. Afterwards the strokes and the road sections in the session are marked as persisted."""
+        road_section_class = self.delimited_stroke_class.road_section_class
+        stroke_rows = [(stroke.id, local_geometry.to_hex_ewkb(stroke.geom), stroke.level, stroke.begin_junction_id,
+                        stroke.end_junction_id, stroke.match_id) for stroke in self.strokes]
+        section_rows = []
+        for stroke in self.strokes:
+            if stroke in session:
+                session.expunge(stroke)
+            make_transient_to_detached(stroke)
+            for section_id in delimited_strokes[stroke.id]:
+                section_rows.append((section_id, stroke.id))
+                # road sections that are no longer in the session are only updated in the database
+                road_section = session.identity_map.get(identity_key(road_section_class, section_id))
+                if road_section is not None:
+                    set_committed_value(road_section, 'delimited_stroke', stroke)
+                    set_committed_value(road_section, 'delimited_stroke_id', stroke.id)
+
+        copy_rows(self.delimited_stroke_class.__tablename__, self.columns, stroke_rows)
+        if section_rows:
+            bulk_update(road_section_class.__tablename__, 'id', ['delimited_stroke_id'], section_rows)
+        for stroke in self.strokes:
+            session.add(stroke)
+        stroke_count = len(self.strokes)
+        self.strokes = []
+        return stroke_count
+
+
+class LinkWriter:
+    """Streams the rows of the linking table to the database with COPY. Rows are buffered up to buffer_size rows, such
+    that memory use does not depend on the number of matches. The rows can also be written to a CSV file."""
+
+    columns = ['nwb_id', 'top10nl_id', 'match_id', 'similarity_score']
+
+    def __init__(self, table_name='linking_table', buffer_size=100000, file_path=None, to_database=True):
+        self.table_name = table_name
+        self.buffer_size = buffer_size
+        self.to_database = to_database
+        self.buffer = []
+        self.row_count = 0
+        self.file = None
+        self.file_writer = None
+        if file_path:
+            self.file = open(file_path, 'w', newline='')
+            self.file_writer = csv.writer(self.file)
+            self.file_writer.writerow(self.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, nwb_id, top10nl_id, match_id, similarity_score):
+        """Adds a row to the linking table."""
+        self.buffer.append((nwb_id, top10nl_id, match_id, similarity_score))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows."""
+        if self.to_database:
+            copy_rows(self.table_name, self.columns, self.buffer)
+        if self.file_writer:
+            self.file_writer.writerows(self.buffer)
+        self.row_count += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        """Writes the remaining rows and closes the file."""
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,155 @@
+"""Module checkpoint.py saves the state of the matching process after each stage of the pipeline in core.py, such
+that a run can be resumed after the last completed stage, or a stage can be run again without running the stages
+before it. The strokes and the stroke of each road section are copied to tables in the database, the delimited
+strokes stores are written to NumPy files and the matches to a JSON file in the checkpoint directory."""
+
+import itertools  # standard library
+import json
+import os
+
+from sqlalchemy import text  # 3rd party packages
+
+from dso import session  # local source
+from structure import Match
+from parallel import load_objects
+
+
+class Checkpoint:
+    """Checkpoints of the stages of a run, stored in a directory. The stages are recorded in order of completion in
+    the file stages.json. The changes map each stage to the columns of the road section tables and of the stroke
+    tables that it changes, of which the checkpoint of the stage copies the id and these columns. A stroke table is
+    copied completely if the stage adds or removes strokes, marked with '*', and a table that the stage does not
+    change, marked with None, is not copied."""
+
+    def __init__(self, directory, road_section_classes, delimited_stroke_classes, stages, changes):
+        self.directory = directory
+        self.road_section_classes = road_section_classes
+        self.delimited_stroke_classes = delimited_stroke_classes
+        self.stages = stages
+        self.changes = changes
+        os.makedirs(directory, exist_ok=True)
+
+    def stage_file(self, stage, suffix='.json'):
+        return os.path.join(self.directory, stage + suffix)
+
+    def completed_stages(self):
+        """Returns the names of the completed stages, in order of completion."""
+        path = os.path.join(self.directory, 'stages.json')
+        if not os.path.exists(path):
+            return []
+        with open(path) as file:
+            return json.load(file)
+
+    def set_completed_stages(self, stages):
+        with open(os.path.join(self.directory, 'stages.json'), 'w') as file:
+            json.dump(stages, file)
+
+    def save(self, stage, delimited_strokes_ref, delimited_strokes_target, matches):
+        """Saves the state after a stage and commits the session. The stage is recorded as completed after the state
+        is written, so an interrupted save is not resumed from. The checkpoints of the later stages depend on the state
+        before them, so they are no longer recorded as completed. The delimited strokes stores only change with the
+        strokes, so they are only written if the stroke tables are copied completely."""
+        road_section_columns, stroke_columns = self.changes[stage]
+        if road_section_columns is not None:
+            for mapped_class in self.road_section_classes:
+                snapshot_table(mapped_class.__tablename__, stage, 'id, ' + road_section_columns)
+        if stroke_columns is not None:
+            for mapped_class in self.delimited_stroke_classes:
+                snapshot_table(mapped_class.__tablename__, stage,
+                               stroke_columns if stroke_columns == '*' else 'id, ' + stroke_columns)
+        session.commit()
+
+        if stroke_columns == '*':
+            for delimited_strokes, suffix in ((delimited_strokes_ref, '_ref.npz'),
+                                              (delimited_strokes_target, '_target.npz')):
+                with open(self.stage_file(stage, suffix) + '.tmp', 'wb') as file:
+                    delimited_strokes.save(file)
+                os.replace(self.stage_file(stage, suffix) + '.tmp', self.stage_file(stage, suffix))
+        state = {'matches': [[match.id, [stroke.id for stroke in match.strokes_ref],
+                              [stroke.id for stroke in match.strokes_target], match.similarity_score]
+                             for match in matches]}
+        with open(self.stage_file(stage) + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.stage_file(stage) + '.tmp', self.stage_file(stage))
+
+        earlier_stages = self.stages[:self.stages.index(stage)]
+        stages = [completed for completed in self.completed_stages() if completed in earlier_stages]
+        self.set_completed_stages(stages + [stage])
+
+    def base_stage(self, stage):
+        """Returns the base stage of a stage: the last stage up to it that copies the stroke tables completely. The
+        strokes after the stage are those of the checkpoint of the base stage."""
+        return [base for base in self.stages[:self.stages.index(stage) + 1] if self.changes[base][1] == '*'][-1]
+
+    def restore(self, stage, delimited_strokes_ref=None, delimited_strokes_target=None):
+        """Restores the strokes in the database and, if they are given, the delimited strokes stores to the state after
+        the stage, from the checkpoint of the base stage and the columns copied by the stages after it. Stages that
+        were completed after it are no longer recorded as completed. Returns the list of matches."""
+        stages = self.completed_stages()
+        assert stage in stages, 'Stage ' + stage + ' has no checkpoint'
+        base_stage = self.base_stage(stage)
+        restored_stages = self.stages[self.stages.index(base_stage):self.stages.index(stage) + 1]
+        assert all(restored in stages for restored in restored_stages), \
+            'Stage ' + stage + ' needs the checkpoints of stages ' + ', '.join(restored_stages)
+
+        session.flush()
+        for delimited_stroke_class in self.delimited_stroke_classes:
+            table_name = delimited_stroke_class.__tablename__
+            session.execute(text('DELETE FROM ' + table_name))
+            session.execute(text('INSERT INTO {} SELECT * FROM {}'.format(table_name,
+                                                                          snapshot_name(table_name, base_stage))))
+        for restored in restored_stages:
+            road_section_columns, stroke_columns = self.changes[restored]
+            if road_section_columns is not None:
+                for road_section_class in self.road_section_classes:
+                    update_from_snapshot(road_section_class.__tablename__, restored, road_section_columns)
+            if stroke_columns is not None and stroke_columns != '*':
+                for delimited_stroke_class in self.delimited_stroke_classes:
+                    update_from_snapshot(delimited_stroke_class.__tablename__, restored, stroke_columns)
+        session.expire_all()
+
+        with open(self.stage_file(stage)) as file:
+            state = json.load(file)
+        stroke_ref_class, stroke_target_class = self.delimited_stroke_classes
+        if delimited_strokes_ref is not None:
+            self.load_stores(stage, delimited_strokes_ref, delimited_strokes_target)
+
+        strokes_ref = load_objects(stroke_ref_class,
+                                   {stroke_id for match in state['matches'] for stroke_id in match[1]})
+        strokes_target = load_objects(stroke_target_class,
+                                      {stroke_id for match in state['matches'] for stroke_id in match[2]})
+        matches = []
+        for match_id, ref_ids, target_ids, score in state['matches']:
+            match = Match([strokes_ref[stroke_id] for stroke_id in ref_ids],
+                          [strokes_target[stroke_id] for stroke_id in target_ids], similarity_score=score)
+            match.id = match_id
+            matches.append(match)
+        Match.id_iter = itertools.count(max([match.id for match in matches], default=-1) + 1)
+
+        self.set_completed_stages(stages[:stages.index(stage) + 1])
+        return matches
+
+    def load_stores(self, stage, delimited_strokes_ref, delimited_strokes_target):
+        """Loads the delimited strokes stores of the state after the stage, written by the base stage."""
+        delimited_strokes_ref.load(self.stage_file(self.base_stage(stage), '_ref.npz'))
+        delimited_strokes_target.load(self.stage_file(self.base_stage(stage), '_target.npz'))
+
+
+def snapshot_name(table_name, stage):
+    """Returns the name of the table with the copy of a table after a stage."""
+    return '{}_checkpoint_{}'.format(table_name, stage)
+
+
+def snapshot_table(table_name, stage, columns):
+    """Copies the columns of a table to the snapshot table of the stage."""
+    snapshot = snapshot_name(table_name, stage)
+    session.execute(text('DROP TABLE IF EXISTS ' + snapshot))
+    session.execute(text('CREATE TABLE {} AS SELECT {} FROM {}'.format(snapshot, columns, table_name)))
+
+
+def update_from_snapshot(table_name, stage, columns):
+    """Sets the columns of the rows of a table to their values in the snapshot table of the stage."""
+    session.execute(text('UPDATE {0} SET {2} FROM {1} snapshot WHERE {0}.id = snapshot.id'.format(
+        table_name, snapshot_name(table_name, stage),
+        ', '.join('{0} = snapshot.{0}'.format(column.strip()) for column in columns.split(',')))))
+
@@ -2,11 +2,14 @@
 
 from math import pi  # standard library
 
-from sqlalchemy import func  # 3rd party packages
+import numpy as np  # 3rd party packages
+from sqlalchemy.orm.util import identity_key
 
-from dso import deviation_angle, session, delimited_strokes_ref, delimited_strokes_target  # local source
-from helpers import angle_at_junction, clockwise_angle_difference
-from structure import DelimitedStrokeRef
+from dso import deviation_angle, session  # local source
+from helpers import angle_at_junction, clockwise_angle_difference, merge_geom
+from bulk import bulk_update, copy_rows, expire_loaded, IdAllocator, StrokeWriter
+import local_geometry
+from instrumentation import timed
 
 
 def classify_junction(junction):
@@ -44,36 +47,97 @@ def classify_junctions(junctions):
             classify_junction(junction)
 
 
-def construct_stroke(road_section, junction, delimited_stroke, level=1):
+def classify_graph(graph):
+    """Classifies all junctions of a RoadGraph at once, with the same rules as classify_junction, and sets their types
+    and angles in the arrays of the graph. Junctions of which a road section has no length at the junction are not
+    classified. Returns the indices of the classified junctions."""
+    angles = graph.adjacency_angles()
+    section_counts = np.diff(graph.adjacency_offsets)
+    classified = []
+    for section_count in np.unique(section_counts[graph.degree == 3]):
+        junctions = np.flatnonzero((graph.degree == 3) & (section_counts == section_count))
+        positions = graph.adjacency_offsets[junctions][:, None] + np.arange(section_count)
+        junction_angles = angles[positions]
+        valid = ~np.isnan(junction_angles).any(axis=1)
+        junctions, junction_angles = junctions[valid], np.sort(junction_angles[valid], axis=1)
+
+        # clockwise differences between consecutive angles, the last angle is compared to the first
+        angles_closed = np.concatenate([junction_angles, junction_angles[:, :1]], axis=1)
+        angle_differences = (angles_closed[:, 1:] - angles_closed[:, :-1]) % (2 * pi)
+        index_max = np.argmax(angle_differences, axis=1)
+        alpha = angle_differences[np.arange(len(junctions)), index_max]
+        index_perpendicular = np.minimum(np.where(index_max - 1 < 0, 2, index_max - 1), section_count)
+        perpendicular = angles_closed[np.arange(len(junctions)), index_perpendicular]
+
+        type_k3 = np.where(alpha < pi - deviation_angle, 0, np.where(alpha > pi + deviation_angle, 1, 2))
+        angle_k3 = np.where(type_k3 == 0, np.nan, perpendicular)
+        graph.type_k3[junctions] = type_k3
+        graph.angle_k3[junctions] = angle_k3
+        classified.append(junctions)
+    return np.concatenate(classified) if classified else np.zeros(0, dtype=np.int64)
+
+
+def classify_junctions_batch(graph, junction_class):
+    """Classifies all junctions of a RoadGraph with classify_graph, and writes the types and angles to the junction
+    table of junction_class in a single bulk update."""
+    junctions = classify_graph(graph)
+    rows = ((junction_id, junction_type, None if np.isnan(angle) else angle) for junction_id, junction_type, angle in
+            zip(graph.junction_ids[junctions].tolist(), graph.type_k3[junctions].tolist(),
+                graph.angle_k3[junctions].tolist()))
+    bulk_update(junction_class.__tablename__, 'id', ['type_k3', 'angle_k3'], rows)
+    expire_loaded(junction_class, ['type_k3', 'angle_k3'])
+    return len(junctions)
+
+
+@timed
+def construct_stroke(road_section, junction, delimited_stroke, level=1, stroke_writer=None):
     """Constructs a delimited stroke from road_section, with junction as its starting point.
-    If a delimited_stroke is given as input, the next road_section is added to this delimited_stroke."""
-    session.flush()
-    # the delimited stroke dictionary use here is based on type of the input stroke
-    if type(delimited_stroke) == DelimitedStrokeRef:
-        delimited_strokes = delimited_strokes_ref
-    else:
-        delimited_strokes = delimited_strokes_target
-    road_section.delimited_stroke = delimited_stroke
+    If a delimited_stroke is given as input, the next road_section is added to this delimited_stroke.
+    The road sections of the stroke are collected first by walking along the stroke, after which the geometry of the
+    stroke is merged once. If a stroke_writer is given, the session is not flushed."""
+    if stroke_writer is None:
+        session.flush()
+    # the delimited strokes store used here is based on the type of the input stroke
+    delimited_strokes = type(delimited_stroke).delimited_strokes
 
-    # determine which from which junction the next road section should be added
-    if junction == road_section.begin_junction:
-        next_junction = road_section.end_junction
-    else:
-        next_junction = road_section.begin_junction
+    added_sections = []
+    while True:
+        road_section.delimited_stroke = delimited_stroke
+
+        # determine which from which junction the next road section should be added
+        if junction == road_section.begin_junction:
+            next_junction = road_section.end_junction
+        else:
+            next_junction = road_section.begin_junction
+
+        # if the next_junction is the same as the begin_junction of the delimited stroke, it is a loop and can be
+        # returned
+        if next_junction.id == delimited_stroke.begin_junction_id:
+            break
+
+        next_road_section = select_next_section(road_section, next_junction, level)
+        if next_road_section is None:
+            break
+        added_sections.append(next_road_section)
+        delimited_strokes.append(delimited_stroke.id, next_road_section.id)
+        road_section, junction = next_road_section, next_junction
+
+    if added_sections:
+        delimited_stroke.geom = merge_geom([delimited_stroke.geom] + [section.geom for section in added_sections])
+    # if the stroke is not extended, the end junction is set
+    delimited_stroke.end_junction_id = next_junction.id
+    return delimited_stroke
 
-    # if the next_junction is the same as the begin_junction of the delimited stroke, it is a loop and can be returned
-    if next_junction.id == delimited_stroke.begin_junction_id:
-        delimited_stroke.end_junction_id = next_junction.id
-        return delimited_stroke
 
+def select_next_section(road_section, next_junction, level):
+    """Selects the road section at next_junction that extends the delimited stroke ending with road_section.
+    Returns None if the stroke ends at next_junction."""
     # if the degree of the next junction is 2, the road section that is not equal to the input is added
     # to the delimited stroke
     if next_junction.degree == 2:
         for next_road_section in next_junction.road_sections:
             if next_road_section != road_section:
-                delimited_stroke.geom = session.query(func.st_linemerge(func.st_collect(delimited_stroke.geom, next_road_section.geom)))
-                delimited_strokes[delimited_stroke.id].append(next_road_section)
-                return construct_stroke(next_road_section, next_junction, delimited_stroke, level)
+                return next_road_section
 
     # only strokes at level 1, are extended with sections that have good continuity
     if level == 1:
@@ -88,59 +152,311 @@ def construct_stroke(road_section, junction, delimited_stroke, level=1):
                         if next_angle != next_junction.angle_k3:
                             # if the next section is a loop, it is not added to the delimited stroke
                             if next_road_section.begin_junction == next_road_section.end_junction:
-                                delimited_stroke.end_junction_id = next_junction.id
-                                return delimited_stroke
+                                return None
+                            return next_road_section
+    return None
 
-                            # merge the selected section with the existing delimited stroke to extend it
-                            delimited_stroke.geom = session.query(func.st_linemerge(func.st_collect(
-                                delimited_stroke.geom, next_road_section.geom)))
-                            delimited_strokes[delimited_stroke.id].append(next_road_section)
-                            return construct_stroke(next_road_section, next_junction, delimited_stroke, level)
 
-    # if the stroke is not extended, the end junction is set
-    delimited_stroke.end_junction_id = next_junction.id
-    return delimited_stroke
-
-
-def construct_strokes(junctions, delimited_stroke_class):
-    """Starts the construction of a stroke from every node that is an effective terminating node."""
+def construct_strokes(junctions, delimited_stroke_class, stroke_writer=None):
+    """Starts the construction of a stroke from every node that is an effective terminating node. If a stroke_writer
+    is given, the new strokes are buffered in it instead of flushed to the database one by one."""
     for junction in junctions:
         if junction.degree == 1 or junction.degree > 2:
             if junction.type_k3 == 2:
                 for road_section in junction.road_sections:
                     if junction.angle_k3 == angle_at_junction(road_section, junction) and road_section.delimited_stroke is None:
-                        delimited_stroke = construct_stroke_from_section(road_section, delimited_stroke_class)
+                        delimited_stroke = construct_stroke_from_section(road_section, delimited_stroke_class,
+                                                                         stroke_writer=stroke_writer)
                         delimited_stroke.begin_junction_id = junction.id
-                        construct_stroke(road_section, junction, delimited_stroke)
+                        construct_stroke(road_section, junction, delimited_stroke, stroke_writer=stroke_writer)
                         break
             else:
                 for road_section in junction.road_sections:
                     if road_section.delimited_stroke is None:
-                        delimited_stroke = construct_stroke_from_section(road_section, delimited_stroke_class)
+                        delimited_stroke = construct_stroke_from_section(road_section, delimited_stroke_class,
+                                                                         stroke_writer=stroke_writer)
                         delimited_stroke.begin_junction_id = junction.id
-                        construct_stroke(road_section, junction, delimited_stroke)
+                        construct_stroke(road_section, junction, delimited_stroke, stroke_writer=stroke_writer)
+
+
+def stroke_chains(graph):
+    """Determines the level 1 strokes of a classified RoadGraph by traversing its adjacency, with the same rules as
+    construct_strokes followed by construct_stroke_from_section for the remaining road sections, in order of junction
+    and road section id. Returns a list of (begin junction, end junction, road sections) per stroke, in order of
+    construction, with the indices of the junctions and road sections in the graph."""
+    offsets = graph.adjacency_offsets.tolist()
+    adjacency = graph.adjacency.tolist()
+    angles = graph.angles.tolist()
+    degree = graph.degree.tolist()
+    type_k3 = graph.type_k3.tolist()
+    angle_k3 = graph.angle_k3.tolist()
+    section_junctions = graph.section_junctions.tolist()
+    stroke_of = [None] * graph.section_count
+
+    def angle_at(section, junction):
+        for position in range(offsets[junction], offsets[junction + 1]):
+            if adjacency[position] == section:
+                return angles[position]
+
+    def next_section(section, junction):
+        # see select_next_section
+        if degree[junction] == 2:
+            for next_road_section in adjacency[offsets[junction]:offsets[junction + 1]]:
+                if next_road_section != section:
+                    return next_road_section
+        if type_k3[junction] == 2 and angle_at(section, junction) != angle_k3[junction]:
+            for position in range(offsets[junction], offsets[junction + 1]):
+                next_road_section = adjacency[position]
+                if next_road_section != section and stroke_of[next_road_section] is None and \
+                        angles[position] != angle_k3[junction]:
+                    if section_junctions[next_road_section][0] == section_junctions[next_road_section][1]:
+                        return None
+                    return next_road_section
+        return None
 
+    def chain(section, junction):
+        # see construct_stroke
+        chain_sections = [section]
+        stroke_of[section] = len(chains)
+        begin_junction = junction
+        while True:
+            begin, end = section_junctions[section]
+            next_junction = end if junction == begin else begin
+            if next_junction == begin_junction or next_junction < 0:
+                break
+            section = next_section(section, next_junction)
+            if section is None:
+                break
+            chain_sections.append(section)
+            stroke_of[section] = len(chains)
+            junction = next_junction
+        chains.append((begin_junction, next_junction, chain_sections))
 
-def construct_stroke_from_section(road_section, delimited_stroke_class, level=1, begin_junction=None):
-    """Creates an instance of the delimited stroke class from a single road section."""
+    chains = []
+    for junction in range(graph.junction_count):
+        if degree[junction] == 1 or degree[junction] > 2:
+            for position in range(offsets[junction], offsets[junction + 1]):
+                section = adjacency[position]
+                if type_k3[junction] == 2:
+                    if angle_k3[junction] == angles[position] and stroke_of[section] is None:
+                        chain(section, junction)
+                        break
+                elif stroke_of[section] is None:
+                    chain(section, junction)
+    for section in range(graph.section_count):
+        if stroke_of[section] is None:
+            stroke_of[section] = len(chains)
+            chains.append((section_junctions[section][0], section_junctions[section][1], [section]))
+    return chains
+
+
+def construct_strokes_batch(graph, delimited_stroke_class):
+    """Constructs all level 1 strokes of a classified RoadGraph with stroke_chains, and writes the strokes and the
+    road section assignments in bulk. The geometries of the road sections are queried per batch of strokes, and the
+    stroke ids are set in the section_stroke array of the graph. Requires the local geometry engine. Returns the
+    number of strokes."""
+    road_section_class = delimited_stroke_class.road_section_class
+    delimited_strokes = delimited_stroke_class.delimited_strokes
+    chains = stroke_chains(graph)
+    section_ids = graph.section_ids.tolist()
+    junction_ids = graph.junction_ids.tolist() + [None]  # index -1 is a junction that is not in the graph
+
+    allocator = IdAllocator(delimited_stroke_class.__tablename__)
+    section_rows = []
+    for start in range(0, len(chains), 10000):
+        batch = chains[start:start + 10000]
+        geoms = dict(session.query(road_section_class.id, road_section_class.geom).filter(road_section_class.id.in_(
+            [section_ids[section] for _, _, sections in batch for section in sections])))
+        stroke_rows = []
+        for begin_junction, end_junction, sections in batch:
+            stroke_id = allocator.next()
+            stroke_section_ids = [section_ids[section] for section in sections]
+            if len(sections) > 1:
+                geom = local_geometry.merge([geoms[section_id] for section_id in stroke_section_ids])
+            else:
+                geom = geoms[stroke_section_ids[0]]
+            stroke_rows.append((stroke_id, local_geometry.to_hex_ewkb(geom), 1, junction_ids[begin_junction],
+                                junction_ids[end_junction], None))
+            section_rows += [(section_id, stroke_id) for section_id in stroke_section_ids]
+            delimited_strokes[stroke_id] = stroke_section_ids
+            graph.section_stroke[sections] = stroke_id
+        copy_rows(delimited_stroke_class.__tablename__, StrokeWriter.columns, stroke_rows)
+
+    if section_rows:
+        bulk_update(road_section_class.__tablename__, 'id', ['delimited_stroke_id'], section_rows)
+    expire_loaded(road_section_class, ['delimited_stroke_id', 'delimited_stroke'])
+    return len(chains)
+
+
+def construct_stroke_from_section(road_section, delimited_stroke_class, level=1, begin_junction=None,
+                                  stroke_writer=None):
+    """Creates an instance of the delimited stroke class from a single road section. If a stroke_writer is given, the
+    id of the stroke is assigned by the writer instead of the database."""
     delimited_stroke = delimited_stroke_class(geom=road_section.geom, begin_junction_id=road_section.begin_junction_id,
-                                              end_junction_id=road_section.end_junction_id, level=level)
+                                              end_junction_id=road_section.end_junction_id, level=level, match_id=None)
     if begin_junction:
         delimited_stroke.begin_junction_id = begin_junction.id
         if begin_junction == road_section.end_junction:
             delimited_stroke.end_junction_id = road_section.begin_junction_id
-    session.add(delimited_stroke)
-    session.flush()
+    if stroke_writer is None:
+        session.add(delimited_stroke)
+        session.flush()
+    else:
+        stroke_writer.add(delimited_stroke)
     road_section.delimited_stroke = delimited_stroke
 
     # add the created stroke to the local storage
-    if delimited_stroke_class == DelimitedStrokeRef:
-        delimited_strokes_ref[delimited_stroke.id] = [road_section]
-    else:
-        delimited_strokes_target[delimited_stroke.id] = [road_section]
+    delimited_stroke_class.delimited_strokes[delimited_stroke.id] = [road_section.id]
     return delimited_stroke
 
 
+def level_2_chains(road_sections, begin_junction_id, degrees):
+    """Splits the ordered road sections of a stroke in the chains of the level 2 strokes, like construct_stroke with
+    level 2: a chain only continues at junctions of degree 2, and ends where it returns to its begin junction. The road
+    sections are rows with id, begin_junction_id and end_junction_id. Returns a list of (begin junction id, end
+    junction id, road sections) per chain."""
+    chains = []
+    junction_id = begin_junction_id
+    position = 0
+    while position < len(road_sections):
+        road_section = road_sections[position]
+        chain = [road_section]
+        chain_begin_id = junction_id
+        while True:
+            if junction_id == road_section.begin_junction_id:
+                next_junction_id = road_section.end_junction_id
+            else:
+                next_junction_id = road_section.begin_junction_id
+            if next_junction_id == chain_begin_id or degrees.get(next_junction_id) != 2:
+                break
+            # at a junction of degree 2 the stroke continued with the next road section
+            if position + 1 == len(road_sections) or next_junction_id not in (
+                    road_sections[position + 1].begin_junction_id, road_sections[position + 1].end_junction_id):
+                break
+            position += 1
+            road_section = road_sections[position]
+            chain.append(road_section)
+            junction_id = next_junction_id
+        chains.append((chain_begin_id, next_junction_id, chain))
+        junction_id = next_junction_id
+        position += 1
+    return chains
+
+
+def construct_strokes_lvl2_batch(delimited_stroke_class, stroke_ids=None):
+    """Replaces all unmatched strokes by strokes of level 2 at once. Only the id columns, geometries and junction
+    degrees are queried, the chains are determined from the road section ids in the delimited strokes store, and the
+    new strokes, the road section assignments and the removal of the old strokes are written in bulk. The strokes are
+    equal to those constructed section by section, except that a chain never continues into the road sections of
+    another stroke, so every road section is in one stroke of level 2. If stroke_ids is given, only these strokes are
+    considered, of which only those of level 1 are replaced. Requires the local geometry engine. Returns the ids of the
+    new strokes."""
+    road_section_class = delimited_stroke_class.road_section_class
+    junction_class = delimited_stroke_class.junction_class
+    delimited_strokes = delimited_stroke_class.delimited_strokes
+    strokes = session.query(delimited_stroke_class.id, delimited_stroke_class.begin_junction_id)\
+        .filter(delimited_stroke_class.level == 1, delimited_stroke_class.match_id == None)\
+        .order_by(delimited_stroke_class.id)
+    if stroke_ids is not None:
+        strokes = strokes.filter(delimited_stroke_class.id.in_(stroke_ids))
+    strokes = strokes.all()
+
+    section_ids = sorted({section_id for stroke in strokes for section_id in delimited_strokes[stroke.id]})
+    road_sections = {}
+    for start in range(0, len(section_ids), 10000):
+        for road_section in session.query(road_section_class.id, road_section_class.begin_junction_id,
+                                          road_section_class.end_junction_id, road_section_class.geom)\
+                .filter(road_section_class.id.in_(section_ids[start:start + 10000])):
+            road_sections[road_section.id] = road_section
+    junction_ids = sorted({road_section.begin_junction_id for road_section in road_sections.values()} |
+                          {road_section.end_junction_id for road_section in road_sections.values()})
+    degrees = {}
+    for start in range(0, len(junction_ids), 10000):
+        degrees.update(session.query(junction_class.id, junction_class.degree)
+                       .filter(junction_class.id.in_(junction_ids[start:start + 10000])))
+
+    allocator = IdAllocator(delimited_stroke_class.__tablename__)
+    stroke_rows = []
+    section_rows = []
+    new_strokes = {}
+    for stroke in strokes:
+        stroke_sections = [road_sections[section_id] for section_id in delimited_strokes[stroke.id]]
+        for begin_junction_id, end_junction_id, chain in level_2_chains(stroke_sections, stroke.begin_junction_id,
+                                                                        degrees):
+            stroke_id = allocator.next()
+            if len(chain) > 1:
+                geom = local_geometry.merge([road_section.geom for road_section in chain])
+            else:
+                geom = chain[0].geom
+            stroke_rows.append((stroke_id, local_geometry.to_hex_ewkb(geom), 2, begin_junction_id, end_junction_id,
+                                None))
+            section_rows += [(road_section.id, stroke_id) for road_section in chain]
+            new_strokes[stroke_id] = [road_section.id for road_section in chain]
+
+    copy_rows(delimited_stroke_class.__tablename__, StrokeWriter.columns, stroke_rows)
+    if section_rows:
+        bulk_update(road_section_class.__tablename__, 'id', ['delimited_stroke_id'], section_rows)
+    old_stroke_ids = [stroke.id for stroke in strokes]
+    for start in range(0, len(old_stroke_ids), 10000):
+        session.query(delimited_stroke_class)\
+            .filter(delimited_stroke_class.id.in_(old_stroke_ids[start:start + 10000]))\
+            .delete(synchronize_session=False)
+    for stroke_id in old_stroke_ids:
+        delimited_strokes.pop(stroke_id, None)
+        old_stroke = session.identity_map.get(identity_key(delimited_stroke_class, stroke_id))
+        if old_stroke is not None:
+            session.expunge(old_stroke)
+    expire_loaded(road_section_class, ['delimited_stroke_id', 'delimited_stroke'])
+    for stroke_id, stroke_section_ids in new_strokes.items():
+        delimited_strokes[stroke_id] = stroke_section_ids
+    if junction_class.road_graph is not None:
+        junction_class.road_graph.set_section_strokes([row[0] for row in section_rows],
+                                                      [row[1] for row in section_rows])
+    return list(new_strokes)
+
+
+def load_delimited_strokes(road_section_class, delimited_stroke_class, stroke_ids, delimited_strokes):
+    """Loads the road section ids of existing strokes from the database into the delimited strokes store. The road
+    sections of each stroke are ordered from its begin junction, as they were added during construction. Only the id
+    columns are queried, no mapped objects are loaded."""
+    for stroke_id in stroke_ids:
+        delimited_strokes.pop(stroke_id, None)
+    for start in range(0, len(stroke_ids), 10000):
+        batch = stroke_ids[start:start + 10000]
+        begin_junction_ids = dict(session.query(delimited_stroke_class.id, delimited_stroke_class.begin_junction_id)
+                                  .filter(delimited_stroke_class.id.in_(batch)))
+        stroke_sections = {}
+        for road_section in session.query(road_section_class.id, road_section_class.delimited_stroke_id,
+                                          road_section_class.begin_junction_id, road_section_class.end_junction_id)\
+                .filter(road_section_class.delimited_stroke_id.in_(batch)).order_by(road_section_class.id):
+            stroke_sections.setdefault(road_section.delimited_stroke_id, []).append(road_section)
+        for stroke_id, road_sections in stroke_sections.items():
+            if stroke_id in begin_junction_ids:
+                road_sections = order_road_sections(road_sections, begin_junction_ids[stroke_id])
+            delimited_strokes[stroke_id] = [road_section.id for road_section in road_sections]
+
+
+def order_road_sections(road_sections, begin_junction_id):
+    """Orders the road sections of a stroke as a chain, starting at the begin junction of the stroke. Road sections
+    that are not connected to the chain are added at the end."""
+    remaining = list(road_sections)
+    ordered = []
+    junction_id = begin_junction_id
+    while remaining:
+        for road_section in remaining:
+            if junction_id in (road_section.begin_junction_id, road_section.end_junction_id):
+                break
+        else:
+            break
+        remaining.remove(road_section)
+        ordered.append(road_section)
+        if road_section.begin_junction_id == junction_id:
+            junction_id = road_section.end_junction_id
+        else:
+            junction_id = road_section.begin_junction_id
+    return ordered + remaining
+
+
 def reset_delimited_strokes(road_sections):
     """Resets each delimited stroke of the input road sections."""
     for each in road_sections:
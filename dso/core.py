@@ -1,15 +1,47 @@
 """Module core.py is the main executable. It runs the construction and matching functions in order, and generates an
 output of the algorithm."""
 
-import time  # standard library
-import traceback
+import argparse  # standard library
+import atexit
+import itertools
+import time
 
-from dso import session, delimited_strokes_ref, delimited_strokes_target  # local source
+from sqlalchemy import or_  # 3rd party packages
+
+from dso import session  # local source
+from membership import delimited_strokes_ref, delimited_strokes_target
 from structure import RoadSectionRef, JunctionRef, RoadSectionTarget, JunctionTarget, DelimitedStrokeRef, \
-    DelimitedStrokeTarget, LinkingTable
+    DelimitedStrokeTarget, LinkingTable, Match
 from construction import classify_junctions, construct_stroke, construct_strokes, reset_delimited_strokes, \
-    construct_stroke_from_section
-from matching import find_matching_candidates
+    construct_stroke_from_section, classify_junctions_batch, load_delimited_strokes, construct_strokes_lvl2_batch, \
+    construct_strokes_batch
+from matching import find_best_match, match_exists, match_links
+from parallel import parallel_matching_process, load_objects
+from pushdown import pushdown_matching_process
+from prefetch import prefetch_matching_process
+from snapshot import save_snapshot, write_membership, open_snapshot, snapshot_exists, matches_database
+from assignment import assignment_matching_process, methods as assignment_methods
+from spatial_index import load_junction_index
+from graph import attach_graph
+from bulk import LinkWriter
+import local_geometry
+from metrics import metric_cache
+from checkpoint import Checkpoint
+from files import file_process
+from sweep import sweep_process, read_grid
+from instrumentation import profile
+from tiles import tile_keys, tile_extent, preprocess_tiled, owned_strokes, tile_junction_index, load_match_sections, \
+    remove_overwritten_matches, release_tile
+from incremental import record_hashes, changed_sections, affected_strokes, nearby_strokes, affected_junctions, \
+    affected_matches, reset_matches, last_match_id
+
+# stages of the matching process, in order of execution
+stages = ['preprocess', 'match_lvl1', 'prepare_lvl2', 'match_lvl2', 'output']
+# columns of the road section and stroke tables that each stage changes, copied by its checkpoint, see Checkpoint
+stage_changes = {'preprocess': ('delimited_stroke_id', '*'), 'match_lvl1': (None, 'match_id'),
+                 'prepare_lvl2': ('delimited_stroke_id', '*'), 'match_lvl2': (None, 'match_id'), 'output': (None, None)}
+# level of the strokes constructed by the stages that construct strokes, of which a snapshot stores the membership
+stroke_levels = {'preprocess': 1, 'prepare_lvl2': 2}
 
 
 def preprocess_reference(preprocessing_check):
@@ -17,18 +49,30 @@ def preprocess_reference(preprocessing_check):
         delimited strokes at level 1. Set the input preprocessing_check to false if the junctions are already
         classified and saved in the database."""
     session.query(DelimitedStrokeRef).delete()
-    reset_delimited_strokes(session.query(RoadSectionRef))
+    metric_cache.clear()
+    if local_geometry.enabled():
+        session.query(RoadSectionRef).update({RoadSectionRef.delimited_stroke_id: None}, synchronize_session='evaluate')
+        graph = attach_graph(RoadSectionRef, JunctionRef, DelimitedStrokeRef)
+        if preprocessing_check:
+            print("Classifying junctions of the reference database.")
+            classify_junctions_batch(graph, JunctionRef)
+        print("Constructing strokes of the reference database.")
+        construct_strokes_batch(graph, DelimitedStrokeRef)
+        return
 
+    reset_delimited_strokes(session.query(RoadSectionRef))
     junctions_ref = session.query(JunctionRef)
     if preprocessing_check:
         print("Classifying junctions of the reference database.")
         classify_junctions(junctions_ref)
 
     print("Constructing strokes of the reference database.")
-    construct_strokes(junctions_ref, DelimitedStrokeRef)
-    remaining_sections_ref = session.query(RoadSectionRef).filter(RoadSectionRef.delimited_stroke_id == None)
-    for road_section in remaining_sections_ref:
-        construct_stroke_from_section(road_section, DelimitedStrokeRef)
+    with session.no_autoflush:
+        construct_strokes(junctions_ref, DelimitedStrokeRef)
+        remaining_sections_ref = session.query(RoadSectionRef).filter(RoadSectionRef.delimited_stroke_id == None)
+        for road_section in remaining_sections_ref:
+            if road_section.delimited_stroke is None:
+                construct_stroke_from_section(road_section, DelimitedStrokeRef)
 
 
 def preprocess_target(preprocessing_check):
@@ -36,131 +80,498 @@ def preprocess_target(preprocessing_check):
         delimited strokes at level 1. Set the input preprocessing_check to false if the junctions are already
         classified and saved in the database"""
     session.query(DelimitedStrokeTarget).delete()
-    reset_delimited_strokes(session.query(RoadSectionTarget))
+    metric_cache.clear()
+    if local_geometry.enabled():
+        session.query(RoadSectionTarget).update({RoadSectionTarget.delimited_stroke_id: None}, synchronize_session='evaluate')
+        graph = attach_graph(RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget)
+        if preprocessing_check:
+            print("Classifying junctions of the target database.")
+            classify_junctions_batch(graph, JunctionTarget)
+        print("Constructing strokes of the target database.")
+        construct_strokes_batch(graph, DelimitedStrokeTarget)
+        return
 
+    reset_delimited_strokes(session.query(RoadSectionTarget))
     junctions_target = session.query(JunctionTarget)
     if preprocessing_check:
         print("Classifying junctions of the target database.")
         classify_junctions(junctions_target)
 
     print("Constructing strokes of the target database.")
-    construct_strokes(junctions_target, DelimitedStrokeTarget)
-    remaining_sections_target = session.query(RoadSectionTarget).filter(RoadSectionTarget.delimited_stroke_id == None)
-    for road_section in remaining_sections_target:
-        construct_stroke_from_section(road_section, DelimitedStrokeTarget)
-
-
-def prepare_strokes_lvl2(delimited_stroke_class):
-    """Constructs delimited strokes of level 2 for road sections in strokes that could not be matched."""
-    not_matched_strokes = session.query(delimited_stroke_class).filter(delimited_stroke_class.match_id == None)
-    if delimited_stroke_class == DelimitedStrokeRef:
-        delimited_strokes = delimited_strokes_ref
-    else:
-        delimited_strokes = delimited_strokes_target
-
+    with session.no_autoflush:
+        construct_strokes(junctions_target, DelimitedStrokeTarget)
+        remaining_sections_target = session.query(RoadSectionTarget).filter(RoadSectionTarget.delimited_stroke_id == None)
+        for road_section in remaining_sections_target:
+            if road_section.delimited_stroke is None:
+                construct_stroke_from_section(road_section, DelimitedStrokeTarget)
+
+
+def prepare_strokes_lvl2(delimited_stroke_class, stroke_ids=None):
+    """Constructs delimited strokes of level 2 for road sections in strokes of level 1 that could not be matched. If
+    stroke_ids is given, only these strokes are considered. Returns the ids of the new strokes. With the local geometry
+    engine, all strokes are constructed at once and written in bulk."""
+    if local_geometry.enabled():
+        return construct_strokes_lvl2_batch(delimited_stroke_class, stroke_ids)
+    not_matched_strokes = session.query(delimited_stroke_class).filter(delimited_stroke_class.level == 1,
+                                                                       delimited_stroke_class.match_id == None)
+    if stroke_ids is not None:
+        not_matched_strokes = not_matched_strokes.filter(delimited_stroke_class.id.in_(stroke_ids))
+    not_matched_strokes = not_matched_strokes.all()
+    delimited_strokes = delimited_stroke_class.delimited_strokes
+    # the road sections of all strokes are loaded at once, the store only contains their ids
+    road_sections = load_objects(delimited_stroke_class.road_section_class,
+                                 {section_id for delimited_stroke in not_matched_strokes
+                                  for section_id in delimited_strokes[delimited_stroke.id]})
+
+    new_stroke_ids = []
     for delimited_stroke in not_matched_strokes:
-        for road_section in delimited_strokes[delimited_stroke.id]:
+        metric_cache.invalidate(delimited_stroke)
+        stroke_sections = [road_sections[section_id] for section_id in delimited_strokes[delimited_stroke.id]]
+        for road_section in stroke_sections:
             road_section.delimited_stroke = None
         begin_junction = delimited_stroke.begin_junction
-        for road_section in delimited_strokes[delimited_stroke.id]:
+        for road_section in stroke_sections:
             if road_section.delimited_stroke is None:
                 new_stroke = construct_stroke_from_section(road_section, delimited_stroke_class, level=2,
                                                            begin_junction=begin_junction)
                 extended_stroke = construct_stroke(road_section, begin_junction, new_stroke, level=2)
                 begin_junction = extended_stroke.end_junction
+                new_stroke_ids.append(new_stroke.id)
+
+    removed_strokes = session.query(delimited_stroke_class).filter(delimited_stroke_class.level == 1,
+                                                                   delimited_stroke_class.match_id == None)
+    if stroke_ids is not None:
+        removed_strokes = removed_strokes.filter(delimited_stroke_class.id.in_(stroke_ids))
+    removed_strokes.delete(synchronize_session=False if stroke_ids is not None else 'evaluate')
+    return new_stroke_ids
+
+
+def matching_process(level, tolerance_distance, workers=1, stroke_ids=None, junction_index=None, pushdown=False,
+                     assignment=None, prefetch=False, snapshot=None):
+    """Searches for a match for each delimited stroke in the reference database. The strokes are processed in order of
+    id. With more than one worker, the search is done in parallel for spatial partitions of the strokes. If stroke_ids
+    is given, only these strokes are matched. If no junction_index is given, one is built over all target junctions.
+    With pushdown, the candidates are generated in the database with one query per batch of strokes instead. With an
+    assignment method, all candidates are found first and the matches are selected at once, see assignment.py. With
+    prefetch, the objects of the next batches of strokes are loaded by a background thread during the matching. If
+    the directory of a snapshot is given, its junction index is used."""
+    if snapshot is not None and junction_index is None and local_geometry.enabled():
+        junction_index = open_snapshot(snapshot)['target'].junction_index()
+    if assignment is not None:
+        return assignment_matching_process(level, tolerance_distance, assignment, workers, stroke_ids=stroke_ids,
+                                           junction_index=junction_index)
+    if pushdown:
+        return pushdown_matching_process(level, tolerance_distance, stroke_ids=stroke_ids)
+    if workers > 1:
+        return parallel_matching_process(level, tolerance_distance, workers, stroke_ids=stroke_ids, snapshot=snapshot)
+    if prefetch:
+        return prefetch_matching_process(level, tolerance_distance, stroke_ids=stroke_ids,
+                                         junction_index=junction_index)
 
-    session.query(delimited_stroke_class).filter(delimited_stroke_class.level == 1,
-                                                 delimited_stroke_class.match_id == None).delete()
-
-
-def matching_process(level, tolerance_distance):
-    """Searches for a match for each delimited stroke in the reference database."""
     strokes_ref = session.query(DelimitedStrokeRef).filter(DelimitedStrokeRef.level == level,
-                                                           DelimitedStrokeRef.match_id == None)
+                                                           DelimitedStrokeRef.match_id == None)\
+        .order_by(DelimitedStrokeRef.id)
+    if stroke_ids is not None:
+        strokes_ref = strokes_ref.filter(DelimitedStrokeRef.id.in_(stroke_ids))
+    if junction_index is None and local_geometry.enabled():
+        junction_index = load_junction_index(JunctionTarget, cell_size=tolerance_distance)
     count = 0
     all_matches = []
     for stroke in strokes_ref:
-        try:
-            matches = find_matching_candidates(stroke, tolerance_distance)
-        except AssertionError as e:
-            print(e)
-            print(traceback.format_exc())
-            print('Something went wrong trying to find a match for stroke', stroke.id)
-            matches = None
-        # TODO add correct Exception, merging looping road sections is not possible
-
-        if matches:
-            best_score = 0
-            best_match = None
-            for match in matches:
-                if match.similarity_score >= best_score:
-                    best_match = match
-                    best_score = match.similarity_score
-
-            if best_match:
-                for stroke_ref in best_match.strokes_ref:
-                    stroke_ref.match_id = best_match.id
-                for stroke_target in best_match.strokes_target:
-                    stroke_target.match_id = best_match.id
-
-                all_matches.append(best_match)
+        best_match = find_best_match(stroke, tolerance_distance, junction_index)
+        if best_match:
+            best_match.set_stroke_match_id()
+            all_matches.append(best_match)
         count += 1
+        profile.count('strokes')
         if count % 100 == 0:
             print('Strokes analyzed:', count)
 
     return all_matches
 
 
-def generate_output(matches):
+def generate_output(matches, file_path=None, replace=True, assigned=False):
+    """Writes the road sections of each match that still exists to the linking table, and optionally to a CSV file.
+    The rows are streamed with COPY in batches. If replace is false, the existing rows of the linking table are kept.
+    If assigned, the matches were selected by an assignment and do not overlap, so they all exist."""
+    if replace:
+        session.query(LinkingTable).delete()
+    with LinkWriter(file_path=file_path) as link_writer:
+        for match in matches:
+            if not assigned and not match_exists(match):
+                # print('Match', match.id, 'no longer exists')
+                continue
+            for row in match_links(match):
+                link_writer.write(*row)
+            # if match.similarity_score < 0.2:
+            #     print('score:', match.similarity_score, ', ref stroke', match.strokes_ref[0].id)
+    return link_writer.row_count
+
+
+def incremental_update(tolerance_distance, changed_ref_ids=None, changed_target_ids=None, workers=1):
+    """Updates the result of an earlier run after road sections changed. If the changed road section ids are not
+    given, they are found by comparing the road sections to the geometry hashes recorded in the earlier run. Only the
+    strokes within the tolerance distance of the changed road sections are constructed again, and only these strokes,
+    the strokes of the other database within the tolerance distance of them and the strokes of their matches are
+    matched again. Returns False if there is no earlier run to update."""
+    if changed_ref_ids is None:
+        changed_ref_ids = changed_sections(RoadSectionRef)
+    if changed_target_ids is None:
+        changed_target_ids = changed_sections(RoadSectionTarget)
+    if changed_ref_ids is None or changed_target_ids is None:
+        print('No recorded run to update, run the complete matching process first.')
+        return False
+    print('Changed road sections:', len(changed_ref_ids), 'reference,', len(changed_target_ids), 'target')
+
+    affected_ref = affected_strokes(RoadSectionRef, DelimitedStrokeRef, changed_ref_ids, tolerance_distance)
+    affected_target = affected_strokes(RoadSectionTarget, DelimitedStrokeTarget, changed_target_ids,
+                                       tolerance_distance)
+    # a change in one database can change the matches of the strokes of the other database near it
+    nearby_ref = nearby_strokes(RoadSectionTarget, DelimitedStrokeTarget, affected_target, changed_target_ids,
+                                DelimitedStrokeRef, tolerance_distance)
+    nearby_target = nearby_strokes(RoadSectionRef, DelimitedStrokeRef, affected_ref, changed_ref_ids,
+                                   DelimitedStrokeTarget, tolerance_distance)
+    match_ids = affected_matches(DelimitedStrokeRef, sorted(set(affected_ref) | set(nearby_ref))) | \
+        affected_matches(DelimitedStrokeTarget, sorted(set(affected_target) | set(nearby_target)))
+    rematch_ref, rematch_target = reset_matches([DelimitedStrokeRef, DelimitedStrokeTarget], LinkingTable, match_ids)
+    rematch_ref = sorted(set(rematch_ref) | set(nearby_ref))
+    rematch_target = sorted(set(rematch_target) | set(nearby_target))
+    Match.id_iter = itertools.count((last_match_id([DelimitedStrokeRef, DelimitedStrokeTarget], LinkingTable) or 0) + 1)
+    session.expire_all()
+
+    rebuilt_ref = rebuild_strokes(RoadSectionRef, JunctionRef, DelimitedStrokeRef, affected_ref, changed_ref_ids,
+                                  tolerance_distance)
+    rebuilt_target = rebuild_strokes(RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget, affected_target,
+                                     changed_target_ids, tolerance_distance)
+    # the kept strokes of level 2 are only matched again at level 2, prepare_strokes_lvl2 skips them
+    kept_ref = sorted(set(rematch_ref) - set(affected_ref))
+    kept_target = sorted(set(rematch_target) - set(affected_target))
+    load_delimited_strokes(RoadSectionRef, DelimitedStrokeRef, kept_ref, delimited_strokes_ref)
+    load_delimited_strokes(RoadSectionTarget, DelimitedStrokeTarget, kept_target, delimited_strokes_target)
+    print('Strokes to match:', len(rebuilt_ref) + len(kept_ref))
+    if workers > 1:
+        session.commit()
+
+    matches_result = matching_process(1, tolerance_distance, workers, stroke_ids=rebuilt_ref + kept_ref)
+    session.flush()
+    lvl2_ref = prepare_strokes_lvl2(DelimitedStrokeRef, stroke_ids=rebuilt_ref + kept_ref)
+    prepare_strokes_lvl2(DelimitedStrokeTarget, stroke_ids=rebuilt_target + kept_target)
+    if workers > 1:
+        session.commit()
+    matches_result += matching_process(2, tolerance_distance, workers, stroke_ids=lvl2_ref + kept_ref)
+    # the matched strokes of the other database that were not constructed or loaded again are not in the store yet
+    load_match_sections(matches_result)
+    generate_output(matches_result, replace=False)
+
+    record_hashes(RoadSectionRef)
+    record_hashes(RoadSectionTarget)
+    return True
+
+
+def rebuild_strokes(road_section_class, junction_class, delimited_stroke_class, stroke_ids, changed_ids,
+                    tolerance_distance):
+    """Removes the input strokes, classifies the junctions near the changed road sections again and constructs new
+    level 1 strokes for the road sections of the removed strokes and the new road sections. Returns the ids of the new
+    strokes."""
+    delimited_strokes = delimited_stroke_class.delimited_strokes
+
+    junction_ids = affected_junctions(road_section_class, junction_class, changed_ids, tolerance_distance)
+    session.query(junction_class).filter(junction_class.id.in_(junction_ids))\
+        .update({junction_class.type_k3: None, junction_class.angle_k3: None}, synchronize_session=False)
+    classify_junctions(session.query(junction_class).filter(junction_class.id.in_(junction_ids)))
+
+    road_sections = session.query(road_section_class).filter(or_(
+        road_section_class.delimited_stroke_id.in_(stroke_ids), road_section_class.id.in_(changed_ids))).all()
+    for stroke_id in stroke_ids:
+        delimited_strokes.pop(stroke_id, None)
+    reset_delimited_strokes(road_sections)
+    session.flush()
+    session.query(delimited_stroke_class).filter(delimited_stroke_class.id.in_(stroke_ids))\
+        .delete(synchronize_session=False)
+    session.expire_all()
+
+    stroke_ids_before = set(delimited_strokes)
+    end_junction_ids = {road_section.begin_junction_id for road_section in road_sections} | \
+        {road_section.end_junction_id for road_section in road_sections}
+    junctions = session.query(junction_class).filter(junction_class.id.in_(end_junction_ids))\
+        .order_by(junction_class.id)
+    construct_strokes(junctions, delimited_stroke_class)
+    for road_section in road_sections:
+        if road_section.delimited_stroke is None:
+            construct_stroke_from_section(road_section, delimited_stroke_class)
+    return sorted(set(delimited_strokes) - stroke_ids_before)
+
+
+def tiled_process(tolerance_distance, tile_size):
+    """Runs the complete matching process tile by tile, such that only the objects of one tile are kept in memory.
+    Matches are written to the linking table after each tile. Returns the number of matches."""
+    keys = tile_keys([JunctionRef, JunctionTarget], tile_size)
+    extents = [tile_extent(key, tile_size) for key in keys]
+    print('Tiles:', len(keys))
     session.query(LinkingTable).delete()
-    for match in matches:
-        strokes = session.query(DelimitedStrokeRef).filter(DelimitedStrokeRef.match_id == match.id)
-        if not strokes.first():
-            # print('Match', match.id, 'no longer exists')
-            continue
-        for stroke_ref in match.strokes_ref:
-            try:
-                for section_ref in delimited_strokes_ref[stroke_ref.id]:
-                    for stroke_target in match.strokes_target:
-                        for section_target in delimited_strokes_target[stroke_target.id]:
-                            link = LinkingTable(nwb_id=section_ref.id, top10nl_id=section_target.id, match_id=match.id,
-                                                similarity_score=match.similarity_score)
-                            session.add(link)
-                            session.flush()
-            except KeyError:
-                print('Stroke', stroke_ref.id, 'not recorded in delimited strokes dictionary')
-        # if match.similarity_score < 0.2:
-        #     print('score:', match.similarity_score, ', ref stroke', match.strokes_ref[0].id)
+    metric_cache.clear()
 
+    print("Constructing strokes of the reference database.")
+    preprocess_tiled(RoadSectionRef, JunctionRef, DelimitedStrokeRef, delimited_strokes_ref, extents)
+    print("Constructing strokes of the target database.")
+    preprocess_tiled(RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget, delimited_strokes_target, extents)
+
+    match_count = 0
+    for level in (1, 2):
+        if level == 2:
+            print('Preparing strokes lvl 2')
+            for extent in extents:
+                for road_section_class, delimited_stroke_class, delimited_strokes in (
+                        (RoadSectionRef, DelimitedStrokeRef, delimited_strokes_ref),
+                        (RoadSectionTarget, DelimitedStrokeTarget, delimited_strokes_target)):
+                    stroke_ids = owned_strokes(delimited_stroke_class, 1, extent)
+                    if stroke_ids:
+                        load_delimited_strokes(road_section_class, delimited_stroke_class, stroke_ids,
+                                               delimited_strokes)
+                        prepare_strokes_lvl2(delimited_stroke_class, stroke_ids=stroke_ids)
+                release_tile()
+
+        # strokes are owned by the tile of the lower left corner of their bounding box, which may have no junctions
+        keys = tile_keys([JunctionRef, JunctionTarget], tile_size, [DelimitedStrokeRef, DelimitedStrokeTarget])
+        extents = [tile_extent(key, tile_size) for key in keys]
+        print('Matching strokes lvl', level)
+        for extent in extents:
+            stroke_ids = owned_strokes(DelimitedStrokeRef, level, extent)
+            if stroke_ids:
+                matches = matching_process(level, tolerance_distance, stroke_ids=stroke_ids,
+                                           junction_index=tile_junction_index(stroke_ids, tolerance_distance))
+                session.flush()
+                load_match_sections(matches)
+                generate_output(matches, replace=False)
+                match_count += len(matches)
+            release_tile()
+
+    remove_overwritten_matches()
+    record_hashes(RoadSectionRef)
+    record_hashes(RoadSectionTarget)
+    session.commit()
+    return match_count
+
+
+def attach_graphs(snapshot=None, level=None):
+    """Attaches the RoadGraph of both databases to their junction classes, read from the snapshot if its directory is
+    given, or else from the database. With a snapshot, the stroke membership of the level is used for the graphs and
+    the delimited strokes stores if the snapshot has it. Returns True if it is used for both databases."""
+    if snapshot is not None:
+        network_snapshots = open_snapshot(snapshot)
+        return all([network_snapshots['ref'].attach_graph(RoadSectionRef, JunctionRef, DelimitedStrokeRef, level,
+                                                          delimited_strokes_ref),
+                    network_snapshots['target'].attach_graph(RoadSectionTarget, JunctionTarget,
+                                                             DelimitedStrokeTarget, level, delimited_strokes_target)])
+    attach_graph(RoadSectionRef, JunctionRef, DelimitedStrokeRef)
+    attach_graph(RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget)
+    return False
+
+
+def run_stage(stage, matches, tolerance_distance, workers=1, pushdown=False, assignment=None, prefetch=False,
+              snapshot=None):
+    """Runs a stage of the matching process. The matches found in the stage are added to the list of matches. If
+    the directory of a snapshot is given, the preprocessed networks and the stroke membership of each level are
+    written to it, and the matching stages use it."""
+    if stage == 'preprocess':
+        preprocess_reference(1)
+        preprocess_target(1)
+        if snapshot is not None and local_geometry.enabled():
+            session.flush()
+            save_snapshot(snapshot, tolerance_distance, {'ref': delimited_strokes_ref,
+                                                         'target': delimited_strokes_target})
+    elif stage == 'match_lvl1':
+        print('Matching strokes lvl 1')
+        matches += matching_process(level=1, tolerance_distance=tolerance_distance, workers=workers,
+                                    pushdown=pushdown, assignment=assignment, prefetch=prefetch, snapshot=snapshot)
+        session.flush()
+    elif stage == 'prepare_lvl2':
+        print('Preparing strokes lvl 2')
+        prepare_strokes_lvl2(DelimitedStrokeRef)
+        prepare_strokes_lvl2(DelimitedStrokeTarget)
+        if snapshot is not None and local_geometry.enabled():
+            session.flush()
+            write_membership(snapshot, stroke_levels[stage], {'ref': delimited_strokes_ref,
+                                                              'target': delimited_strokes_target})
+    elif stage == 'match_lvl2':
+        print('Matching strokes lvl 2')
+        matches += matching_process(level=2, tolerance_distance=tolerance_distance, workers=workers,
+                                    pushdown=pushdown, assignment=assignment, prefetch=prefetch, snapshot=snapshot)
+    elif stage == 'output':
+        print('Generating output')
+        generate_output(matches, assigned=assignment is not None)
+        record_hashes(RoadSectionRef)
+        record_hashes(RoadSectionTarget)
+
+
+def run_pipeline(tolerance_distance, workers=1, checkpoint=None, resume=False, single_stage=None, pushdown=False,
+                 assignment=None, prefetch=False, snapshot=None):
+    """Runs the stages of the matching process in order. After each stage the session is committed and, if a
+    checkpoint is given, the state is saved. With resume, the run continues after the last completed stage of the
+    checkpoint. With single_stage, only that stage is run, from the checkpoint of the stage before it. If the
+    directory of a snapshot is given, it is written after preprocessing, and used by runs that start later."""
+    first_stage = 0
+    matches = []
+    if single_stage is not None:
+        first_stage = stages.index(single_stage)
+    elif resume and checkpoint is not None and checkpoint.completed_stages():
+        first_stage = stages.index(checkpoint.completed_stages()[-1]) + 1
+    if first_stage > 0:
+        assert checkpoint is not None, 'A checkpoint is required to start after the first stage'
+        restored_stage = stages[first_stage - 1]
+        print('Restoring checkpoint of stage', restored_stage)
+        matches = checkpoint.restore(restored_stage)
+        metric_cache.clear()
+        if snapshot is not None and not (snapshot_exists(snapshot) and matches_database(snapshot)):
+            print('Snapshot', snapshot, 'is missing or does not match the database, it is not used')
+            snapshot = None
+        # the delimited strokes stores are read from the checkpoint if the snapshot has no membership of the strokes
+        level = stroke_levels[checkpoint.base_stage(restored_stage)]
+        if not (local_geometry.enabled() and attach_graphs(snapshot, level)):
+            checkpoint.load_stores(restored_stage, delimited_strokes_ref, delimited_strokes_target)
+    last_stage = first_stage + 1 if single_stage is not None else len(stages)
+
+    for stage in stages[first_stage:last_stage]:
+        stage_start_time = time.time()
+        print('---------------------')
+        with profile.stage(stage):
+            run_stage(stage, matches, tolerance_distance, workers, pushdown, assignment, prefetch, snapshot)
+        if checkpoint is not None:
+            checkpoint.save(stage, delimited_strokes_ref, delimited_strokes_target, matches)
+        else:
+            # the worker processes and the prefetch thread have their own database connection, and only see
+            # committed strokes
+            session.commit()
+        print('Stage', stage, 'completed, time elapsed:', round(time.time()-stage_start_time, 2), 's')
+    return matches
 
-# execution of algorithm starts here
-start_time = time.time()
-
-preprocess_reference(1)
-preprocess_target(1)
-
-print('---------------------')
-print('Matching strokes lvl 1')
-
-matches_result = []
-matches_result += matching_process(level=1, tolerance_distance=20)
-
-session.flush()
-
-print('---------------------')
-print('Matching strokes lvl 2')
-
-prepare_strokes_lvl2(DelimitedStrokeRef)
-prepare_strokes_lvl2(DelimitedStrokeTarget)
-matches_result += matching_process(level=2, tolerance_distance=20)
-
-print('---------------------')
-print('Generating output')
-generate_output(matches_result)
-
-session.commit()
-session.close()
 
-end_time = time.time()
-print('---------------------')
-print('Matching completed, time elapsed:', round(end_time-start_time, 2), 's')
+# execution of algorithm starts here
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Matches the road sections of the reference and target database.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used for the matching process (default: 1)')
+    # the ways to find the matches, of which one can be used
+    matching_method = parser.add_mutually_exclusive_group()
+    matching_method.add_argument('--pushdown', action='store_true',
+                                 help='generate the matching candidates with set-based queries in the database')
+    matching_method.add_argument('--prefetch', action='store_true',
+                                 help='load the strokes of the next batches in a background thread during the '
+                                      'matching')
+    matching_method.add_argument('--assignment', choices=assignment_methods,
+                                 help='find all candidates first and select the matches at once, greedily by score or '
+                                      'exactly per connected component')
+    parser.add_argument('--snapshot', help='directory of a snapshot of the preprocessed networks, written after '
+                                           'preprocessing and used by later runs that resume from a checkpoint')
+    # the processes other than the complete matching process in stages, of which one can be used
+    process = parser.add_mutually_exclusive_group()
+    process.add_argument('--incremental', action='store_true',
+                         help='only update the result of the previous run for the changed road sections')
+    parser.add_argument('--checkpoint',
+                        help='directory of the checkpoints saved after each stage, no checkpoints are saved if it is '
+                             'not given')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue after the last completed stage of the checkpoint')
+    parser.add_argument('--stage', choices=stages,
+                        help='only run this stage, from the checkpoint of the stage before it')
+    process.add_argument('--tile-size', type=float,
+                         help='process the network in square tiles of this size in meters, to limit the memory use')
+    process.add_argument('--ref-file', help='GeoPackage or GeoParquet file with the reference road sections, to run '
+                                            'without a database')
+    parser.add_argument('--target-file', help='GeoPackage or GeoParquet file with the target road sections')
+    parser.add_argument('--output',
+                        help='CSV file for the linking table when running on files (default: linking_table.csv)')
+    parser.add_argument('--sweep', help='JSON file with a list of tolerance settings, to run the matching process on '
+                                        'files for each setting with one preprocessing of the networks')
+    parser.add_argument('--sweep-output',
+                        help='directory for the linking tables and summary of a sweep (default: sweep)')
+    parser.add_argument('--profile', help='write the time spent per stage, function and SQL statement to this JSON or '
+                                          'CSV file')
+    arguments = parser.parse_args()
+
+    # options that are only used by some processes are rejected instead of ignored, the options of the processes on
+    # files require the argument of their process
+    options = {'--workers': arguments.workers > 1, '--pushdown': arguments.pushdown, '--prefetch': arguments.prefetch,
+               '--assignment': arguments.assignment is not None, '--snapshot': arguments.snapshot is not None,
+               '--checkpoint': arguments.checkpoint is not None, '--resume': arguments.resume,
+               '--stage': arguments.stage is not None}
+    file_options = {'--target-file': (arguments.target_file is not None, '--ref-file'),
+                    '--output': (arguments.output is not None, '--ref-file'),
+                    '--sweep-output': (arguments.sweep_output is not None, '--sweep')}
+    options.update((option, used) for option, (used, _) in file_options.items())
+    if arguments.sweep:
+        process_option, supported_options = '--sweep', ['--target-file', '--sweep-output']
+    elif arguments.ref_file:
+        process_option, supported_options = '--ref-file', ['--assignment', '--target-file', '--output']
+    elif arguments.incremental:
+        process_option, supported_options = '--incremental', ['--workers']
+    elif arguments.tile_size:
+        process_option, supported_options = '--tile-size', []
+    else:
+        process_option, supported_options = None, [option for option in options if option not in file_options]
+    for option, used in options.items():
+        if used and option not in supported_options:
+            if process_option is None:
+                parser.error('argument {}: requires argument {}'.format(option, file_options[option][1]))
+            parser.error('argument {}: not allowed with argument {}'.format(option, process_option))
+    if arguments.workers > 1 and (arguments.pushdown or arguments.prefetch):
+        parser.error('argument --workers: not allowed with argument {}, which runs in a single process'
+                     .format('--pushdown' if arguments.pushdown else '--prefetch'))
+    if (arguments.resume or arguments.stage) and arguments.checkpoint is None:
+        parser.error('argument {}: requires argument --checkpoint'
+                     .format('--resume' if arguments.resume else '--stage'))
+    if (arguments.ref_file or arguments.sweep) and not (arguments.ref_file and arguments.target_file):
+        parser.error('arguments --ref-file and --target-file are both required to run on files')
+    # the defaults of the options of the processes on files are set after the validation, which rejects them when given
+    arguments.output = arguments.output or 'linking_table.csv'
+    arguments.sweep_output = arguments.sweep_output or 'sweep'
+
+    start_time = time.time()
+    if arguments.profile:
+        profile.enable()
+        atexit.register(profile.dump, arguments.profile)
+
+    if arguments.ref_file and arguments.sweep:
+        summary = sweep_process(arguments.ref_file, arguments.target_file, read_grid(arguments.sweep),
+                                arguments.sweep_output)
+        print('---------------------')
+        print('Sweep completed,', len(summary), 'settings written to', arguments.sweep_output, ', time elapsed:',
+              round(time.time()-start_time, 2), 's')
+        raise SystemExit
+
+    if arguments.ref_file:
+        row_count = file_process(arguments.ref_file, arguments.target_file, arguments.output,
+                                 assignment=arguments.assignment)
+        print('---------------------')
+        print('Matching completed,', row_count, 'rows written to', arguments.output, ', time elapsed:',
+              round(time.time()-start_time, 2), 's')
+        raise SystemExit
+
+    if arguments.incremental:
+        if incremental_update(tolerance_distance=20, workers=arguments.workers):
+            session.commit()
+            session.close()
+            print('---------------------')
+            print('Incremental update completed, time elapsed:', round(time.time()-start_time, 2), 's')
+            raise SystemExit
+        session.close()
+        raise SystemExit(1)
+
+    if arguments.tile_size:
+        tiled_process(tolerance_distance=20, tile_size=arguments.tile_size)
+        session.close()
+        print('---------------------')
+        print('Tiled matching completed, time elapsed:', round(time.time()-start_time, 2), 's')
+        raise SystemExit
+
+    run_pipeline(tolerance_distance=20, workers=arguments.workers,
+                 checkpoint=Checkpoint(arguments.checkpoint, [RoadSectionRef, RoadSectionTarget],
+                                       [DelimitedStrokeRef, DelimitedStrokeTarget], stages, stage_changes)
+                 if arguments.checkpoint else None,
+                 resume=arguments.resume, single_stage=arguments.stage, pushdown=arguments.pushdown,
+                 assignment=arguments.assignment, prefetch=arguments.prefetch, snapshot=arguments.snapshot)
+    session.close()
+
+    end_time = time.time()
+    print('---------------------')
+    print('Matching completed, time elapsed:', round(end_time-start_time, 2), 's')
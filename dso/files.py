@@ -0,0 +1,389 @@
+"""Module files.py is a storage backend that reads the road sections of the reference and target database from
+GeoPackage or GeoParquet files, instead of the PostGIS tables. The topology is created in memory in the same way as
+the SQL scripts do with pgr_createTopology, and construction and matching run on in-memory objects with the same
+attributes as the mapped classes in structure.py, so no database connection is needed. The linking table is written
+to a CSV file. GeoPandas is an optional dependency that is only needed for this backend, and the local geometry
+engine is required."""
+
+from itertools import count  # standard library
+
+try:  # 3rd party packages
+    import geopandas
+    import numpy as np
+    from shapely.geometry import LineString, Point
+    from shapely.ops import linemerge
+except ImportError:
+    geopandas = None
+
+import dso  # local source
+from membership import delimited_strokes_ref, delimited_strokes_target, StrokeMembership
+from construction import classify_graph, stroke_chains, level_2_chains
+from helpers import merge_geom
+from graph import RoadGraph, coordinate_arrays
+from matching import find_best_match, match_exists, match_links
+from spatial_index import JunctionIndex
+from assignment import CandidateGraph, stroke_candidates
+from bulk import LinkWriter
+import local_geometry
+from metrics import metric_cache
+from instrumentation import profile
+
+grid_size = 0.001  # meters, equal to ST_SnapToGrid in the SQL scripts
+
+
+class RoadSection:
+    """Road section of a file, with the attributes of the mapped road section classes."""
+
+    def __init__(self, section_id, geom, begin_junction, end_junction):
+        self.id = section_id
+        self.geom = geom
+        self.begin_junction = begin_junction
+        self.end_junction = end_junction
+        self.delimited_stroke = None
+
+    @property
+    def begin_junction_id(self):
+        return self.begin_junction.id
+
+    @property
+    def end_junction_id(self):
+        return self.end_junction.id
+
+    @property
+    def delimited_stroke_id(self):
+        return None if self.delimited_stroke is None else self.delimited_stroke.id
+
+
+class Junction:
+    """Junction created from the end points of the road sections, with the attributes of the mapped junction
+    classes. The degree is the number of road section ends at the junction, like cnt of pgr_analyzeGraph."""
+
+    road_graph = None
+
+    def __init__(self, junction_id, geom):
+        self.id = junction_id
+        self.geom = geom
+        self.degree = 0
+        self.type_k3 = None
+        self.angle_k3 = None
+        self.road_sections = []
+
+
+class DelimitedStroke:
+    """Delimited stroke in memory, with the attributes of the mapped stroke classes. The junctions are looked up by id
+    in the junctions dictionary of the class, which is set when a network is read. The cached metrics are removed when
+    the geometry is set, like for the mapped classes."""
+    junctions = {}
+    delimited_strokes = StrokeMembership()
+
+    def __init__(self, geom=None, begin_junction_id=None, end_junction_id=None, level=1, match_id=None):
+        self.id = None
+        self._geom = geom
+        self.begin_junction_id = begin_junction_id
+        self.end_junction_id = end_junction_id
+        self.level = level
+        self.match_id = match_id
+
+    @property
+    def geom(self):
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        metric_cache.invalidate(self)
+        self._geom = geom
+
+    @property
+    def begin_junction(self):
+        return self.junctions.get(self.begin_junction_id)
+
+    @property
+    def end_junction(self):
+        return self.junctions.get(self.end_junction_id)
+
+
+# separate classes for both databases, such that the cached metrics and stroke stores are kept apart
+class RoadSectionRef(RoadSection):
+    pass
+
+
+class RoadSectionTarget(RoadSection):
+    pass
+
+
+class JunctionRef(Junction):
+    pass
+
+
+class JunctionTarget(Junction):
+    pass
+
+
+class DelimitedStrokeRef(DelimitedStroke):
+    junctions = {}
+    delimited_strokes = delimited_strokes_ref
+
+
+class DelimitedStrokeTarget(DelimitedStroke):
+    junctions = {}
+    delimited_strokes = delimited_strokes_target
+
+
+class Network:
+    """Road sections, junctions and delimited strokes of one database in memory. The network is also the stroke
+    writer of the construction functions: new strokes get the next id and are stored in the strokes dictionary. The
+    RoadGraph of the network is attached to the junction class, such that the construction and matching traverse its
+    arrays."""
+
+    def __init__(self, road_sections, junctions, junction_class, delimited_stroke_class):
+        self.road_sections = road_sections
+        self.junctions = junctions
+        self.delimited_stroke_class = delimited_stroke_class
+        self.strokes = {}
+        self.stroke_ids = count(1)
+        delimited_stroke_class.junctions.clear()
+        delimited_stroke_class.junctions.update(junctions)
+        delimited_stroke_class.delimited_strokes.clear()
+        self.graph = self.build_graph()
+        self.graph.attach(junction_class, self.stroke)
+
+    def add(self, delimited_stroke):
+        """Assigns an id to a new delimited stroke and stores it."""
+        delimited_stroke.id = next(self.stroke_ids)
+        self.strokes[delimited_stroke.id] = delimited_stroke
+
+    def stroke(self, stroke_id):
+        """Returns the stroke with the input id."""
+        return self.strokes.get(stroke_id)
+
+    def build_graph(self):
+        """Builds the RoadGraph of the road sections and junctions, in order of id."""
+        junction_ids = sorted(self.junctions)
+        position = {junction_id: index for index, junction_id in enumerate(junction_ids)}
+        junctions = [self.junctions[junction_id] for junction_id in junction_ids]
+        road_sections = [self.road_sections[section_id] for section_id in sorted(self.road_sections)]
+        coord_offsets, coords = coordinate_arrays([road_section.geom for road_section in road_sections])
+        return RoadGraph(junction_ids, [junction.geom.coords[0] for junction in junctions],
+                         [junction.degree for junction in junctions], [-1] * len(junctions),
+                         [np.nan] * len(junctions), [road_section.id for road_section in road_sections],
+                         [(position[road_section.begin_junction_id], position[road_section.end_junction_id])
+                          for road_section in road_sections], [-1] * len(road_sections), coord_offsets, coords)
+
+    def update_graph(self, road_sections):
+        """Sets the strokes of the input road sections in the graph, after they were changed on the objects."""
+        self.graph.set_section_strokes([road_section.id for road_section in road_sections],
+                                       [-1 if road_section.delimited_stroke is None else
+                                        road_section.delimited_stroke.id for road_section in road_sections])
+
+    def junction_index(self, cell_size):
+        """Builds a JunctionIndex over the junctions of the network."""
+        return JunctionIndex(list(self.junctions), [junction.geom.coords[0] for junction in self.junctions.values()],
+                             cell_size, junctions=self.junctions)
+
+
+def read_file(file_path, layer=None):
+    """Reads a GeoPackage, or a GeoParquet file if the extension is .parquet, into a GeoDataFrame. The feature ids of a
+    GeoPackage are used as index."""
+    assert geopandas is not None, 'The file backend requires GeoPandas'
+    if file_path.endswith('.parquet'):
+        return geopandas.read_parquet(file_path)
+    return geopandas.read_file(file_path, layer=layer, fid_as_index=True)
+
+
+def snap_to_grid(line):
+    """Rounds the coordinates of a line to the grid and removes repeated points, equal to ST_SnapToGrid. Returns None if
+    less than two points remain."""
+    coords = np.round(np.asarray(line.coords)[:, :2] / grid_size) * grid_size
+    coords = coords[np.concatenate([[True], np.any(coords[1:] != coords[:-1], axis=1)])]
+    if len(coords) < 2:
+        return None
+    return LineString(coords)
+
+
+def single_line(geom):
+    """Converts a (multi) line geometry to a single line. Returns None if that is not possible."""
+    if geom is None or geom.is_empty:
+        return None
+    if geom.geom_type == 'MultiLineString':
+        geom = linemerge(geom)
+    if geom.geom_type != 'LineString':
+        return None
+    return geom
+
+
+def read_network(file_path, id_column, road_section_class, junction_class, delimited_stroke_class, layer=None):
+    """Reads the road sections of one database from a file and creates the network. If the id column is not found,
+    the feature ids are used."""
+    data = read_file(file_path, layer)
+    section_ids = data[id_column] if id_column in data.columns else data.index
+    return create_network(zip(section_ids.tolist(), data.geometry), road_section_class, junction_class,
+                          delimited_stroke_class)
+
+
+def create_network(rows, road_section_class, junction_class, delimited_stroke_class):
+    """Creates a network with topology from (id, geometry) rows of road sections. The road sections are processed in
+    order of id, and the junctions get ids in the order in which their points are found, first the begin and then the
+    end point of each road section, like pgr_createTopology. Road sections without a single line geometry are
+    skipped."""
+    rows = sorted(((int(section_id), geom) for section_id, geom in rows), key=lambda row: row[0])
+    junctions = {}
+    junction_ids = {}
+    road_sections = {}
+    skipped = 0
+    for section_id, geom in rows:
+        line = single_line(geom)
+        line = snap_to_grid(line) if line is not None else None
+        if line is None:
+            skipped += 1
+            continue
+        ends = []
+        for point in (line.coords[0], line.coords[-1]):
+            junction_id = junction_ids.get(point)
+            if junction_id is None:
+                junction_id = junction_ids[point] = len(junction_ids) + 1
+                junctions[junction_id] = junction_class(junction_id, Point(point))
+            ends.append(junctions[junction_id])
+        road_section = road_section_class(section_id, line, ends[0], ends[1])
+        road_sections[section_id] = road_section
+        for junction in ends:
+            junction.degree += 1
+        ends[0].road_sections.append(road_section)
+        if ends[1] is not ends[0]:
+            ends[1].road_sections.append(road_section)
+    if skipped:
+        print('Road sections without a line geometry skipped:', skipped)
+    return Network(road_sections, junctions, junction_class, delimited_stroke_class)
+
+
+def preprocess(network):
+    """Classifies the junctions and constructs the delimited strokes at level 1 of a network."""
+    classify_network(network)
+    construct_network(network)
+
+
+def classify_network(network):
+    """Classifies the junctions of a network with classify_graph, and sets the types and angles on the junctions.
+    Returns the number of junctions."""
+    graph = network.graph
+    for junction in classify_graph(graph).tolist():
+        network.junctions[int(graph.junction_ids[junction])].type_k3 = int(graph.type_k3[junction])
+        angle = float(graph.angle_k3[junction])
+        network.junctions[int(graph.junction_ids[junction])].angle_k3 = None if np.isnan(angle) else angle
+    return len(network.junctions)
+
+
+def construct_network(network):
+    """Constructs the delimited strokes at level 1 of a network with stroke_chains, first from the junctions and then
+    from the remaining road sections, in order of id. Returns the number of road sections."""
+    graph = network.graph
+    delimited_stroke_class = network.delimited_stroke_class
+    junction_ids = graph.junction_ids.tolist()
+    section_ids = graph.section_ids.tolist()
+    for begin_junction, end_junction, sections in stroke_chains(graph):
+        road_sections = [network.road_sections[section_ids[section]] for section in sections]
+        geom = road_sections[0].geom
+        if len(road_sections) > 1:
+            geom = merge_geom([road_section.geom for road_section in road_sections])
+        delimited_stroke = delimited_stroke_class(geom=geom, begin_junction_id=junction_ids[begin_junction],
+                                                  end_junction_id=junction_ids[end_junction], level=1, match_id=None)
+        network.add(delimited_stroke)
+        for road_section in road_sections:
+            road_section.delimited_stroke = delimited_stroke
+        delimited_stroke_class.delimited_strokes[delimited_stroke.id] = [road_section.id
+                                                                         for road_section in road_sections]
+        graph.section_stroke[sections] = delimited_stroke.id
+    return len(network.road_sections)
+
+
+def prepare_strokes_lvl2(network):
+    """Replaces the strokes of level 1 that could not be matched by strokes of level 2, split with
+    construction.level_2_chains like construction.construct_strokes_lvl2_batch does in the database, such that both
+    backends construct the same strokes."""
+    delimited_stroke_class = network.delimited_stroke_class
+    delimited_strokes = delimited_stroke_class.delimited_strokes
+    not_matched_strokes = [stroke for stroke in network.strokes.values()
+                           if stroke.level == 1 and stroke.match_id is None]
+    degrees = {junction_id: junction.degree for junction_id, junction in network.junctions.items()}
+    road_sections = []
+    for delimited_stroke in not_matched_strokes:
+        metric_cache.invalidate(delimited_stroke)
+        stroke_sections = [network.road_sections[section_id] for section_id in delimited_strokes[delimited_stroke.id]]
+        for begin_junction_id, end_junction_id, chain in level_2_chains(stroke_sections,
+                                                                        delimited_stroke.begin_junction_id, degrees):
+            geom = chain[0].geom
+            if len(chain) > 1:
+                geom = merge_geom([road_section.geom for road_section in chain])
+            new_stroke = delimited_stroke_class(geom=geom, begin_junction_id=begin_junction_id,
+                                                end_junction_id=end_junction_id, level=2, match_id=None)
+            network.add(new_stroke)
+            for road_section in chain:
+                road_section.delimited_stroke = new_stroke
+            delimited_strokes[new_stroke.id] = [road_section.id for road_section in chain]
+        del network.strokes[delimited_stroke.id]
+        delimited_strokes.pop(delimited_stroke.id, None)
+        road_sections += stroke_sections
+    network.update_graph(road_sections)
+
+
+def matching_process(network_ref, level, junction_index, tolerance_distance, assignment=None):
+    """Searches for a match for each unmatched delimited stroke of a level in the reference network, in order of id.
+    With an assignment method, the matches are selected in two phases with assignment.CandidateGraph instead."""
+    strokes_ref = [stroke for stroke in network_ref.strokes.values()
+                   if stroke.level == level and stroke.match_id is None]
+    if assignment is not None:
+        graph = CandidateGraph()
+        for stroke in strokes_ref:
+            for match in stroke_candidates(stroke, tolerance_distance, junction_index):
+                graph.add_match(match)
+        print('Strokes analyzed:', len(strokes_ref), ', candidates:', len(graph.candidates))
+        profile.count('strokes', len(strokes_ref))
+        return graph.apply(graph.assign(assignment))
+
+    all_matches = []
+    for stroke in strokes_ref:
+        best_match = find_best_match(stroke, tolerance_distance, junction_index)
+        if best_match:
+            best_match.set_stroke_match_id()
+            all_matches.append(best_match)
+    print('Strokes analyzed:', len(strokes_ref))
+    profile.count('strokes', len(strokes_ref))
+    return all_matches
+
+
+def file_process(file_path_ref, file_path_target, output_path, id_column_ref='wvk_id', id_column_target='ogc_fid',
+                 tolerance_distance=None, assignment=None):
+    """Runs the complete matching process on files and writes the linking table to a CSV file. Returns the number of
+    rows of the linking table. The tolerance distance is that of the dso package if it is not given. The assignment
+    method is passed to matching_process."""
+    assert local_geometry.enabled(), 'The file backend requires the local geometry engine'
+    if tolerance_distance is None:
+        tolerance_distance = dso.tolerance_distance
+    metric_cache.clear()
+    network_ref = read_network(file_path_ref, id_column_ref, RoadSectionRef, JunctionRef, DelimitedStrokeRef)
+    network_target = read_network(file_path_target, id_column_target, RoadSectionTarget, JunctionTarget,
+                                  DelimitedStrokeTarget)
+    print('Road sections:', len(network_ref.road_sections), 'reference,', len(network_target.road_sections),
+          'target')
+
+    with profile.stage('preprocess'):
+        preprocess(network_ref)
+        preprocess(network_target)
+    junction_index = network_target.junction_index(tolerance_distance)
+
+    print('Matching strokes lvl 1')
+    with profile.stage('match_lvl1'):
+        matches = matching_process(network_ref, 1, junction_index, tolerance_distance, assignment)
+    with profile.stage('prepare_lvl2'):
+        prepare_strokes_lvl2(network_ref)
+        prepare_strokes_lvl2(network_target)
+    print('Matching strokes lvl 2')
+    with profile.stage('match_lvl2'):
+        matches += matching_process(network_ref, 2, junction_index, tolerance_distance, assignment)
+
+    with profile.stage('output'), LinkWriter(file_path=output_path, to_database=False) as link_writer:
+        for match in matches:
+            # the matches of an assignment do not overlap, so they all exist
+            if assignment is not None or match_exists(match):
+                for row in match_links(match):
+                    link_writer.write(*row)
+    return link_writer.row_count
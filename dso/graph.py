@@ -0,0 +1,232 @@
+"""Module graph.py contains a compact, array-backed representation of a road network. The road sections and junctions
+are read from the database with a single bulk select per table, and stored in NumPy arrays. The junction to road
+section adjacency is stored in compressed sparse row (CSR) format: the road sections of junction j are
+adjacency[adjacency_offsets[j]:adjacency_offsets[j + 1]]. Junctions and road sections are referred to by their index
+in the arrays, the database ids are found in junction_ids and section_ids.
+
+A graph can be attached to a junction class, after which the construction and matching functions traverse the arrays
+of the graph instead of the road_sections relationship of the junctions. NumPy and Shapely are optional dependencies,
+like for local_geometry.py."""
+
+from functools import cached_property, partial  # standard library
+
+try:  # 3rd party packages
+    import numpy as np
+    import shapely
+except ImportError:
+    shapely = None
+from sqlalchemy import func, or_
+
+from dso import session  # local source
+from local_geometry import azimuth
+
+
+class RoadGraph:
+    """Road network of one database, with junction and road section properties stored in arrays."""
+
+    # the arrays that define the graph, see snapshot.py
+    array_names = ['junction_ids', 'junction_xy', 'degree', 'type_k3', 'angle_k3', 'section_ids', 'section_junctions',
+                   'section_stroke', 'coord_offsets', 'coords', 'adjacency_offsets', 'adjacency']
+
+    def __init__(self, junction_ids, junction_xy, degree, type_k3, angle_k3, section_ids, section_junctions,
+                 section_stroke, coord_offsets, coords):
+        """Stores the input arrays and builds the junction to road section adjacency. Missing values are stored as
+        -1 for integer arrays and NaN for float arrays."""
+        self.junction_ids = np.asarray(junction_ids, dtype=np.int64)
+        self.junction_xy = np.asarray(junction_xy, dtype=np.float64).reshape(-1, 2)
+        self.degree = np.asarray(degree, dtype=np.int32)
+        self.type_k3 = np.asarray(type_k3, dtype=np.int8)
+        self.angle_k3 = np.asarray(angle_k3, dtype=np.float64)
+        self.section_ids = np.asarray(section_ids, dtype=np.int64)
+        self.section_junctions = np.asarray(section_junctions, dtype=np.int32).reshape(-1, 2)
+        self.section_stroke = np.asarray(section_stroke, dtype=np.int64)
+        self.coord_offsets = np.asarray(coord_offsets, dtype=np.int64)
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.adjacency_offsets, self.adjacency = self.build_adjacency()
+        self.load_stroke = None
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Creates a graph from a dictionary with the arrays of array_names, such as memory-mapped arrays of a
+        snapshot, without copying them or building the adjacency again."""
+        graph = cls.__new__(cls)
+        for name in cls.array_names:
+            setattr(graph, name, arrays[name])
+        graph.load_stroke = None
+        return graph
+
+    def arrays(self):
+        """Returns the arrays that define the graph, by name."""
+        return {name: getattr(self, name) for name in self.array_names}
+
+    @cached_property
+    def junction_index(self):
+        """Index of each junction id in the junction arrays."""
+        return {junction_id: index for index, junction_id in enumerate(self.junction_ids.tolist())}
+
+    @cached_property
+    def section_index(self):
+        """Index of each road section id in the road section arrays."""
+        return {section_id: index for index, section_id in enumerate(self.section_ids.tolist())}
+
+    @cached_property
+    def angles(self):
+        """Angle of every entry in the adjacency at its junction, see adjacency_angles."""
+        return self.adjacency_angles()
+
+    def attach(self, junction_class, load_stroke):
+        """Sets the graph as the road_graph of the junction class, such that the construction and matching functions
+        traverse the graph. load_stroke returns the stroke object with an id, for the strokes in section_stroke."""
+        self.load_stroke = load_stroke
+        junction_class.road_graph = self
+
+    def junction_sections(self, junction_id):
+        """Returns the indices of the road sections at the junction with the input id, in the order of the
+        road_sections relationship, and their angles at the junction."""
+        junction = self.junction_index[junction_id]
+        start, end = self.adjacency_offsets[junction], self.adjacency_offsets[junction + 1]
+        return self.adjacency[start:end].tolist(), self.angles[start:end].tolist()
+
+    def stroke(self, section):
+        """Returns the stroke object of the road section with the input index, or None if it has no stroke."""
+        stroke_id = int(self.section_stroke[section])
+        return None if stroke_id < 0 else self.load_stroke(stroke_id)
+
+    def set_section_strokes(self, section_ids, stroke_ids):
+        """Sets the stroke ids of the road sections with the input ids."""
+        sections = positions(self.section_ids, section_ids)
+        known = sections >= 0
+        self.section_stroke[sections[known]] = np.asarray(stroke_ids, dtype=np.int64)[known]
+
+    @property
+    def junction_count(self):
+        return len(self.junction_ids)
+
+    @property
+    def section_count(self):
+        return len(self.section_ids)
+
+    def build_adjacency(self):
+        """Builds the CSR adjacency from junctions to road sections. A road section that begins and ends at the same
+        junction is listed once, like in the road_sections relationship of the mapped junction classes."""
+        sections = np.arange(self.section_count, dtype=np.int32)
+        begin, end = self.section_junctions[:, 0], self.section_junctions[:, 1]
+        not_loop = end != begin
+        junctions = np.concatenate([begin, end[not_loop]])
+        incident = np.concatenate([sections, sections[not_loop]])
+        valid = junctions >= 0
+        junctions, incident = junctions[valid], incident[valid]
+
+        order = np.lexsort((incident, junctions))
+        counts = np.bincount(junctions, minlength=self.junction_count)
+        offsets = np.zeros(self.junction_count + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, incident[order]
+
+    def incident_sections(self, junction):
+        """Returns the indices of the road sections that begin or end at the junction."""
+        return self.adjacency[self.adjacency_offsets[junction]:self.adjacency_offsets[junction + 1]]
+
+    def other_junction(self, section, junction):
+        """Determines the junction of the road section that is not equal to the input junction."""
+        begin, end = self.section_junctions[section]
+        assert begin == junction or end == junction
+        if begin == junction:
+            return end
+        else:
+            return begin
+
+    def section_coords(self, section):
+        """Returns the coordinates of a road section as an (n, 2) array."""
+        return self.coords[self.coord_offsets[section]:self.coord_offsets[section + 1]]
+
+    def section_lengths(self):
+        """Calculates the length (in m) of every road section."""
+        segment_lengths = np.hypot(*np.diff(self.coords, axis=0).T)
+        cumulative = np.concatenate([[0], np.cumsum(segment_lengths)])
+        return cumulative[self.coord_offsets[1:] - 1] - cumulative[self.coord_offsets[:-1]]
+
+    def angle_at_junction(self, section, junction):
+        """Calculates the angle of the line segment of the road section at the junction, referenced from the north.
+        Equal to helpers.angle_at_junction."""
+        return float(self.incidence_angles(np.array([section]), np.array([junction]))[0])
+
+    def incidence_angles(self, sections, junctions):
+        """Calculates the angles of the line segments of the input road sections at the input junctions, as arrays.
+        The angle is NaN if the segment has no length. Each angle is calculated with local_geometry.azimuth, because
+        the angles are compared with == to the angles of helpers.angle_at_junction, and np.arctan2 can differ from
+        math.atan2 in the last bit."""
+        first = self.coord_offsets[sections]
+        last = self.coord_offsets[sections + 1] - 1
+        origin = self.junction_xy[junctions]
+        at_begin = np.all(self.coords[first] == origin, axis=1)
+        towards = np.where(at_begin[:, None], self.coords[first + 1], self.coords[last - 1])
+        angles = [azimuth(point_a, point_b) for point_a, point_b in zip(origin.tolist(), towards.tolist())]
+        return np.array([np.nan if angle is None else angle for angle in angles], dtype=np.float64)
+
+    def adjacency_angles(self):
+        """Calculates the angle of every entry in the adjacency at its junction, aligned with the adjacency array."""
+        junctions = np.repeat(np.arange(self.junction_count), np.diff(self.adjacency_offsets))
+        return self.incidence_angles(self.adjacency, junctions)
+
+
+def load_graph(road_section_class, junction_class, junction_filter=None):
+    """Reads the road sections and junctions of one database into a RoadGraph, with one select per table. If a
+    junction_filter is given, only the junctions that satisfy it and their incident road sections are read."""
+    junction_rows = session.query(junction_class.id, func.st_x(junction_class.geom), func.st_y(junction_class.geom),
+                                  junction_class.degree, junction_class.type_k3, junction_class.angle_k3)
+    section_rows = session.query(road_section_class.id, road_section_class.begin_junction_id,
+                                 road_section_class.end_junction_id, road_section_class.delimited_stroke_id,
+                                 func.st_asbinary(road_section_class.geom))
+    if junction_filter is not None:
+        junction_rows = junction_rows.filter(junction_filter)
+        junction_ids = session.query(junction_class.id).filter(junction_filter)
+        section_rows = section_rows.filter(or_(road_section_class.begin_junction_id.in_(junction_ids),
+                                               road_section_class.end_junction_id.in_(junction_ids)))
+    junction_rows = junction_rows.order_by(junction_class.id).all()
+    section_rows = section_rows.order_by(road_section_class.id).all()
+
+    junction_ids = [row[0] for row in junction_rows]
+    junction_xy = [(row[1], row[2]) for row in junction_rows]
+    degree = [row[3] for row in junction_rows]
+    type_k3 = [-1 if row[4] is None else row[4] for row in junction_rows]
+    angle_k3 = [np.nan if row[5] is None else row[5] for row in junction_rows]
+
+    section_ids = [row[0] for row in section_rows]
+    section_junctions = positions(np.asarray(junction_ids, dtype=np.int64),
+                                  [(-1 if row[1] is None else row[1], -1 if row[2] is None else row[2])
+                                   for row in section_rows])
+    section_stroke = [-1 if row[3] is None else row[3] for row in section_rows]
+    coord_offsets, coords = coordinate_arrays([bytes(row[4]) for row in section_rows])
+
+    return RoadGraph(junction_ids, junction_xy, degree, type_k3, angle_k3, section_ids, section_junctions,
+                     section_stroke, coord_offsets, coords)
+
+
+def attach_graph(road_section_class, junction_class, delimited_stroke_class):
+    """Loads the RoadGraph of one database and attaches it to the junction class, such that the construction and
+    matching functions traverse its arrays. The strokes are taken from the session. Returns the graph."""
+    graph = load_graph(road_section_class, junction_class)
+    graph.attach(junction_class, partial(session.get, delimited_stroke_class))
+    return graph
+
+
+def coordinate_arrays(geometries):
+    """Converts a list of line geometries (WKB or Shapely) to the flat coordinate array and the offsets of each line
+    in that array."""
+    geometries = np.array(geometries, dtype=object)
+    if len(geometries) and not isinstance(geometries[0], shapely.Geometry):
+        geometries = shapely.from_wkb(geometries)
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    offsets = np.zeros(len(geometries) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(index, minlength=len(geometries)), out=offsets[1:])
+    return offsets, coords
+
+
+def positions(sorted_ids, ids):
+    """Returns the index of each of the input ids in the array of sorted ids, or -1 for ids that are not in it."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.full(ids.shape, -1, dtype=np.int64)
+    found = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[found] == ids, found, -1)
@@ -2,20 +2,36 @@
 
 from math import pi  # standard library
 
-from sqlalchemy.sql import func  # 3rd party packages
+from geoalchemy2.elements import WKBElement, WKTElement  # 3rd party packages
+from sqlalchemy.sql import func, text
 from sqlalchemy.dialects.postgresql import array
 
-from dso import session, tolerance_distance  # local source
+import dso  # local source
+from dso import session, srid
+import local_geometry
+from metrics import metric_cache
+from instrumentation import timed
 
 
+@timed
 def angle_at_junction(road_section, junction):
-    """Calculates the angle of the line segment of road_section at junction."""
+    """Calculates the angle of the line segment of road_section at junction. The angles at both ends of each road
+    section are cached."""
     assert (road_section.begin_junction == junction or road_section.end_junction == junction)
-    first_point_section = session.query(func.st_startpoint(road_section.geom))[0][0]
-    if session.query(func.st_equals(first_point_section, junction.geom))[0][0]:
-        angle = session.query(func.ST_Azimuth(junction.geom, road_section.geom.ST_PointN(2)))[0][0]
+    metrics = metric_cache.line(road_section)
+    junction_point = metric_cache.point(junction)
+    if metrics.start is not None and junction_point == metrics.start:
+        angle = metrics.start_angle
+    elif metrics.end is not None and junction_point == metrics.end:
+        angle = metrics.end_angle
+    elif local_geometry.enabled():
+        angle = local_geometry.angle_at_junction(road_section.geom, junction.geom)
     else:
-        angle = session.query(func.ST_Azimuth(junction.geom, road_section.geom.ST_PointN(-2)))[0][0]
+        first_point_section = session.query(func.st_startpoint(road_section.geom))[0][0]
+        if session.query(func.st_equals(first_point_section, junction.geom))[0][0]:
+            angle = session.query(func.ST_Azimuth(junction.geom, road_section.geom.ST_PointN(2)))[0][0]
+        else:
+            angle = session.query(func.ST_Azimuth(junction.geom, road_section.geom.ST_PointN(-2)))[0][0]
     assert angle is not None
     return angle
 
@@ -34,27 +50,87 @@ def get_length(list_of_strokes):
     """Calculates the length (in m) of the input array of strokes."""
     length = 0
     for stroke in list_of_strokes:
-        length += session.query(func.st_length(stroke.geom)).first()[0]
+        length += metric_cache.length(stroke)
     return length
 
 
 def length_difference(stroke_a, stroke_b):
-    """Calculates the difference in length between two strokes, normalized with the tolerance distance."""
-    return abs(get_length(stroke_a) - get_length(stroke_b))/tolerance_distance
+    """Calculates the difference in length between two strokes, normalized with the tolerance distance. The tolerance
+    distance is read from the dso package on each call, such that a tolerance sweep can change it."""
+    return abs(get_length(stroke_a) - get_length(stroke_b))/dso.tolerance_distance
+
+
+@timed
+def get_distance(object_a, object_b):
+    """Calculates the distance between two geometries."""
+    assert object_a.geom is not None
+    assert object_b.geom is not None
+    if local_geometry.enabled():
+        return local_geometry.get_distance(object_a.geom, object_b.geom)
+    return session.query(func.st_distance(object_a.geom, object_b.geom))[0][0]
+
+
+def get_hausdorff_distance(geom_a, geom_b):
+    """Calculates the Hausdorff distance between two geometries."""
+    if local_geometry.enabled():
+        return local_geometry.get_hausdorff_distance(geom_a, geom_b)
+    return session.query(func.st_hausdorffdistance(geom_a, geom_b))[0][0]
+
+
+def get_hausdorff_distances_and_areas(geoms_a, geoms_b):
+    """Calculates the Hausdorff distance between each pair of geometries of the two input lists, and the area (see
+    get_area) of each geometry, in one vectorized pass or one query. Returns three lists, with an area of None for a
+    geometry that is not a single line. The query runs in a savepoint, such that a failure does not end the
+    transaction."""
+    if local_geometry.enabled():
+        return local_geometry.get_hausdorff_distances_and_areas(geoms_a, geoms_b)
+    statement = text(
+        'SELECT ST_HausdorffDistance(a, b), '
+        'CASE WHEN ST_NumPoints(a) > 2 THEN ST_Area(ST_MakePolygon(ST_AddPoint(a, ST_StartPoint(a)))) '
+        'WHEN ST_NumPoints(a) IS NOT NULL THEN 0 END, '
+        'CASE WHEN ST_NumPoints(b) > 2 THEN ST_Area(ST_MakePolygon(ST_AddPoint(b, ST_StartPoint(b)))) '
+        'WHEN ST_NumPoints(b) IS NOT NULL THEN 0 END '
+        'FROM (SELECT ST_SetSRID(a::geometry, :srid) AS a, ST_SetSRID(b::geometry, :srid) AS b, position '
+        'FROM unnest(CAST(:geoms_a AS text[]), CAST(:geoms_b AS text[])) WITH ORDINALITY AS pairs(a, b, position)) '
+        'AS geometries ORDER BY position')
+    with session.begin_nested():
+        rows = session.execute(statement, {'srid': srid, 'geoms_a': [geometry_text(geom) for geom in geoms_a],
+                                           'geoms_b': [geometry_text(geom) for geom in geoms_b]}).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]
+
+
+def geometry_text(geom):
+    """Returns the text representation (hexadecimal WKB or WKT) of a geometry, which PostGIS can cast to a geometry."""
+    if isinstance(geom, WKBElement):
+        return geom.desc
+    if isinstance(geom, WKTElement):
+        return geom.data
+    return geom
 
 
 def combine_geom(list_of_strokes):
     """Expects a list of strokes, returns a combined geometry of the strokes in the list."""
     geoms = [stroke.geom for stroke in list_of_strokes]
+    if local_geometry.enabled():
+        return local_geometry.merge(geoms).wkt
     return session.query(func.st_astext(func.st_linemerge(func.st_collect(array(geoms)))))[0][0]
 
 
+def merge_geom(geoms):
+    """Merges the input line geometries to a single line, that can be assigned to the geometry of a stroke."""
+    if local_geometry.enabled():
+        return local_geometry.to_element(local_geometry.merge(geoms))
+    return session.query(func.st_linemerge(func.st_collect(array(geoms))))
+
+
 def get_area(geom):
-    """Calculates the area (in m2) of a plane."""
+    """Calculates the area (in m2) of a plane. Returns None if the geometry is not a single line."""
+    if local_geometry.enabled():
+        return local_geometry.get_area(geom)
     numpoints = session.query(func.st_numpoints(geom))[0][0]
+    if numpoints is None:
+        return None
     if numpoints > 2:
         return session.query(func.st_area(func.st_makepolygon(func.st_addpoint(geom, func.st_startpoint(geom)))))[0][0]
     else:
         return 0
-
-
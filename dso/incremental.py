@@ -0,0 +1,118 @@
+"""Module incremental.py determines which part of an earlier matching result has to be updated after road sections
+changed. After each run, the geometry hash, geometry and delimited stroke of every road section are recorded in a
+table next to the road section table. The next run compares the road sections to this table, and only the strokes,
+junction classifications and matches in the neighbourhood of the changed road sections are constructed and matched
+again. New road sections need to be added to the topology first, with pgr_createTopology(clean := false) and
+pgr_analyzeGraph, such that existing junction ids do not change."""
+
+from sqlalchemy import text  # 3rd party packages
+
+from dso import session  # local source
+
+
+def hash_table_name(road_section_class):
+    """Returns the name of the table with the recorded geometry hashes of a road section table."""
+    return road_section_class.__tablename__ + '_hashes'
+
+
+def record_hashes(road_section_class):
+    """Records the geometry hash, geometry and delimited stroke of each road section for the next incremental run."""
+    hash_table = hash_table_name(road_section_class)
+    session.execute(text('DROP TABLE IF EXISTS ' + hash_table))
+    session.execute(text('CREATE TABLE {} AS SELECT id, md5(ST_AsBinary(geom)) AS geom_hash, geom, '
+                         'delimited_stroke_id FROM {}'.format(hash_table, road_section_class.__tablename__)))
+    session.execute(text('ALTER TABLE {} ADD PRIMARY KEY (id)'.format(hash_table)))
+
+
+def changed_sections(road_section_class):
+    """Returns the ids of the road sections that were added, removed or of which the geometry changed since the hashes
+    were recorded. Returns None if no hashes were recorded."""
+    hash_table = hash_table_name(road_section_class)
+    if session.execute(text('SELECT to_regclass(:table)'), {'table': hash_table}).scalar() is None:
+        return None
+    rows = session.execute(text(
+        'SELECT coalesce(sections.id, hashes.id) FROM {} sections FULL OUTER JOIN {} hashes ON sections.id = hashes.id '
+        'WHERE sections.id IS NULL OR hashes.id IS NULL OR md5(ST_AsBinary(sections.geom)) <> hashes.geom_hash'
+        .format(road_section_class.__tablename__, hash_table)))
+    return sorted(row[0] for row in rows)
+
+
+def changed_geometries(road_section_class, changed_ids):
+    """Returns an SQL fragment that selects the current and recorded geometry and delimited stroke of the changed road
+    sections, used as common table expression named changed."""
+    return ('WITH changed AS (SELECT geom, delimited_stroke_id FROM {0} WHERE id = ANY(:changed_ids) '
+            'UNION ALL SELECT geom, delimited_stroke_id FROM {1} WHERE id = ANY(:changed_ids)) '
+            .format(road_section_class.__tablename__, hash_table_name(road_section_class)))
+
+
+def affected_strokes(road_section_class, delimited_stroke_class, changed_ids, tolerance_distance):
+    """Returns the ids of the strokes that contain a changed road section, or that are within the tolerance distance of
+    the old or new geometry of a changed road section."""
+    if not changed_ids:
+        return []
+    rows = session.execute(text(
+        changed_geometries(road_section_class, changed_ids) +
+        'SELECT DISTINCT strokes.id FROM {} strokes JOIN changed ON strokes.id = changed.delimited_stroke_id '
+        'OR ST_DWithin(strokes.geom, changed.geom, :tolerance_distance)'.format(delimited_stroke_class.__tablename__)),
+        {'changed_ids': changed_ids, 'tolerance_distance': tolerance_distance})
+    return sorted(row[0] for row in rows)
+
+
+def nearby_strokes(road_section_class, delimited_stroke_class, stroke_ids, changed_ids, other_stroke_class,
+                   tolerance_distance):
+    """Returns the ids of the strokes of the other database that are within the tolerance distance of the input
+    strokes, or of the old or new geometry of a changed road section. These strokes could match a changed stroke, or
+    could have matched it before the change, so their matches have to be found again."""
+    if not stroke_ids and not changed_ids:
+        return []
+    rows = session.execute(text(
+        changed_geometries(road_section_class, changed_ids) +
+        ', near AS (SELECT geom FROM changed UNION ALL SELECT geom FROM {} WHERE id = ANY(:stroke_ids)) '
+        'SELECT DISTINCT others.id FROM {} others JOIN near ON ST_DWithin(others.geom, near.geom, :tolerance_distance)'
+        .format(delimited_stroke_class.__tablename__, other_stroke_class.__tablename__)),
+        {'changed_ids': changed_ids, 'stroke_ids': stroke_ids, 'tolerance_distance': tolerance_distance})
+    return sorted(row[0] for row in rows)
+
+
+def affected_junctions(road_section_class, junction_class, changed_ids, tolerance_distance):
+    """Returns the ids of the junctions within the tolerance distance of the old or new geometry of a changed road
+    section. These junctions have to be classified again."""
+    if not changed_ids:
+        return []
+    rows = session.execute(text(
+        changed_geometries(road_section_class, changed_ids) +
+        'SELECT DISTINCT junctions.id FROM {} junctions JOIN changed '
+        'ON ST_DWithin(junctions.the_geom, changed.geom, :tolerance_distance)'.format(junction_class.__tablename__)),
+        {'changed_ids': changed_ids, 'tolerance_distance': tolerance_distance})
+    return sorted(row[0] for row in rows)
+
+
+def affected_matches(delimited_stroke_class, stroke_ids):
+    """Returns the ids of the matches of the input strokes."""
+    if not stroke_ids:
+        return set()
+    rows = session.execute(text('SELECT DISTINCT match_id FROM {} WHERE id = ANY(:stroke_ids) AND match_id IS NOT NULL'
+                                .format(delimited_stroke_class.__tablename__)), {'stroke_ids': stroke_ids})
+    return {row[0] for row in rows}
+
+
+def reset_matches(delimited_stroke_classes, linking_table_class, match_ids):
+    """Removes the matches with the input ids from the strokes and the linking table. Returns, for each stroke class,
+    the ids of the strokes that were part of these matches."""
+    match_ids = sorted(match_ids)
+    stroke_ids = []
+    for delimited_stroke_class in delimited_stroke_classes:
+        rows = session.execute(text('UPDATE {} SET match_id = NULL WHERE match_id = ANY(:match_ids) RETURNING id'
+                                    .format(delimited_stroke_class.__tablename__)), {'match_ids': match_ids})
+        stroke_ids.append(sorted(row[0] for row in rows))
+    session.execute(text('DELETE FROM {} WHERE match_id = ANY(:match_ids)'.format(linking_table_class.__tablename__)),
+                    {'match_ids': match_ids})
+    return stroke_ids
+
+
+def last_match_id(delimited_stroke_classes, linking_table_class):
+    """Returns the largest match id in use, such that new matches get ids that are not in use yet."""
+    tables = [delimited_stroke_class.__tablename__ for delimited_stroke_class in delimited_stroke_classes]
+    tables.append(linking_table_class.__tablename__)
+    return session.execute(text('SELECT max(match_id) FROM (' + ' UNION ALL '.join(
+        'SELECT max(match_id) AS match_id FROM ' + table for table in tables) + ') AS match_ids')).scalar()
@@ -0,0 +1,137 @@
+"""Module instrumentation.py records where the time of a run is spent. The stages of core.py and the functions that are
+called most often are timed, and the SQL statements are counted and timed with SQLAlchemy engine events. The profile
+is written to a JSON or CSV file at the end of the run. Recording is disabled by default, in which case the timed
+functions only check a flag."""
+
+import csv  # standard library
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event  # 3rd party packages
+
+from dso import engine  # local source
+
+
+class Profile:
+    """Wall time and number of calls of stages and functions, and number and time of SQL statements. Times of
+    functions include the time of the timed functions they call."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.functions = {}
+        self.counters = {}
+        self.statements = {}
+        self.statement_start = {}  # thread id -> start times of the running statements
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """Starts recording, including the SQL statements of the engine."""
+        if not self.enabled:
+            event.listen(engine, 'before_cursor_execute', self.before_statement)
+            event.listen(engine, 'after_cursor_execute', self.after_statement)
+            self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            event.remove(engine, 'before_cursor_execute', self.before_statement)
+            event.remove(engine, 'after_cursor_execute', self.after_statement)
+            self.enabled = False
+
+    def before_statement(self, connection, cursor, statement, parameters, context, executemany):
+        self.statement_start.setdefault(threading.get_ident(), []).append(time.perf_counter())
+
+    def after_statement(self, connection, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - self.statement_start[threading.get_ident()].pop()
+        # statements are grouped by their text, such that the same query with other parameters is one entry
+        key = ' '.join(statement.split())[:200]
+        self.add_time(self.statements, key, seconds)
+
+    def add_time(self, records, name, seconds):
+        # statements can be executed by a background thread, see prefetch.py
+        with self.lock:
+            record = records.setdefault(name, [0, 0.0])
+            record[0] += 1
+            record[1] += seconds
+
+    def count(self, name, amount=1):
+        """Adds to a counter, for example the number of processed strokes."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, name):
+        """Times a stage of the run, and the number of SQL statements and processed strokes in it."""
+        if not self.enabled:
+            yield
+            return
+        counters = dict(self.counters)
+        statement_count = self.statement_count()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'statements': 0, 'counters': {}})
+            record['calls'] += 1
+            record['seconds'] += time.perf_counter() - start_time
+            record['statements'] += self.statement_count() - statement_count
+            for key, value in self.counters.items():
+                if value != counters.get(key, 0):
+                    record['counters'][key] = record['counters'].get(key, 0) + value - counters.get(key, 0)
+
+    def statement_count(self):
+        return sum(record[0] for record in self.statements.values())
+
+    def rows(self):
+        """Returns the profile as rows of (kind, name, calls, seconds, details), with functions and statements sorted
+        by time. The details of a stage are the number of statements and the counters, also per second."""
+        rows = []
+        for name, record in self.stages.items():
+            details = {'statements': record['statements']}
+            for key, value in record['counters'].items():
+                details[key] = value
+                if record['seconds'] > 0:
+                    details[key + '_per_second'] = round(value / record['seconds'], 1)
+            rows.append(('stage', name, record['calls'], record['seconds'], details))
+        for kind, records in (('function', self.functions), ('statement', self.statements)):
+            for name, (calls, seconds) in sorted(records.items(), key=lambda item: -item[1][1]):
+                rows.append((kind, name, calls, seconds, {}))
+        for name, value in self.counters.items():
+            rows.append(('counter', name, value, None, {}))
+        return rows
+
+    def dump(self, file_path):
+        """Writes the profile to a CSV file if the extension is .csv, otherwise to a JSON file."""
+        rows = self.rows()
+        if file_path.endswith('.csv'):
+            with open(file_path, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['kind', 'name', 'calls', 'seconds', 'details'])
+                for kind, name, calls, seconds, details in rows:
+                    writer.writerow([kind, name, calls, seconds, json.dumps(details) if details else ''])
+        else:
+            with open(file_path, 'w') as file:
+                json.dump([{'kind': kind, 'name': name, 'calls': calls, 'seconds': seconds, **details}
+                           for kind, name, calls, seconds, details in rows], file, indent=1)
+
+
+def timed(function):
+    """Decorator that records the time and number of calls of a function in the profile, when it is enabled."""
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not profile.enabled:
+            return function(*args, **kwargs)
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.add_time(profile.functions, name, time.perf_counter() - start_time)
+    return wrapper
+
+
+profile = Profile()
@@ -0,0 +1,201 @@
+"""Module local_geometry.py computes the geometric properties used by the matching process in the Python process,
+instead of sending a query to PostGIS for each calculation. The results are equal to the PostGIS functions for
+planar geometries in EPSG:28992. Shapely is an optional dependency, if it is not installed the SQL functions in
+helpers.py are used."""
+
+from math import atan2, pi  # standard library
+
+from geoalchemy2.elements import WKBElement, WKTElement  # 3rd party packages
+from sqlalchemy import func
+
+try:
+    import numpy as np
+    import shapely
+    from shapely import wkb, wkt
+    from shapely.geometry import MultiLineString, Polygon
+    from shapely.geometry.base import BaseGeometry
+    from shapely.ops import linemerge
+    from geoalchemy2.shape import from_shape
+except ImportError:
+    shapely = None
+
+import dso  # local source
+
+
+def enabled():
+    """Returns True if the local geometry engine can and should be used."""
+    return dso.use_local_geometry and shapely is not None
+
+
+def to_shape(geom):
+    """Converts a geometry as it is found on the mapped classes (WKB element, WKT element or WKT string) to a
+    Shapely geometry."""
+    if isinstance(geom, BaseGeometry):
+        return geom
+    if isinstance(geom, WKBElement):
+        return wkb.loads(bytes(geom.data))
+    if isinstance(geom, WKTElement):
+        return wkt.loads(geom.data)
+    if isinstance(geom, str):
+        return wkt.loads(geom)
+    if isinstance(geom, (bytes, memoryview)):
+        return wkb.loads(bytes(geom))
+    raise TypeError('Geometry of type ' + type(geom).__name__ + ' can not be converted to a local geometry')
+
+
+def to_element(shape):
+    """Converts a Shapely geometry to a WKB element that can be assigned to a geometry column."""
+    return from_shape(shape, srid=dso.srid)
+
+
+def to_hex_ewkb(geom):
+    """Converts a geometry to a hexadecimal EWKB string with the SRID of the project, as accepted by COPY."""
+    return shapely.to_wkb(shapely.set_srid(to_shape(geom), dso.srid), hex=True, include_srid=True)
+
+
+def coordinates(geom):
+    """Returns the coordinates of a point or line geometry as a list of (x, y) tuples. Returns None for other
+    geometries, such as a multi-part line, for which ST_PointN and ST_NumPoints return NULL."""
+    shape = to_shape(geom)
+    if shape.geom_type not in ('Point', 'LineString'):
+        return None
+    return list(shape.coords)
+
+
+def line_parts(geom):
+    """Returns the coordinates of each line of a line or multi-part line geometry, as a list of arrays of (x, y)."""
+    return [shapely.get_coordinates(part) for part in shapely.get_parts(to_shape(geom))]
+
+
+def azimuth(point_a, point_b):
+    """Calculates the angle in radians of the segment from point_a to point_b, referenced from the north and
+    clockwise positive, equal to ST_Azimuth. Returns None if the points are equal."""
+    dx = point_b[0] - point_a[0]
+    dy = point_b[1] - point_a[1]
+    if dx == 0 and dy == 0:
+        return None
+    return atan2(dx, dy) % (2 * pi)
+
+
+def angle_at_junction(section_geom, junction_geom):
+    """Calculates the angle of the line segment of section_geom at the junction, see helpers.angle_at_junction.
+    Returns None if section_geom is not a single line, like ST_PointN."""
+    section_coords = coordinates(section_geom)
+    if section_coords is None:
+        return None
+    junction_point = coordinates(junction_geom)[0]
+    if section_coords[0][:2] == junction_point[:2]:
+        return azimuth(junction_point, section_coords[1])
+    return azimuth(junction_point, section_coords[-2])
+
+
+def get_length(geom):
+    """Calculates the length (in m) of a geometry, equal to ST_Length."""
+    return to_shape(geom).length
+
+
+def get_distance(geom_a, geom_b):
+    """Calculates the minimum distance between two geometries, equal to ST_Distance."""
+    return to_shape(geom_a).distance(to_shape(geom_b))
+
+
+def get_hausdorff_distance(geom_a, geom_b):
+    """Calculates the discrete Hausdorff distance between two geometries, equal to ST_HausdorffDistance."""
+    return to_shape(geom_a).hausdorff_distance(to_shape(geom_b))
+
+
+def get_area(geom):
+    """Calculates the area (in m2) of the plane enclosed by a line and the segment between its end points. Returns
+    None if the geometry is not a single line, such as a multi-part line, for which ST_NumPoints is NULL."""
+    line_coords = coordinates(geom)
+    if line_coords is None:
+        return None
+    if len(line_coords) > 2:
+        return Polygon(line_coords + [line_coords[0]]).area
+    else:
+        return 0
+
+
+def get_hausdorff_distances_and_areas(geoms_a, geoms_b):
+    """Vectorized version of get_hausdorff_distance and get_area, for pairs of geometries from two lists. Returns the
+    Hausdorff distances and the areas of the geometries of both lists."""
+    shapes_a = np.array([to_shape(geom) for geom in geoms_a], dtype=object)
+    shapes_b = np.array([to_shape(geom) for geom in geoms_b], dtype=object)
+    return shapely.hausdorff_distance(shapes_a, shapes_b).tolist(), get_areas(shapes_a), get_areas(shapes_b)
+
+
+def get_areas(shapes):
+    """Vectorized version of get_area for an array of Shapely lines."""
+    areas = [0.0 if shape.geom_type == 'LineString' else None for shape in shapes]
+    lines = [index for index, shape in enumerate(shapes) if shape.geom_type == 'LineString'
+             and shapely.get_num_coordinates(shape) > 2]
+    if lines:
+        coords, line_index = shapely.get_coordinates(shapes[lines], return_index=True)
+        rings = shapely.linearrings(coords, indices=line_index)
+        for index, area in zip(lines, shapely.area(shapely.polygons(rings)).tolist()):
+            areas[index] = area
+    return areas
+
+
+def line_coordinates(geom):
+    """Returns the coordinates of a line geometry as an array of (x, y), or None if it is not a single line."""
+    shape = to_shape(geom)
+    if shape.geom_type != 'LineString':
+        return None
+    return shapely.get_coordinates(shape)
+
+
+def join_lines(coordinate_arrays):
+    """Returns the line through the input coordinate arrays, in order."""
+    return shapely.linestrings(np.concatenate(coordinate_arrays))
+
+
+def merge(geoms):
+    """Merges the input line geometries to a single line, equal to ST_LineMerge(ST_Collect(geoms))."""
+    lines = []
+    for geom in geoms:
+        shape = to_shape(geom)
+        if shape.geom_type == 'MultiLineString':
+            lines.extend(shape.geoms)
+        else:
+            lines.append(shape)
+    return linemerge(MultiLineString(lines))
+
+
+def parity_check(session, road_sections, tolerance=1e-6):
+    """Compares the local calculations with PostGIS for the input road sections. Returns a list of
+    (road section id, property, local value, PostGIS value) for each property that differs more than the tolerance."""
+    differences = []
+
+    def compare(section_id, name, local_value, sql_value):
+        if local_value is None or sql_value is None:
+            if local_value is not sql_value:
+                differences.append((section_id, name, local_value, sql_value))
+        elif abs(local_value - sql_value) > tolerance:
+            differences.append((section_id, name, local_value, sql_value))
+
+    for road_section in road_sections:
+        geom = road_section.geom
+        compare(road_section.id, 'length', get_length(geom), session.query(func.st_length(geom))[0][0])
+        # the area of a multi-part line is NULL, like in helpers.get_hausdorff_distances_and_areas
+        numpoints = session.query(func.st_numpoints(geom))[0][0]
+        if numpoints is None:
+            sql_area = None
+        elif numpoints > 2:
+            sql_area = session.query(func.st_area(func.st_makepolygon(func.st_addpoint(
+                geom, func.st_startpoint(geom)))))[0][0]
+        else:
+            sql_area = 0
+        compare(road_section.id, 'area', get_area(geom), sql_area)
+        for junction in (road_section.begin_junction, road_section.end_junction):
+            if junction is None:
+                continue
+            first_point_section = session.query(func.st_startpoint(geom))[0][0]
+            if session.query(func.st_equals(first_point_section, junction.geom))[0][0]:
+                sql_angle = session.query(func.ST_Azimuth(junction.geom, geom.ST_PointN(2)))[0][0]
+            else:
+                sql_angle = session.query(func.ST_Azimuth(junction.geom, geom.ST_PointN(-2)))[0][0]
+            compare(road_section.id, 'angle ' + str(junction.id), angle_at_junction(geom, junction.geom), sql_angle)
+            compare(road_section.id, 'distance ' + str(junction.id), get_distance(geom, junction.geom),
+                    session.query(func.st_distance(geom, junction.geom))[0][0])
+    return differences
@@ -1,12 +1,21 @@
 """Module matching.py contains all functions related to the matching of the delimited strokes"""
 
-from math import pi  # standard library
+from collections import Counter  # standard library
+from math import isnan, pi
+import traceback
 
 from sqlalchemy import func  # 3rd party packages
+from sqlalchemy.orm.util import identity_key
 
-from dso import session, deviation_angle  # local source
-from structure import JunctionTarget, Match
-from helpers import angle_at_junction, angle_difference, get_length
+from dso import session, deviation_angle, topology_tolerance  # local source
+from structure import JunctionTarget, Match, score_matches
+from helpers import angle_at_junction, angle_difference, get_length, get_distance
+from local_geometry import coordinates
+import local_geometry
+from metrics import metric_cache
+from prefilter import near_line, line_within_distance, junctions_within_distance, length_compatible, \
+    azimuth_compatible, passes
+from instrumentation import profile, timed
 
 
 def other_junction(road_section, junction):
@@ -26,107 +35,313 @@ def has_good_continuity(stroke_a, stroke_b, junction):
     return pi-deviation_angle < angle_difference(angle_a, angle_b) < pi+deviation_angle
 
 
-def extend_matching_pair(stroke_ref, stroke_target, junction_ref, junction_target, tolerance_distance):
-    """Extends the input delimited strokes with strokes that have good continuity at input junction,
-    until a good match is found or if no match is possible. Stroke_ref and stroke_target are both lists of delimited
-    strokes."""
-    # create local variables of which stroke to extend and which to compare to when a new stroke is added
-    if get_length(stroke_ref) < get_length(stroke_target):
-        stroke_to_extend = stroke_ref
-        stroke_to_compare = stroke_target
-        junction_to_extend = junction_ref
-        junction_to_compare = junction_target
-    else:
-        stroke_to_extend = stroke_target
-        stroke_to_compare = stroke_ref
-        junction_to_extend = junction_target
-        junction_to_compare = junction_ref
+def junction_strokes(junction):
+    """Returns the delimited stroke of each road section at the junction. If a RoadGraph is attached to the junction
+    class, its arrays are used instead of the road_sections relationship."""
+    graph = type(junction).road_graph
+    if graph is None:
+        return [road_section.delimited_stroke for road_section in junction.road_sections]
+    return [graph.stroke(section) for section in graph.junction_sections(junction.id)[0]]
+
+
+def select_extension(stroke, junction):
+    """Selects the stroke that extends stroke at the junction, see extend_matching_pair. Returns None if there is no
+    such stroke. If a RoadGraph is attached to the junction class, graph_extension is used."""
+    graph = type(junction).road_graph
+    if graph is not None:
+        return graph_extension(graph, stroke, junction)
 
     new_stroke = None
     # if the junction where the next stroke is added is a W-junction (type 1), select the stroke of the outer road
     # sections to be added
-    if junction_to_extend.type_k3 == 1:
-        if angle_at_junction(stroke_to_extend[-1], junction_to_extend) != junction_to_extend.angle_k3:
-            for road_section in junction_to_extend.road_sections:
-                if road_section.delimited_stroke != stroke_to_extend[-1] and junction_to_extend.angle_k3 != \
-                        angle_at_junction(road_section, junction_to_extend):
+    if junction.type_k3 == 1:
+        if angle_at_junction(stroke, junction) != junction.angle_k3:
+            for road_section in junction.road_sections:
+                if road_section.delimited_stroke != stroke and junction.angle_k3 != \
+                        angle_at_junction(road_section, junction):
                     new_stroke = road_section.delimited_stroke
 
     # for other junctions, select the stroke that has good continuity
-    if junction_to_extend.degree > 1:
-        for road_section in junction_to_extend.road_sections:
-            if road_section.delimited_stroke != stroke_to_extend[-1] and has_good_continuity(road_section, stroke_to_extend[-1], junction_to_extend):
+    if junction.degree > 1:
+        for road_section in junction.road_sections:
+            if road_section.delimited_stroke != stroke and has_good_continuity(road_section, stroke, junction):
                 new_stroke = road_section.delimited_stroke
+    return new_stroke
 
-    if new_stroke and (new_stroke.begin_junction == junction_to_extend or new_stroke.end_junction == junction_to_extend):
-        stroke_to_extend.append(new_stroke)
-        junction_to_extend = other_junction(stroke_to_extend[-1], junction_to_extend)
-        point_distance = session.query(func.st_distance(junction_to_extend.geom, junction_to_compare.geom))[0][0]
-        if point_distance < tolerance_distance:
-            return Match(stroke_ref, stroke_target)
-        elif session.query(func.st_distance(junction_to_extend.geom, stroke_to_compare[-1].geom))[0][0] < tolerance_distance or \
-                session.query(func.st_distance(junction_to_compare.geom, stroke_to_extend[-1].geom))[0][0] < tolerance_distance:
-            if stroke_to_extend == stroke_ref:
-                return extend_matching_pair(stroke_ref, stroke_target, junction_to_extend, junction_target, tolerance_distance)
-            elif stroke_to_extend == stroke_target:
-                return extend_matching_pair(stroke_ref, stroke_target, junction_ref, junction_to_extend, tolerance_distance)
-            else:
-                print('Error: wrong stroke')
-    return None
 
+def graph_extension(graph, stroke, junction):
+    """Selects the stroke that extends stroke at the junction like select_extension, with the road sections, their
+    strokes and their angles at the junction taken from the arrays of a RoadGraph."""
+    position = graph.junction_index[junction.id]
+    sections, angles = graph.junction_sections(junction.id)
+    others = [(section, angle) for section, stroke_id, angle in zip(sections, graph.section_stroke[sections].tolist(),
+                                                                    angles) if stroke_id != stroke.id]
+    # an angle that can not be calculated fails like in helpers.angle_at_junction
+    assert not any(isnan(angle) for _, angle in others)
+
+    new_section = None
+    if graph.type_k3[position] == 1:
+        angle_k3 = float(graph.angle_k3[position])
+        if angle_at_junction(stroke, junction) != angle_k3:
+            for section, angle in others:
+                if angle_k3 != angle:
+                    new_section = section
+    if graph.degree[position] > 1:
+        stroke_angle = angle_at_junction(stroke, junction)
+        for section, angle in others:
+            if pi-deviation_angle < angle_difference(angle, stroke_angle) < pi+deviation_angle:
+                new_section = section
+    return None if new_section is None else graph.stroke(new_section)
+
+
+class ExtensionChain:
+    """Running state of one side of a pair of strokes that is extended by extend_matching_pair: the list of strokes,
+    their total length, the junction at which the next stroke is added and, with the local geometry engine, the
+    direction of each stroke in the combined line. Adding a stroke only uses the cached metrics of that stroke, and the
+    coordinates are joined once when a match is found. The combined line is kept while it is equal to the result of
+    combine_geom, that is while each stroke starts at the end of the line and no point is the end of more than two
+    strokes. Otherwise combine_geom is used when the match is scored."""
+
+    def __init__(self, strokes, junction):
+        self.strokes = strokes
+        self.junction = junction
+        self.length = get_length(strokes)
+        self.reversed = None
+        if local_geometry.enabled() and len(strokes) == 1:
+            metrics = metric_cache.line(strokes[0])
+            if metrics.start is not None:
+                # the line is oriented such that it ends at the junction where the next stroke is added
+                reverse = metrics.start == metric_cache.point(junction) and metrics.end != metrics.start
+                self.reversed = [reverse]
+                self.end = metrics.start if reverse else metrics.end
+                self.end_counts = Counter([metrics.start, metrics.end])
+
+    def append(self, stroke):
+        """Adds a stroke at the junction and moves the junction to the other end of the stroke."""
+        self.strokes.append(stroke)
+        self.junction = other_junction(stroke, self.junction)
+        metrics = metric_cache.line(stroke)
+        self.length += metrics.length
+        if self.reversed is None:
+            return
+        if metrics.start is None or self.end not in (metrics.start, metrics.end):
+            self.reversed = None
+            return
+        self.end_counts.update([metrics.start, metrics.end])
+        if self.end_counts[metrics.start] > 2 or self.end_counts[metrics.end] > 2:
+            self.reversed = None
+            return
+        reverse = metrics.start != self.end
+        self.reversed.append(reverse)
+        self.end = metrics.start if reverse else metrics.end
+
+    def geom(self):
+        """Returns the combined line of the strokes, or None if it is not kept."""
+        if self.reversed is None or len(self.strokes) == 1:
+            return None
+        lines = []
+        for stroke, reverse in zip(self.strokes, self.reversed):
+            coords = local_geometry.line_coordinates(stroke.geom)
+            coords = coords[::-1] if reverse else coords
+            lines.append(coords[1:] if lines else coords)
+        return local_geometry.join_lines(lines)
+
+
+def extend_matching_pair(stroke_ref, stroke_target, junction_ref, junction_target, tolerance_distance,
+                         max_extensions=10000):
+    """Extends the input delimited strokes with strokes that have good continuity at input junction,
+    until a good match is found or if no match is possible. Stroke_ref and stroke_target are both lists of delimited
+    strokes. The shorter side is extended one stroke at a time, keeping the lengths and the combined lines of both
+    sides in an ExtensionChain. After max_extensions strokes no match is returned."""
+    chain_ref = ExtensionChain(stroke_ref, junction_ref)
+    chain_target = ExtensionChain(stroke_target, junction_target)
+    for _ in range(max_extensions):
+        # create local variables of which stroke to extend and which to compare to when a new stroke is added
+        if chain_ref.length < chain_target.length:
+            chain_to_extend, chain_to_compare = chain_ref, chain_target
+        else:
+            chain_to_extend, chain_to_compare = chain_target, chain_ref
+        stroke_to_extend = chain_to_extend.strokes
+        junction_to_extend = chain_to_extend.junction
 
-def get_distance(object_a, object_b):
-    """Calculates the distance between two geometries."""
-    assert object_a.geom is not None
-    assert object_b.geom is not None
-    return session.query(func.st_distance(object_a.geom, object_b.geom))[0][0]
+        new_stroke = select_extension(stroke_to_extend[-1], junction_to_extend)
+        if not new_stroke or (new_stroke.begin_junction != junction_to_extend and
+                              new_stroke.end_junction != junction_to_extend):
+            return None
+        chain_to_extend.append(new_stroke)
+        if get_distance(chain_to_extend.junction, chain_to_compare.junction) < tolerance_distance:
+            match = Match(stroke_ref, stroke_target)
+            match.geom_ref = chain_ref.geom()
+            match.geom_target = chain_target.geom()
+            return match
+        if not (get_distance(chain_to_extend.junction, chain_to_compare.strokes[-1]) < tolerance_distance or
+                get_distance(chain_to_compare.junction, chain_to_extend.strokes[-1]) < tolerance_distance):
+            return None
+    profile.count('extension_limit')
+    return None
 
 
-def find_matching_candidates(stroke_ref, tolerance_distance):
+def find_matching_candidates(stroke_ref, tolerance_distance, junction_index=None):
     """Searches a match for stroke_ref. The starting junction of the matched stroke has to be within the
-    tolerance_distance. If the end junction is not within the tolerance_distance, extend_matching_pair is called."""
+    tolerance_distance. If the end junction is not within the tolerance_distance, extend_matching_pair is called.
+    If a junction_index of the target junctions is given, it is used for the junction searches and the distance checks
+    between stroke_ref and target junctions."""
     matches = []
-    junction_candidates = nearby_junctions(stroke_ref.begin_junction, tolerance_distance)
+    junction_candidates = nearby_junctions(stroke_ref.begin_junction, tolerance_distance, junction_index)
     junction_ref = stroke_ref.begin_junction
     junction_ref_other = stroke_ref.end_junction
-    if junction_candidates.count() == 0:
-        junction_candidates = nearby_junctions(stroke_ref.end_junction, tolerance_distance)
+    if not junction_candidates:
+        junction_candidates = nearby_junctions(stroke_ref.end_junction, tolerance_distance, junction_index)
         junction_ref = stroke_ref.end_junction
         junction_ref_other = stroke_ref.begin_junction
-        if junction_candidates.count() == 0:
+        if not junction_candidates:
             # TODO set delimited stroke check true
             return matches
 
+    junctions_near_stroke_ref = None
+    box_distance = tolerance_distance + topology_tolerance
+
     for junction_target in junction_candidates:
-        for section_target in junction_target.road_sections:
-            stroke_target = section_target.delimited_stroke
+        for stroke_target in junction_strokes(junction_target):
             if stroke_ref.match_id != stroke_target.match_id or stroke_ref.match_id is None:
                 match = None
+                profile.count('candidate_pairs')
 
                 if stroke_target.begin_junction == junction_target or stroke_target.end_junction == junction_target:
                     junction_target_other = other_junction(stroke_target, junction_target)
-                    if get_distance(junction_ref_other, junction_target_other) < tolerance_distance:
-                        match = Match([stroke_ref], [stroke_target])
-                    elif get_distance(stroke_ref, junction_target_other) < tolerance_distance or \
-                            get_distance(stroke_target, junction_ref_other) < tolerance_distance:
+                    # each of the checks below needs one of the strokes within the tolerance distance of the other end
+                    # of the other stroke, or of the junction at its own other end, which the topology can place up
+                    # to the topology tolerance from the line
+                    if not passes('bounding_box', near_line(stroke_target, junction_ref_other, box_distance) or
+                                  near_line(stroke_ref, junction_target_other, box_distance)):
+                        continue
+                    if junctions_within_distance(junction_ref_other, junction_target_other, tolerance_distance):
+                        # a direct match passes the length filter here, before it is created
+                        if passes('length', length_compatible([stroke_ref], [stroke_target])) and \
+                                passes('azimuth', azimuth_compatible(stroke_ref, junction_ref, stroke_target,
+                                                                     junction_target)):
+                            matches.append(Match([stroke_ref], [stroke_target]))
+                        continue
+                    elif junction_index is not None:
+                        if junctions_near_stroke_ref is None:
+                            junctions_near_stroke_ref = set().union(*(
+                                junction_index.near_line(part, tolerance_distance)
+                                for part in local_geometry.line_parts(stroke_ref.geom)))
+                        if junction_target_other.id in junctions_near_stroke_ref or \
+                                line_within_distance(stroke_target, junction_ref_other, tolerance_distance):
+                            match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref_other,
+                                                         junction_target_other, tolerance_distance)
+                    elif line_within_distance(stroke_ref, junction_target_other, tolerance_distance) or \
+                            line_within_distance(stroke_target, junction_ref_other, tolerance_distance):
                         match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref_other,
                                                      junction_target_other, tolerance_distance)
                 else:
-                    if get_distance(stroke_target.begin_junction, junction_ref_other) < tolerance_distance:
-                        match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref, stroke_target.end_junction, tolerance_distance)
-                    elif get_distance(stroke_target.end_junction, junction_ref_other) < tolerance_distance:
-                        match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref, stroke_target.begin_junction, tolerance_distance)
+                    if not passes('bounding_box', near_line(stroke_target, junction_ref_other, box_distance)):
+                        continue
+                    if junctions_within_distance(stroke_target.begin_junction, junction_ref_other, tolerance_distance):
+                        match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref,
+                                                     stroke_target.end_junction, tolerance_distance)
+                    elif junctions_within_distance(stroke_target.end_junction, junction_ref_other, tolerance_distance):
+                        match = extend_matching_pair([stroke_ref], [stroke_target], junction_ref,
+                                                     stroke_target.begin_junction, tolerance_distance)
 
-                if match:
+                # an extended match passes the length filter once its strokes are known
+                if match and passes('length', length_compatible(match.strokes_ref, match.strokes_target)):
                     matches.append(match)
     return matches
 
 
-def nearby_junctions(junction_ref, tolerance_distance):
+@timed
+def nearby_junctions(junction_ref, tolerance_distance, junction_index=None):
     """Finds the junctions in the target database that are within the tolerance distance of junction_ref."""
+    if junction_index is not None:
+        x, y = coordinates(junction_ref.geom)[0][:2]
+        junction_ids = junction_index.query_radius(x, y, tolerance_distance).tolist()
+        if junction_index.junctions is not None:
+            return [junction_index.junctions[junction_id] for junction_id in junction_ids]
+        return load_junctions(junction_ids)
     junctions = session.query(JunctionTarget).filter(func.st_dwithin(JunctionTarget.geom, junction_ref.geom,
                                                                      tolerance_distance))
-    return junctions
+    return junctions.all()
+
+
+def nearby_junctions_batch(junctions_ref, tolerance_distance, junction_index):
+    """Finds the nearby target junctions for each of the input reference junctions at once, with the junction_index.
+    Returns a dictionary from reference junction id to the list of nearby target junctions."""
+    points = [coordinates(junction_ref.geom)[0][:2] for junction_ref in junctions_ref]
+    nearby_ids = junction_index.query_batch(points, tolerance_distance)
+    loaded = {junction.id: junction for junction in load_junctions(
+        sorted(set(junction_id for ids in nearby_ids for junction_id in ids.tolist())))}
+    return {junction_ref.id: [loaded[junction_id] for junction_id in ids.tolist()]
+            for junction_ref, ids in zip(junctions_ref, nearby_ids)}
+
+
+def load_junctions(junction_ids):
+    """Returns the target junctions with the input ids. Junctions that are already loaded in the session are taken
+    from the session, the others are loaded with a single query."""
+    junctions = {}
+    missing_ids = []
+    for junction_id in junction_ids:
+        junction = session.identity_map.get(identity_key(JunctionTarget, junction_id))
+        if junction is None:
+            missing_ids.append(junction_id)
+        else:
+            junctions[junction_id] = junction
+    if missing_ids:
+        for junction in session.query(JunctionTarget).filter(JunctionTarget.id.in_(missing_ids)):
+            junctions[junction.id] = junction
+    return [junctions[junction_id] for junction_id in junction_ids if junction_id in junctions]
+
+
+@timed
+def find_best_match(stroke_ref, tolerance_distance, junction_index=None):
+    """Searches the matching candidates of stroke_ref and returns the best one, or None if there is no match."""
+    try:
+        matches = find_matching_candidates(stroke_ref, tolerance_distance, junction_index)
+    except AssertionError as e:
+        print(e)
+        print(traceback.format_exc())
+        print('Something went wrong trying to find a match for stroke', stroke_ref.id)
+        matches = None
+    # TODO add correct Exception, merging looping road sections is not possible
+
+    if matches:
+        score_matches(matches)
+        return select_best_match(matches)
+    return None
+
+
+def select_best_match(matches):
+    """Selects the match with the highest similarity score. Matches with a negative score are not selected, and of
+    matches with an equal score the last one is selected."""
+    best_score = 0
+    best_match = None
+    for match in matches:
+        if match.similarity_score >= best_score:
+            best_match = match
+            best_score = match.similarity_score
+    return best_match
+
+
+def match_exists(match):
+    """Determines if a match still exists, that is if any of its reference strokes still has the id of the match.
+    Matches are overwritten when a stroke is matched again later in the matching process."""
+    return any(stroke_ref.match_id == match.id for stroke_ref in match.strokes_ref)
+
+
+def match_links(match):
+    """Returns the rows of the linking table of a match, one for each pair of a reference and target road section.
+    The road section ids are taken from the delimited strokes stores."""
+    rows = []
+    for stroke_ref in match.strokes_ref:
+        try:
+            for section_ref_id in type(stroke_ref).delimited_strokes[stroke_ref.id]:
+                for stroke_target in match.strokes_target:
+                    for section_target_id in type(stroke_target).delimited_strokes[stroke_target.id]:
+                        rows.append((section_ref_id, section_target_id, match.id, match.similarity_score))
+        except KeyError:
+            print('Stroke', stroke_ref.id, 'not recorded in delimited strokes store')
+    return rows
 
 
 def reset_matches(strokes):
@@ -0,0 +1,184 @@
+"""Module membership.py stores which road sections belong to each delimited stroke, as integer arrays instead of lists
+of mapped road section objects, such that the memory use only depends on the number of road section ids."""
+
+from array import array  # standard library
+
+import numpy as np  # 3rd party packages
+
+
+class StrokeMembership:
+    """Ordered road section ids of each stroke in compressed sparse row form. Compacted strokes are stored in arrays
+    sorted by stroke id, with the road section ids of stroke i in sections[offsets[i]:offsets[i + 1]]. Strokes that
+    are added or changed after the last compaction are appended to a growing buffer, and the buffer is compacted when it
+    holds compact_size strokes. Supports the dictionary operations used by the construction and matching process."""
+    # the arrays of the compacted strokes, see arrays
+    array_names = ['stroke_ids', 'offsets', 'sections']
+
+    def __init__(self, compact_size=100000):
+        self.compact_size = compact_size
+        self.clear()
+
+    def clear(self):
+        """Removes all strokes."""
+        self.stroke_ids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.sections = np.zeros(0, dtype=np.int64)
+        self.valid = np.zeros(0, dtype=bool)
+        self.valid_count = 0
+        self.buffer = array('q')
+        self.rows = {}  # stroke id -> (start, count) in the buffer
+        self.last_stroke_id = None
+
+    def position(self, stroke_id):
+        """Returns the index of a stroke in the compacted arrays, or None if it is not found there."""
+        if not self.valid_count:
+            return None
+        index = int(np.searchsorted(self.stroke_ids, stroke_id))
+        if index < len(self.stroke_ids) and self.stroke_ids[index] == stroke_id and self.valid[index]:
+            return index
+        return None
+
+    def __getitem__(self, stroke_id):
+        """Returns the road section ids of a stroke as a list."""
+        row = self.rows.get(stroke_id)
+        if row is not None:
+            return self.buffer[row[0]:row[0] + row[1]].tolist()
+        index = self.position(stroke_id)
+        if index is None:
+            raise KeyError(stroke_id)
+        return self.sections[self.offsets[index]:self.offsets[index + 1]].tolist()
+
+    def get(self, stroke_id, default=None):
+        try:
+            return self[stroke_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, stroke_id):
+        return stroke_id in self.rows or self.position(stroke_id) is not None
+
+    def __len__(self):
+        return len(self.rows) + self.valid_count
+
+    def __iter__(self):
+        """Iterates over the stroke ids, first the compacted ones in order of id."""
+        for stroke_id in self.stroke_ids[self.valid].tolist():
+            if stroke_id not in self.rows:
+                yield stroke_id
+        yield from list(self.rows)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for stroke_id in self:
+            yield stroke_id, self[stroke_id]
+
+    def __setitem__(self, stroke_id, section_ids):
+        """Sets the road section ids of a stroke, replacing earlier ones."""
+        self.discard(stroke_id)
+        self.rows[stroke_id] = (len(self.buffer), len(section_ids))
+        self.buffer.extend(section_ids)
+        self.last_stroke_id = stroke_id
+        if len(self.rows) >= self.compact_size:
+            self.compact()
+
+    def append(self, stroke_id, section_id):
+        """Adds a road section id at the end of a stroke. This is fast for the stroke that was set last, other strokes
+        are moved to the end of the buffer first."""
+        if stroke_id != self.last_stroke_id:
+            self[stroke_id] = self[stroke_id] + [section_id]
+            return
+        start, count = self.rows[stroke_id]
+        self.buffer.append(section_id)
+        self.rows[stroke_id] = (start, count + 1)
+
+    def discard(self, stroke_id):
+        """Removes a stroke if it exists. The space in the buffer or arrays is reused at the next compaction."""
+        if self.rows.pop(stroke_id, None) is not None:
+            if stroke_id == self.last_stroke_id:
+                self.last_stroke_id = None
+            return True
+        index = self.position(stroke_id)
+        if index is not None:
+            self.valid[index] = False
+            self.valid_count -= 1
+            return True
+        return False
+
+    def pop(self, stroke_id, default=None):
+        section_ids = self.get(stroke_id)
+        if section_ids is None:
+            return default
+        self.discard(stroke_id)
+        return section_ids
+
+    def __delitem__(self, stroke_id):
+        if not self.discard(stroke_id):
+            raise KeyError(stroke_id)
+
+    def compact(self):
+        """Moves the strokes of the buffer to the compacted arrays, and removes the space of removed strokes."""
+        keep = self.valid.copy()
+        for stroke_id in self.rows:
+            index = self.position(stroke_id)
+            if index is not None:
+                keep[index] = False
+        counts = np.diff(self.offsets)
+        kept_ids = self.stroke_ids[keep]
+        kept_sections = self.sections[np.repeat(keep, counts)]
+        kept_counts = counts[keep]
+
+        buffer = np.frombuffer(self.buffer, dtype=np.int64) if len(self.buffer) else np.zeros(0, dtype=np.int64)
+        new_ids = np.fromiter(self.rows.keys(), dtype=np.int64, count=len(self.rows))
+        new_counts = np.fromiter((row[1] for row in self.rows.values()), dtype=np.int64, count=len(self.rows))
+        new_sections = np.concatenate([buffer[start:start + count] for start, count in self.rows.values()]) \
+            if self.rows else np.zeros(0, dtype=np.int64)
+
+        stroke_ids = np.concatenate([kept_ids, new_ids])
+        counts = np.concatenate([kept_counts, new_counts])
+        sections = np.concatenate([kept_sections, new_sections])
+        offsets = np.zeros(len(stroke_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # sort the strokes by id, the section ids of each stroke move from their old to their new offset
+        order = np.argsort(stroke_ids, kind='stable')
+        self.offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(counts[order], out=self.offsets[1:])
+        shift = np.repeat(offsets[:-1][order] - self.offsets[:-1], counts[order])
+        self.stroke_ids = stroke_ids[order]
+        self.sections = sections[np.arange(len(sections)) + shift]
+        self.valid = np.ones(len(order), dtype=bool)
+        self.valid_count = len(order)
+        self.buffer = array('q')
+        self.rows = {}
+        self.last_stroke_id = None
+
+    def arrays(self):
+        """Compacts the strokes and returns the arrays stroke_ids, offsets and sections by name."""
+        self.compact()
+        return {'stroke_ids': self.stroke_ids, 'offsets': self.offsets, 'sections': self.sections}
+
+    def set_arrays(self, arrays):
+        """Replaces the strokes by the arrays returned by arrays, which are not copied. Since changes are written to
+        the buffer and compaction creates new arrays, the arrays can be read-only, such as memory-mapped arrays."""
+        self.clear()
+        self.stroke_ids = arrays['stroke_ids']
+        self.offsets = arrays['offsets']
+        self.sections = arrays['sections']
+        self.valid = np.ones(len(self.stroke_ids), dtype=bool)
+        self.valid_count = len(self.stroke_ids)
+
+    def save(self, file_path):
+        """Writes the strokes to a NumPy .npz file."""
+        np.savez(file_path, **self.arrays())
+
+    def load(self, file_path):
+        """Replaces the strokes by the strokes of a NumPy .npz file written by save."""
+        with np.load(file_path) as data:
+            self.set_arrays({name: data[name] for name in self.array_names})
+
+
+# road section ids of the generated delimited strokes, by stroke id
+delimited_strokes_ref = StrokeMembership()
+delimited_strokes_target = StrokeMembership()
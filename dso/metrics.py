@@ -0,0 +1,110 @@
+"""Module metrics.py contains a cache of derived properties of strokes and road sections, such as the length, the
+angles at both ends and the bounding box, such that they are calculated once per geometry instead of on every use in
+the matching process. Entries are removed when the geometry of a stroke or road section changes."""
+
+from collections import namedtuple  # standard library
+
+from sqlalchemy import func  # 3rd party packages
+
+from dso import session  # local source
+import local_geometry
+
+LineMetrics = namedtuple('LineMetrics', ['length', 'start', 'end', 'start_angle', 'end_angle', 'bounds'])
+
+
+class MetricCache:
+    """Cache of LineMetrics of lines and points of junctions, keyed by mapped class name and id. Counts hits and misses
+    of the line metrics."""
+
+    def __init__(self):
+        self.lines = {}
+        self.points = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(instance):
+        """Returns the key of a mapped instance, or None if the instance has no id yet."""
+        if instance.id is None:
+            return None
+        return type(instance).__name__, instance.id
+
+    def line(self, instance):
+        """Returns the LineMetrics of a stroke or road section."""
+        key = self.key(instance)
+        metrics = self.lines.get(key) if key else None
+        if metrics is not None:
+            self.hits += 1
+            return metrics
+        self.misses += 1
+        metrics = line_metrics(instance.geom)
+        if key:
+            self.lines[key] = metrics
+        return metrics
+
+    def point(self, junction):
+        """Returns the (x, y) coordinates of a junction."""
+        key = self.key(junction)
+        point = self.points.get(key) if key else None
+        if point is None:
+            point = point_coordinates(junction.geom)
+            if key:
+                self.points[key] = point
+        return point
+
+    def length(self, instance):
+        """Returns the length of a stroke or road section."""
+        return self.line(instance).length
+
+    def invalidate(self, instance):
+        """Removes the metrics of a stroke or road section, for example because its geometry has changed."""
+        key = self.key(instance)
+        if key:
+            self.lines.pop(key, None)
+
+    def clear(self):
+        """Removes all entries, used when the strokes are constructed again."""
+        self.lines.clear()
+        self.points.clear()
+
+    def statistics(self):
+        """Returns the number of entries, hits and misses of the cache."""
+        return {'entries': len(self.lines), 'hits': self.hits, 'misses': self.misses}
+
+
+def line_metrics(geom):
+    """Calculates the LineMetrics of a line geometry, locally or with a single query. The points and angles are None
+    if the geometry is not a single line. The bounds are (x_min, y_min, x_max, y_max)."""
+    if local_geometry.enabled():
+        shape = local_geometry.to_shape(geom)
+        if shape.geom_type != 'LineString':
+            return LineMetrics(shape.length, None, None, None, None, shape.bounds)
+        coords = list(shape.coords)
+        start, end = coords[0][:2], coords[-1][:2]
+        return LineMetrics(shape.length, start, end, local_geometry.azimuth(start, coords[1]),
+                           local_geometry.azimuth(end, coords[-2]), shape.bounds)
+
+    start_point, end_point = func.st_startpoint(geom), func.st_endpoint(geom)
+    row = session.query(func.st_length(geom), func.st_x(start_point), func.st_y(start_point), func.st_x(end_point),
+                        func.st_y(end_point), func.st_azimuth(start_point, func.st_pointn(geom, 2)),
+                        func.st_azimuth(end_point, func.st_pointn(geom, -2)), func.st_xmin(geom), func.st_ymin(geom),
+                        func.st_xmax(geom), func.st_ymax(geom))[0]
+    if row[1] is None:
+        return LineMetrics(row[0], None, None, None, None, tuple(row[7:11]))
+    return LineMetrics(row[0], (row[1], row[2]), (row[3], row[4]), row[5], row[6], tuple(row[7:11]))
+
+
+def point_coordinates(geom):
+    """Returns the (x, y) coordinates of a point geometry."""
+    if local_geometry.enabled():
+        return local_geometry.coordinates(geom)[0][:2]
+    row = session.query(func.st_x(geom), func.st_y(geom))[0]
+    return row[0], row[1]
+
+
+def geometry_changed(target, value, oldvalue, initiator):
+    """Attribute event listener that invalidates the metrics of a stroke or road section when its geometry is set."""
+    metric_cache.invalidate(target)
+
+
+metric_cache = MetricCache()
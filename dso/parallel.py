@@ -0,0 +1,130 @@
+"""Module parallel.py runs the matching process in worker processes. The reference strokes are partitioned in square
+tiles, and each worker searches the best matches of the strokes in a tile with its own database connection. The
+results are merged in the main process in order of stroke id, which gives the same matches as the sequential
+matching process."""
+
+import multiprocessing  # standard library
+
+from sqlalchemy import func  # 3rd party packages
+from sqlalchemy.orm.util import identity_key
+
+from dso import session  # local source
+from structure import DelimitedStrokeRef, DelimitedStrokeTarget, RoadSectionTarget, JunctionTarget, Match
+from matching import find_best_match
+from spatial_index import load_junction_index
+from snapshot import open_snapshot
+import local_geometry
+from instrumentation import profile
+
+
+def partition_strokes(level, tile_size, stroke_ids=None):
+    """Partitions the unmatched reference strokes of a level in square tiles, based on the lower left corner of their
+    bounding box. If stroke_ids is given, only these strokes are partitioned. Returns a list of (stroke ids, extent of
+    the strokes) per tile."""
+    rows = session.query(DelimitedStrokeRef.id, func.st_xmin(DelimitedStrokeRef.geom),
+                         func.st_ymin(DelimitedStrokeRef.geom), func.st_xmax(DelimitedStrokeRef.geom),
+                         func.st_ymax(DelimitedStrokeRef.geom))\
+        .filter(DelimitedStrokeRef.level == level, DelimitedStrokeRef.match_id == None)\
+        .order_by(DelimitedStrokeRef.id)
+    if stroke_ids is not None:
+        rows = rows.filter(DelimitedStrokeRef.id.in_(stroke_ids))
+    tiles = {}
+    for stroke_id, x_min, y_min, x_max, y_max in rows:
+        tile = tiles.setdefault((int(x_min // tile_size), int(y_min // tile_size)), ([], [x_min, y_min, x_max, y_max]))
+        tile[0].append(stroke_id)
+        extent = tile[1]
+        extent[:] = [min(extent[0], x_min), min(extent[1], y_min), max(extent[2], x_max), max(extent[3], y_max)]
+    return [tiles[key] for key in sorted(tiles)]
+
+
+def halo(extent, distance):
+    """Returns the extent (x_min, y_min, x_max, y_max) enlarged by the distance on all sides."""
+    return extent[0] - distance, extent[1] - distance, extent[2] + distance, extent[3] + distance
+
+
+def match_tile(level, tolerance_distance, stroke_ids, extent, snapshot=None):
+    """Searches the best match for each of the input reference strokes, without changing the database. Runs in a
+    worker process. The target junctions within the extent plus a halo of tolerance_distance are indexed, or, if the
+    directory of a snapshot is given, the junction index, the graph of the target network and its stroke membership of
+    the level are used, which the workers share. Returns a list of (stroke id, reference stroke ids, target stroke ids,
+    similarity score) of the best matches."""
+    junction_index = None
+    if local_geometry.enabled():
+        if snapshot is not None:
+            target_snapshot = open_snapshot(snapshot)['target']
+            junction_index = target_snapshot.junction_index()
+            target_snapshot.attach_graph(RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget, level)
+        else:
+            junction_index = load_junction_index(JunctionTarget, tolerance_distance,
+                                                 extent=halo(extent, tolerance_distance))
+
+    results = []
+    strokes_ref = session.query(DelimitedStrokeRef).filter(DelimitedStrokeRef.id.in_(stroke_ids))\
+        .order_by(DelimitedStrokeRef.id)
+    for stroke in strokes_ref:
+        best_match = find_best_match(stroke, tolerance_distance, junction_index)
+        if best_match:
+            results.append((stroke.id, [stroke_ref.id for stroke_ref in best_match.strokes_ref],
+                            [stroke_target.id for stroke_target in best_match.strokes_target],
+                            best_match.similarity_score))
+    session.rollback()
+    return results
+
+
+def parallel_matching_process(level, tolerance_distance, workers, tile_size=5000, stroke_ids=None, snapshot=None):
+    """Runs the matching process of a level with a pool of worker processes. The strokes must be committed to the
+    database before, because the workers use their own connection. If the directory of a snapshot is given, the
+    workers use its junction index and target graph.
+
+    The best matches of the workers are applied in order of stroke id, like in the sequential matching process. If a
+    stroke is already part of a match that was applied earlier in this order, its candidates depend on that match, so
+    it is matched again in the main process. Match ids are assigned in the main process."""
+    tiles = partition_strokes(level, tile_size, stroke_ids)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        tile_results = pool.starmap(match_tile, [(level, tolerance_distance, stroke_ids, extent, snapshot)
+                                                 for stroke_ids, extent in tiles])
+    results = sorted((result for tile_result in tile_results for result in tile_result), key=lambda result: result[0])
+    print('Strokes analyzed:', sum(len(stroke_ids) for stroke_ids, extent in tiles), 'in', len(tiles), 'tiles')
+    profile.count('strokes', sum(len(stroke_ids) for stroke_ids, extent in tiles))
+
+    # load the strokes of all matches in batches, such that the matches can be created without a query per stroke
+    strokes_ref = load_objects(DelimitedStrokeRef, {stroke_id for result in results for stroke_id in result[1]})
+    strokes_target = load_objects(DelimitedStrokeTarget, {stroke_id for result in results for stroke_id in result[2]})
+
+    junction_index = None
+    all_matches = []
+    for stroke_id, ref_ids, target_ids, similarity_score in results:
+        stroke = strokes_ref[stroke_id]
+        if stroke.match_id is not None:
+            if junction_index is None and local_geometry.enabled():
+                if snapshot is not None:
+                    junction_index = open_snapshot(snapshot)['target'].junction_index()
+                else:
+                    junction_index = load_junction_index(JunctionTarget, cell_size=tolerance_distance)
+            best_match = find_best_match(stroke, tolerance_distance, junction_index)
+        else:
+            best_match = Match([strokes_ref[ref_id] for ref_id in ref_ids],
+                               [strokes_target[target_id] for target_id in target_ids],
+                               similarity_score=similarity_score)
+        if best_match:
+            best_match.set_stroke_match_id()
+            all_matches.append(best_match)
+    return all_matches
+
+
+def load_objects(mapped_class, ids):
+    """Returns a dictionary with the objects of a mapped class, such as strokes or road sections, with the input ids.
+    Objects that are not loaded in the session yet are loaded in batches."""
+    objects = {}
+    missing_ids = []
+    for object_id in sorted(ids):
+        mapped_object = session.identity_map.get(identity_key(mapped_class, object_id))
+        if mapped_object is None:
+            missing_ids.append(object_id)
+        else:
+            objects[object_id] = mapped_object
+    for start in range(0, len(missing_ids), 10000):
+        for mapped_object in session.query(mapped_class).filter(mapped_class.id.in_(missing_ids[start:start + 10000])):
+            objects[mapped_object.id] = mapped_object
+    return objects
@@ -0,0 +1,227 @@
+"""Module prefetch.py runs the matching process as a pipeline. A background thread loads the next batch of reference
+strokes, their junctions, the target junctions within the tolerance distance and the road sections and strokes at
+these junctions, with its own database connection and a few set-based queries per batch. Meanwhile the main thread
+matches the strokes of the current batch. The loaded rows are added to the session of the main thread as persistent
+objects, so the matching process finds them in the identity map instead of loading them one by one, and the time of a
+batch is bounded by the slower of loading and matching instead of their sum."""
+
+import queue  # standard library
+import threading
+import time
+
+from sqlalchemy import func, or_  # 3rd party packages
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from dso import Session, session  # local source
+from structure import RoadSectionRef, JunctionRef, RoadSectionTarget, JunctionTarget, DelimitedStrokeRef, \
+    DelimitedStrokeTarget
+from matching import find_best_match
+from metrics import metric_cache, line_metrics
+from spatial_index import load_junction_index
+import local_geometry
+from instrumentation import profile
+
+
+def column_keys(mapped_class):
+    """Returns the attribute names of the columns of a mapped class."""
+    return [attribute.key for attribute in mapped_class.__mapper__.column_attrs]
+
+
+def query_rows(prefetch_session, mapped_class, ids):
+    """Returns the column values of the objects of a mapped class with the input ids, as a list of dictionaries."""
+    keys = column_keys(mapped_class)
+    ids = sorted(ids)
+    rows = []
+    for start in range(0, len(ids), 10000):
+        rows += [dict(zip(keys, row)) for row in prefetch_session.query(*[getattr(mapped_class, key) for key in keys])
+                 .filter(mapped_class.id.in_(ids[start:start + 10000]))]
+    return rows
+
+
+def query_sections_at(prefetch_session, road_section_class, junction_ids):
+    """Returns the column values of all road sections that begin or end at the input junctions."""
+    keys = column_keys(road_section_class)
+    junction_ids = sorted(junction_ids)
+    rows = {}
+    for start in range(0, len(junction_ids), 10000):
+        chunk = junction_ids[start:start + 10000]
+        for row in prefetch_session.query(*[getattr(road_section_class, key) for key in keys])\
+                .filter(or_(road_section_class.begin_junction_id.in_(chunk),
+                            road_section_class.end_junction_id.in_(chunk))):
+            rows[row[0]] = dict(zip(keys, row))
+    return list(rows.values())
+
+
+def query_nearby_junction_ids(prefetch_session, junction_ids, tolerance_distance):
+    """Returns the ids of the target junctions within the tolerance distance of the input reference junctions."""
+    junction_ids = sorted(junction_ids)
+    nearby_ids = set()
+    for start in range(0, len(junction_ids), 10000):
+        nearby_ids.update(row[0] for row in prefetch_session.query(JunctionTarget.id)
+                          .join(JunctionRef, func.st_dwithin(JunctionTarget.geom, JunctionRef.geom, tolerance_distance))
+                          .filter(JunctionRef.id.in_(junction_ids[start:start + 10000])).distinct())
+    return nearby_ids
+
+
+class Batch:
+    """Rows of the objects needed to match a batch of reference strokes, loaded by the background thread. The rows are
+    stored per mapped class, and the junctions of which all road sections are loaded are listed separately. With the
+    local geometry engine, the line metrics of the strokes are calculated as well."""
+
+    def __init__(self, stroke_ids):
+        self.stroke_ids = stroke_ids
+        self.rows = {}
+        self.complete_junction_ids = {JunctionRef: set(), JunctionTarget: set()}
+        self.line_metrics = {}
+
+    def load(self, prefetch_session, tolerance_distance):
+        """Queries the rows of the batch."""
+        strokes_ref = query_rows(prefetch_session, DelimitedStrokeRef, self.stroke_ids)
+        junction_ref_ids = {row[key] for row in strokes_ref for key in ('begin_junction_id', 'end_junction_id')}
+        sections_ref = query_sections_at(prefetch_session, RoadSectionRef, junction_ref_ids)
+
+        junction_target_ids = query_nearby_junction_ids(prefetch_session, junction_ref_ids, tolerance_distance)
+        sections_target = query_sections_at(prefetch_session, RoadSectionTarget, junction_target_ids)
+        strokes_target = query_rows(prefetch_session, DelimitedStrokeTarget,
+                                    {row['delimited_stroke_id'] for row in sections_target
+                                     if row['delimited_stroke_id'] is not None})
+        # the other junctions of the target strokes are used in the distance checks
+        other_junction_ids = {row[key] for row in strokes_target for key in ('begin_junction_id', 'end_junction_id')}
+
+        self.rows = {DelimitedStrokeRef: strokes_ref, RoadSectionRef: sections_ref,
+                     JunctionRef: query_rows(prefetch_session, JunctionRef, junction_ref_ids),
+                     JunctionTarget: query_rows(prefetch_session, JunctionTarget,
+                                                junction_target_ids | other_junction_ids),
+                     RoadSectionTarget: sections_target, DelimitedStrokeTarget: strokes_target}
+        self.complete_junction_ids = {JunctionRef: junction_ref_ids, JunctionTarget: junction_target_ids}
+        if local_geometry.enabled():
+            for mapped_class in (DelimitedStrokeRef, DelimitedStrokeTarget):
+                for row in self.rows[mapped_class]:
+                    self.line_metrics[mapped_class.__name__, row['id']] = line_metrics(row['geom'])
+        prefetch_session.rollback()
+
+    def install(self):
+        """Adds the objects of the batch to the session of the main thread as persistent objects, without a query.
+        Objects that are already in the session are kept as they are, such that changes made by the matching process,
+        like match ids, are not overwritten. Returns the objects of the batch by mapped class and id, which keeps them
+        in the session while the batch is matched."""
+        objects = {}
+        new_junctions = []
+        for mapped_class in (JunctionRef, JunctionTarget, RoadSectionRef, RoadSectionTarget, DelimitedStrokeRef,
+                             DelimitedStrokeTarget):
+            objects[mapped_class] = {}
+            for row in self.rows[mapped_class]:
+                mapped_object = session.identity_map.get(identity_key(mapped_class, row['id']))
+                if mapped_object is None:
+                    mapped_object = mapped_class(**row)
+                    make_transient_to_detached(mapped_object)
+                    session.add(mapped_object)
+                    if mapped_class in self.complete_junction_ids and \
+                            row['id'] in self.complete_junction_ids[mapped_class]:
+                        new_junctions.append(mapped_object)
+                objects[mapped_class][row['id']] = mapped_object
+
+        # the road sections of the new junctions are set, since all road sections at these junctions are loaded
+        road_sections = {JunctionRef: {}, JunctionTarget: {}}
+        for junction_class, road_section_class in ((JunctionRef, RoadSectionRef), (JunctionTarget, RoadSectionTarget)):
+            for road_section in objects[road_section_class].values():
+                for junction_id in {road_section.begin_junction_id, road_section.end_junction_id}:
+                    road_sections[junction_class].setdefault(junction_id, []).append(road_section)
+        for junction in new_junctions:
+            set_committed_value(junction, 'road_sections', road_sections[type(junction)].get(junction.id, []))
+
+        for key, metrics in self.line_metrics.items():
+            metric_cache.lines.setdefault(key, metrics)
+        return objects
+
+
+class Prefetcher:
+    """Background thread that loads the batches of reference stroke ids in order, at most depth batches ahead of the
+    main thread. Iterating over the prefetcher returns the loaded batches. An error in the background thread is raised
+    in the main thread."""
+
+    def __init__(self, batches, tolerance_distance, depth=2):
+        self.batches = batches
+        self.tolerance_distance = tolerance_distance
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stopped.set()
+        # the thread may wait for room in the queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+    def run(self):
+        # a session can not be shared between threads, so the thread has its own session and connection
+        prefetch_session = Session()
+        try:
+            for stroke_ids in self.batches:
+                if self.stopped.is_set():
+                    return
+                batch = Batch(stroke_ids)
+                batch.load(prefetch_session, self.tolerance_distance)
+                self.queue.put(batch)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+        finally:
+            prefetch_session.close()
+
+    def __iter__(self):
+        while True:
+            start_time = time.perf_counter()
+            batch = self.queue.get()
+            if profile.enabled:
+                profile.add_time(profile.functions, 'Prefetcher.wait', time.perf_counter() - start_time)
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+
+def prefetch_matching_process(level, tolerance_distance, stroke_ids=None, junction_index=None, batch_size=1000,
+                              depth=2):
+    """Searches for a match for each unmatched reference stroke of the level, like core.matching_process, while the
+    objects of the next batches of batch_size strokes are loaded in the background. The strokes are processed in order
+    of id, which gives the same matches as core.matching_process. The background thread only sees committed data, so
+    the strokes must be committed to the database before. If stroke_ids is given, only these strokes are matched."""
+    strokes_ref = session.query(DelimitedStrokeRef.id).filter(DelimitedStrokeRef.level == level,
+                                                              DelimitedStrokeRef.match_id == None)\
+        .order_by(DelimitedStrokeRef.id)
+    if stroke_ids is not None:
+        strokes_ref = strokes_ref.filter(DelimitedStrokeRef.id.in_(stroke_ids))
+    all_stroke_ids = [row[0] for row in strokes_ref]
+    if junction_index is None and local_geometry.enabled():
+        junction_index = load_junction_index(JunctionTarget, cell_size=tolerance_distance)
+
+    count = 0
+    all_matches = []
+    batches = [all_stroke_ids[start:start + batch_size] for start in range(0, len(all_stroke_ids), batch_size)]
+    with Prefetcher(batches, tolerance_distance, depth) as prefetcher:
+        for batch in prefetcher:
+            # the objects are referenced until the batch is matched, the session only keeps weak references
+            objects = batch.install()
+            for stroke_id in batch.stroke_ids:
+                best_match = find_best_match(objects[DelimitedStrokeRef][stroke_id], tolerance_distance,
+                                             junction_index)
+                if best_match:
+                    best_match.set_stroke_match_id()
+                    all_matches.append(best_match)
+            count += len(batch.stroke_ids)
+            profile.count('strokes', len(batch.stroke_ids))
+            print('Strokes analyzed:', count)
+
+    return all_matches
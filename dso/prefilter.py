@@ -0,0 +1,63 @@
+"""Module prefilter.py contains cheap tests that remove pairs of strokes from the matching candidates before the exact
+distance checks and the similarity score are calculated. The tests are applied in layers: the bounding boxes expanded
+by the tolerance distance, the difference in length and, optionally, the directions of the strokes at their junctions.
+The first two layers only remove pairs that could not give a selected match, so they do not change the result. The
+number of candidate pairs and the pairs removed by each layer are counted in the profile."""
+
+import dso  # local source
+from dso import deviation_angle
+from helpers import angle_at_junction, angle_difference, get_distance, length_difference
+from metrics import metric_cache
+from structure import similarity_score
+from instrumentation import profile
+
+
+def near_line(line, junction, tolerance_distance):
+    """Returns False if the junction is outside the bounding box of the stroke or road section expanded by the
+    tolerance distance, in which case their distance is more than the tolerance distance."""
+    x_min, y_min, x_max, y_max = metric_cache.line(line).bounds
+    x, y = metric_cache.point(junction)
+    return x_min - tolerance_distance <= x <= x_max + tolerance_distance and \
+        y_min - tolerance_distance <= y <= y_max + tolerance_distance
+
+
+def near_junction(junction_a, junction_b, tolerance_distance):
+    """Returns False if the junctions are more than the tolerance distance apart in x or y."""
+    x_a, y_a = metric_cache.point(junction_a)
+    x_b, y_b = metric_cache.point(junction_b)
+    return abs(x_a - x_b) <= tolerance_distance and abs(y_a - y_b) <= tolerance_distance
+
+
+def line_within_distance(line, junction, tolerance_distance):
+    """Determines if the distance between a stroke and a junction is smaller than the tolerance distance. The
+    distance is only calculated if the junction is near the bounding box of the stroke."""
+    return near_line(line, junction, tolerance_distance) and get_distance(line, junction) < tolerance_distance
+
+
+def junctions_within_distance(junction_a, junction_b, tolerance_distance):
+    """Determines if the distance between two junctions is smaller than the tolerance distance. The distance is only
+    calculated if the junctions are near each other in x and y."""
+    return near_junction(junction_a, junction_b, tolerance_distance) and \
+        get_distance(junction_a, junction_b) < tolerance_distance
+
+
+def length_compatible(strokes_ref, strokes_target):
+    """Returns False if the difference in length of the lists of strokes alone gives a negative similarity score. The
+    other terms of the score are at most their weight, so the match would not be selected."""
+    return similarity_score(length_difference(strokes_ref, strokes_target), 0, 0) >= 0
+
+
+def azimuth_compatible(stroke_ref, junction_ref, stroke_target, junction_target):
+    """Returns False if the strokes leave their junctions in directions that differ more than the deviation angle.
+    Always True if the azimuth filter is not used, since this test can remove matches that would be selected."""
+    if not dso.use_azimuth_filter:
+        return True
+    return angle_difference(angle_at_junction(stroke_ref, junction_ref),
+                            angle_at_junction(stroke_target, junction_target)) <= deviation_angle
+
+
+def passes(layer, result):
+    """Counts a candidate pair that is removed by a layer, and returns the result of the test of the layer."""
+    if not result:
+        profile.count('removed_by_' + layer)
+    return result
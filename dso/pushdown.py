@@ -0,0 +1,224 @@
+"""Module pushdown.py generates the matching candidates of the reference strokes with one set-based query per batch of
+strokes, instead of the junction searches and distance checks of find_matching_candidates for each stroke. The query
+joins the end junctions of the reference strokes to the target junctions within the tolerance distance, using the
+GiST indexes of the junction tables, and to the target strokes of the road sections at these junctions. The distance
+checks of find_matching_candidates are done in the query, which classifies each candidate pair as a direct match or
+as a pair that has to be extended. Only the extensions and the length and azimuth filters run in Python.
+parity_check compares the best matches of the query candidates with those of find_best_match on a database."""
+
+import traceback  # standard library
+
+from sqlalchemy import text  # 3rd party packages
+
+import dso  # local source
+from dso import session
+from structure import RoadSectionTarget, JunctionRef, JunctionTarget, DelimitedStrokeRef, DelimitedStrokeTarget, \
+    Match, score_matches
+from matching import extend_matching_pair, select_best_match, find_best_match
+from parallel import load_objects
+from prefilter import length_compatible, azimuth_compatible, passes
+from instrumentation import profile, timed
+
+# The start junction of a reference stroke is its begin junction if there are target junctions near it, otherwise its
+# end junction. A target stroke that ends at the target junction is a direct match if its other end is near the other
+# end of the reference stroke, and is extended if one of the strokes passes near the other end of the other stroke.
+# A target stroke that passes through the target junction is extended if one of its ends is near the other end of the
+# reference stroke. The junction columns are the junctions from which the pair is extended, or for a direct match the
+# junctions at which the pair starts, at which the azimuth filter compares the directions of the strokes.
+candidate_sql = '''
+WITH ref AS (
+    SELECT id, geom, begin_junction_id, end_junction_id FROM {strokes_ref} WHERE id = ANY(:stroke_ids)
+), ends AS (
+    SELECT ref.id AS stroke_ref_id, side.junction_ref_id, side.junction_ref_other_id,
+           junction_target.id AS junction_target_id, rank() OVER (PARTITION BY ref.id ORDER BY side.side) AS side_rank
+    FROM ref
+    CROSS JOIN LATERAL (VALUES (0, ref.begin_junction_id, ref.end_junction_id),
+                               (1, ref.end_junction_id, ref.begin_junction_id))
+        AS side (side, junction_ref_id, junction_ref_other_id)
+    JOIN {junctions_ref} junction_ref ON junction_ref.id = side.junction_ref_id
+    JOIN {junctions_target} junction_target
+        ON ST_DWithin(junction_target.the_geom, junction_ref.the_geom, :tolerance_distance)
+), pairs AS (
+    SELECT ends.*, sections.id AS section_target_id, strokes.id AS stroke_target_id,
+           ends.junction_target_id IN (strokes.begin_junction_id, strokes.end_junction_id) AS ends_at_junction,
+           strokes.begin_junction_id AS target_begin_id, strokes.end_junction_id AS target_end_id,
+           CASE WHEN strokes.begin_junction_id = ends.junction_target_id THEN strokes.end_junction_id
+                ELSE strokes.begin_junction_id END AS target_other_id
+    FROM ends
+    JOIN {sections_target} sections
+        ON sections.begin_junction_id = ends.junction_target_id OR sections.end_junction_id = ends.junction_target_id
+    JOIN {strokes_target} strokes ON strokes.id = sections.delimited_stroke_id
+    WHERE ends.side_rank = 1
+), candidates AS (
+    SELECT pairs.stroke_ref_id, pairs.stroke_target_id, pairs.junction_ref_id AS start_junction_id,
+           pairs.junction_target_id AS near_junction_id, pairs.section_target_id,
+           CASE WHEN pairs.ends_at_junction THEN
+                    CASE WHEN ST_Distance(ref_other.the_geom, target_other.the_geom) < :tolerance_distance THEN 'match'
+                         WHEN ST_Distance(ref.geom, target_other.the_geom) < :tolerance_distance
+                              OR ST_Distance(strokes.geom, ref_other.the_geom) < :tolerance_distance THEN 'extend'
+                    END
+                WHEN ST_Distance(target_begin.the_geom, ref_other.the_geom) < :tolerance_distance
+                     OR ST_Distance(target_end.the_geom, ref_other.the_geom) < :tolerance_distance THEN 'extend'
+           END AS kind,
+           CASE WHEN pairs.ends_at_junction THEN pairs.junction_ref_other_id
+                ELSE pairs.junction_ref_id END AS junction_ref_id,
+           CASE WHEN pairs.ends_at_junction THEN pairs.target_other_id
+                WHEN ST_Distance(target_begin.the_geom, ref_other.the_geom) < :tolerance_distance
+                    THEN pairs.target_end_id
+                ELSE pairs.target_begin_id END AS junction_target_id
+    FROM pairs
+    JOIN ref ON ref.id = pairs.stroke_ref_id
+    JOIN {strokes_target} strokes ON strokes.id = pairs.stroke_target_id
+    JOIN {junctions_ref} ref_other ON ref_other.id = pairs.junction_ref_other_id
+    JOIN {junctions_target} target_other ON target_other.id = pairs.target_other_id
+    JOIN {junctions_target} target_begin ON target_begin.id = pairs.target_begin_id
+    JOIN {junctions_target} target_end ON target_end.id = pairs.target_end_id
+)
+SELECT stroke_ref_id, stroke_target_id, kind,
+       CASE WHEN kind = 'match' THEN start_junction_id ELSE junction_ref_id END,
+       CASE WHEN kind = 'match' THEN near_junction_id ELSE junction_target_id END
+FROM candidates
+WHERE kind IS NOT NULL
+ORDER BY stroke_ref_id, near_junction_id, section_target_id
+'''
+
+
+def candidate_rows(stroke_ids, tolerance_distance, partition_size=10000):
+    """Yields the candidate pairs of the input reference strokes as rows of (reference stroke id, target stroke id,
+    kind, reference junction id, target junction id), ordered by reference stroke id. The kind is 'match' for a direct
+    match, with the junctions at which it starts, and 'extend' for a pair that is extended from the two junctions. The
+    rows are read with a server-side cursor, in lists of partition_size rows."""
+    sql = candidate_sql.format(strokes_ref=DelimitedStrokeRef.__tablename__, junctions_ref=JunctionRef.__tablename__,
+                               junctions_target=JunctionTarget.__tablename__,
+                               sections_target=RoadSectionTarget.__tablename__,
+                               strokes_target=DelimitedStrokeTarget.__tablename__)
+    result = session.execute(text(sql), {'stroke_ids': stroke_ids, 'tolerance_distance': tolerance_distance},
+                             execution_options={'stream_results': True})
+    yield from result.partitions(partition_size)
+
+
+def stroke_candidates(partitions):
+    """Groups candidate rows that are ordered by reference stroke id by stroke. Yields, for each list of rows, a list
+    of (reference stroke id, candidate rows) of the strokes of which all rows are read. The rows of the last stroke of
+    a list are kept until the rows of the next stroke are found."""
+    stroke_id, rows = None, []
+    for partition in partitions:
+        strokes = []
+        for row in partition:
+            if row[0] != stroke_id:
+                if rows:
+                    strokes.append((stroke_id, rows))
+                stroke_id, rows = row[0], []
+            rows.append(row)
+        if strokes:
+            yield strokes
+    if rows:
+        yield [(stroke_id, rows)]
+
+
+@timed
+def best_candidate(stroke_ref, candidates, strokes_target, junctions, tolerance_distance):
+    """Creates the matches of the candidate rows of stroke_ref, extending the pairs that need it, and returns the best
+    one, or None if there is no match. The candidates pass the filters of find_matching_candidates: target strokes that
+    already have the match of stroke_ref are skipped, direct matches that differ too much in length or, with the
+    azimuth filter, in direction are not created, and extended matches that differ too much in length are not
+    scored."""
+    matches = []
+    try:
+        for _, stroke_target_id, kind, junction_ref_id, junction_target_id in candidates:
+            stroke_target = strokes_target[stroke_target_id]
+            if stroke_ref.match_id == stroke_target.match_id and stroke_ref.match_id is not None:
+                continue
+            if kind == 'match':
+                if passes('length', length_compatible([stroke_ref], [stroke_target])) and \
+                        passes('azimuth', azimuth_compatible(stroke_ref, junctions[JunctionRef][junction_ref_id],
+                                                             stroke_target,
+                                                             junctions[JunctionTarget][junction_target_id])):
+                    matches.append(Match([stroke_ref], [stroke_target]))
+            else:
+                match = extend_matching_pair([stroke_ref], [stroke_target], junctions[JunctionRef][junction_ref_id],
+                                             junctions[JunctionTarget][junction_target_id], tolerance_distance)
+                if match and passes('length', length_compatible(match.strokes_ref, match.strokes_target)):
+                    matches.append(match)
+    except AssertionError as e:
+        print(e)
+        print(traceback.format_exc())
+        print('Something went wrong trying to find a match for stroke', stroke_ref.id)
+        matches = None
+
+    if matches:
+        score_matches(matches)
+        return select_best_match(matches)
+    return None
+
+
+def pushdown_matching_process(level, tolerance_distance, stroke_ids=None, batch_size=10000):
+    """Searches for a match for each unmatched reference stroke of the level, like core.matching_process, with the
+    candidates of each batch of batch_size strokes generated by one query. The strokes are processed in order of id.
+    The candidate rows are streamed, and the strokes of each part are matched before the next part is read. If
+    stroke_ids is given, only these strokes are matched."""
+    all_stroke_ids = unmatched_strokes(level, stroke_ids)
+    count = 0
+    all_matches = []
+    for start in range(0, len(all_stroke_ids), batch_size):
+        batch = all_stroke_ids[start:start + batch_size]
+        strokes = load_objects(DelimitedStrokeRef, batch)
+        for _, best_match in best_candidates(strokes, batch, tolerance_distance):
+            if best_match:
+                best_match.set_stroke_match_id()
+                all_matches.append(best_match)
+        count += len(batch)
+        profile.count('strokes', len(batch))
+        print('Strokes analyzed:', count)
+
+    return all_matches
+
+
+def unmatched_strokes(level, stroke_ids=None):
+    """Returns the ids of the unmatched reference strokes of the level, or of those in stroke_ids, in order of id."""
+    strokes_ref = session.query(DelimitedStrokeRef.id).filter(DelimitedStrokeRef.level == level,
+                                                              DelimitedStrokeRef.match_id == None)\
+        .order_by(DelimitedStrokeRef.id)
+    if stroke_ids is not None:
+        strokes_ref = strokes_ref.filter(DelimitedStrokeRef.id.in_(stroke_ids))
+    return [row[0] for row in strokes_ref]
+
+
+def best_candidates(strokes, stroke_ids, tolerance_distance):
+    """Yields (reference stroke id, best match or None) for the input strokes that have candidates, from the candidates
+    of one query. Strokes is a dictionary from id to the reference strokes of stroke_ids."""
+    for candidates in stroke_candidates(candidate_rows(stroke_ids, tolerance_distance)):
+        rows = [row for _, stroke_rows in candidates for row in stroke_rows]
+        profile.count('candidates', len(rows))
+        strokes_target = load_objects(DelimitedStrokeTarget, {row[1] for row in rows})
+        # the junctions of direct matches are only used by the azimuth filter
+        rows_with_junctions = [row for row in rows if row[2] == 'extend' or dso.use_azimuth_filter]
+        junctions = {JunctionRef: load_objects(JunctionRef, {row[3] for row in rows_with_junctions}),
+                     JunctionTarget: load_objects(JunctionTarget, {row[4] for row in rows_with_junctions})}
+
+        for stroke_id, stroke_rows in candidates:
+            yield stroke_id, best_candidate(strokes[stroke_id], stroke_rows, strokes_target, junctions,
+                                            tolerance_distance)
+
+
+def parity_check(level, tolerance_distance, stroke_ids=None, junction_index=None):
+    """Compares the best match of each unmatched reference stroke of the level from the candidates of candidate_sql
+    with the best match of find_best_match, without setting the match ids. Returns a list of (reference stroke id,
+    query match, Python match) for each stroke of which the matches differ, with a match as its reference stroke ids,
+    target stroke ids and rounded score, or None."""
+    def key(match):
+        if match is None:
+            return None
+        return ([stroke.id for stroke in match.strokes_ref], [stroke.id for stroke in match.strokes_target],
+                round(match.similarity_score, 9))
+
+    all_stroke_ids = unmatched_strokes(level, stroke_ids)
+    strokes = load_objects(DelimitedStrokeRef, all_stroke_ids)
+    query_matches = {stroke_id: key(match) for stroke_id, match in
+                     best_candidates(strokes, all_stroke_ids, tolerance_distance)}
+    differences = []
+    for stroke_id in all_stroke_ids:
+        python_match = key(find_best_match(strokes[stroke_id], tolerance_distance, junction_index))
+        if query_matches.get(stroke_id) != python_match:
+            differences.append((stroke_id, query_matches.get(stroke_id), python_match))
+    return differences
@@ -0,0 +1,174 @@
+"""Module snapshot.py writes the preprocessed state of both networks to a directory of flat NumPy arrays, and opens it
+again as memory-mapped arrays. The state is the RoadGraph of each network (junction coordinates and classifications,
+road section endpoints and coordinates), the spatial index of the junctions and the stroke membership: the road
+section ids of each stroke, in the arrays of a StrokeMembership. The membership is written for each level of the
+matching, after the stage that constructs the strokes of the level. Runs that start after the preprocessing attach the
+graphs of the snapshot to the junction classes, set the stroke of each road section and the delimited strokes stores
+from the membership and use the junction index of the target network, instead of reading them from the database.
+
+The snapshot covers part of the state: the stroke rows, with their geometries and match ids, are read from the
+database when a stroke is used, since the match ids change in every matching stage. If the number of strokes in the
+database differs from the membership of the level, the stroke of each road section is read from the database instead.
+Opening a snapshot reads no data until it is used, and processes that open the same snapshot share its pages in the
+page cache instead of each holding a copy."""
+
+import json  # standard library
+import os
+from functools import partial
+
+import numpy as np  # 3rd party packages
+from sqlalchemy import func
+
+from dso import session  # local source
+from structure import RoadSectionRef, JunctionRef, RoadSectionTarget, JunctionTarget, DelimitedStrokeRef, \
+    DelimitedStrokeTarget
+from membership import StrokeMembership
+from graph import RoadGraph, load_graph, positions
+from spatial_index import JunctionIndex, graph_junction_index
+
+format_version = 3
+networks = {'ref': (RoadSectionRef, JunctionRef, DelimitedStrokeRef),
+            'target': (RoadSectionTarget, JunctionTarget, DelimitedStrokeTarget)}
+
+
+class NetworkSnapshot:
+    """Preprocessed state of one network, opened from a snapshot. The arrays are stored by name in the dictionaries
+    graph_arrays and index_arrays, and the membership arrays of each level in the dictionary memberships, by level."""
+
+    def __init__(self, graph_arrays, index_arrays, cell_size, memberships=None):
+        self.graph_arrays = graph_arrays
+        self.index_arrays = index_arrays
+        self.cell_size = cell_size
+        self.memberships = memberships or {}
+
+    def graph(self):
+        """Returns the RoadGraph of the network."""
+        return RoadGraph.from_arrays(self.graph_arrays)
+
+    def junction_index(self):
+        """Returns the JunctionIndex of the junctions of the network, with the cell size of the snapshot."""
+        return JunctionIndex.from_arrays(self.index_arrays, self.cell_size)
+
+    def attach_graph(self, road_section_class, junction_class, delimited_stroke_class, level=None,
+                     delimited_strokes=None):
+        """Attaches the RoadGraph of the network to the junction class, like graph.attach_graph. The stroke of each
+        road section is set from the membership of the level, if the snapshot has it and it has as many strokes as
+        the database, or else read from the database, into an array in memory. The other arrays stay memory-mapped.
+        If the membership is used and a delimited strokes store is given, the store is set to the memory-mapped
+        membership. Returns True if the membership of the snapshot is used."""
+        graph = self.graph()
+        membership = self.memberships.get(level)
+        use_membership = membership is not None and \
+            len(membership['stroke_ids']) == session.query(func.count(delimited_stroke_class.id)).scalar()
+        if use_membership:
+            graph.section_stroke = section_strokes(graph.section_ids, membership)
+            if delimited_strokes is not None:
+                delimited_strokes.set_arrays(membership)
+        else:
+            graph.section_stroke = np.full(graph.section_count, -1, dtype=np.int64)
+            rows = session.query(road_section_class.id, road_section_class.delimited_stroke_id)\
+                .filter(road_section_class.delimited_stroke_id != None).all()
+            graph.set_section_strokes([row[0] for row in rows], [row[1] for row in rows])
+        graph.attach(junction_class, partial(session.get, delimited_stroke_class))
+        return use_membership
+
+
+def section_strokes(section_ids, membership):
+    """Returns the stroke id of each of the road section ids, or -1 for road sections without a stroke, from the
+    arrays of a StrokeMembership."""
+    stroke_of_sections = np.full(len(section_ids), -1, dtype=np.int64)
+    # the road sections of stroke i are sections[offsets[i]:offsets[i + 1]]
+    sections = positions(section_ids, membership['sections'])
+    stroke_ids = np.repeat(membership['stroke_ids'], np.diff(membership['offsets']))
+    stroke_of_sections[sections[sections >= 0]] = stroke_ids[sections >= 0]
+    return stroke_of_sections
+
+
+def write_snapshot(directory, graphs, cell_size):
+    """Writes a snapshot from a dictionary with the RoadGraph of 'ref' and 'target'. The arrays are written as .npy
+    files, and the manifest snapshot.json is written last, so an interrupted write leaves no snapshot that can be
+    opened."""
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, 'snapshot.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manifest = {'version': format_version, 'cell_size': cell_size, 'networks': {}}
+    for name, graph in graphs.items():
+        arrays = {'graph': graph.arrays(), 'index': graph_junction_index(graph, cell_size).arrays()}
+        manifest['networks'][name] = {'junctions': len(graph.junction_ids), 'road_sections': len(graph.section_ids)}
+        for group, group_arrays in arrays.items():
+            for array_name, array in group_arrays.items():
+                np.save(os.path.join(directory, '{}_{}_{}.npy'.format(name, group, array_name)), np.asarray(array))
+    write_manifest(directory, manifest)
+
+
+def write_membership(directory, level, memberships):
+    """Adds the stroke membership of a level to a snapshot, from a dictionary with the StrokeMembership of 'ref' and
+    'target', replacing the membership of the level written before. The manifest is written after the arrays."""
+    manifest = read_manifest(directory)
+    manifest.setdefault('memberships', {}).pop(str(level), None)
+    write_manifest(directory, manifest)
+    for name, delimited_strokes in memberships.items():
+        for array_name, array in delimited_strokes.arrays().items():
+            np.save(os.path.join(directory, '{}_membership{}_{}.npy'.format(name, level, array_name)), array)
+    manifest['memberships'][str(level)] = {name: len(delimited_strokes)
+                                           for name, delimited_strokes in memberships.items()}
+    write_manifest(directory, manifest)
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, 'snapshot.json')) as file:
+        return json.load(file)
+
+
+def write_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, 'snapshot.json')
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def save_snapshot(directory, cell_size, memberships):
+    """Writes a snapshot of the preprocessed networks in the database, with one select per table, and the stroke
+    membership of level 1 from a dictionary with the StrokeMembership of 'ref' and 'target'."""
+    write_snapshot(directory, {name: load_graph(road_section_class, junction_class)
+                               for name, (road_section_class, junction_class, _) in networks.items()}, cell_size)
+    write_membership(directory, 1, memberships)
+
+
+def snapshot_exists(directory):
+    return os.path.exists(os.path.join(directory, 'snapshot.json'))
+
+
+def open_snapshot(directory, mmap_mode='r'):
+    """Opens a snapshot written by write_snapshot. The arrays are memory-mapped read-only by default, use mmap_mode
+    'c' for arrays that can be changed in memory without changing the files. Returns a dictionary with a
+    NetworkSnapshot for 'ref' and 'target'."""
+    manifest = read_manifest(directory)
+    assert manifest['version'] == format_version, 'Snapshot ' + directory + ' has an unsupported format'
+
+    def load(name, group, array_names):
+        return {array_name: np.load(os.path.join(directory, '{}_{}_{}.npy'.format(name, group, array_name)),
+                                    mmap_mode=mmap_mode)
+                for array_name in array_names}
+
+    return {name: NetworkSnapshot(load(name, 'graph', RoadGraph.array_names),
+                                  load(name, 'index', JunctionIndex.array_names), manifest['cell_size'],
+                                  {int(level): load(name, 'membership' + level, StrokeMembership.array_names)
+                                   for level in manifest.get('memberships', {})})
+            for name in manifest['networks']}
+
+
+def matches_database(directory):
+    """Determines if the snapshot has the current format and the numbers of junctions and road sections in the
+    snapshot are equal to those in the database, as a cheap check that the networks did not change after the snapshot
+    was written."""
+    manifest = read_manifest(directory)
+    if manifest.get('version') != format_version:
+        return False
+    for name, (road_section_class, junction_class, _) in networks.items():
+        counts = manifest['networks'].get(name, {})
+        if counts.get('junctions') != session.query(func.count(junction_class.id)).scalar() or \
+                counts.get('road_sections') != session.query(func.count(road_section_class.id)).scalar():
+            return False
+    return True
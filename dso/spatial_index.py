@@ -0,0 +1,158 @@
+"""Module spatial_index.py contains an in-memory spatial index over junctions. It is built once per run and replaces the
+ST_DWithin query per delimited stroke in the search for nearby junctions."""
+
+from functools import cached_property  # standard library
+
+import numpy as np  # 3rd party packages
+from sqlalchemy import func
+
+from dso import session, srid  # local source
+
+
+class JunctionIndex:
+    """Uniform grid over junction points. With a cell size equal to the tolerance distance, a radius query only has
+    to look at the 3x3 cells around the query point. If a dictionary of junction objects by id is given, the junctions
+    are taken from it instead of the session."""
+
+    # the arrays that define the index, see snapshot.py
+    array_names = ['ids', 'xy', 'order', 'keys', 'starts', 'ends']
+
+    def __init__(self, ids, xy, cell_size, junctions=None):
+        self.junctions = junctions
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+
+        keys = self.cell_keys(np.floor(self.xy / self.cell_size).astype(np.int64))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.ends = self.starts + counts
+
+    @classmethod
+    def from_arrays(cls, arrays, cell_size, junctions=None):
+        """Creates an index from a dictionary with the arrays of array_names, such as memory-mapped arrays of a
+        snapshot, without copying them or sorting the junctions again."""
+        index = cls.__new__(cls)
+        index.junctions = junctions
+        index.cell_size = float(cell_size)
+        for name in cls.array_names:
+            setattr(index, name, arrays[name])
+        return index
+
+    def arrays(self):
+        """Returns the arrays that define the index, by name."""
+        return {name: getattr(self, name) for name in self.array_names}
+
+    @cached_property
+    def position(self):
+        """Index of each junction id in the arrays."""
+        return {junction_id: index for index, junction_id in enumerate(self.ids.tolist())}
+
+    @cached_property
+    def cells(self):
+        """Start and end in the order array of the junctions of each grid cell, by cell key."""
+        return dict(zip(self.keys.tolist(), zip(self.starts.tolist(), self.ends.tolist())))
+
+    @staticmethod
+    def cell_keys(cells):
+        """Encodes (column, row) grid cells as a single integer."""
+        return ((cells[..., 0] + 2 ** 30) << 32) | (cells[..., 1] + 2 ** 30)
+
+    def candidates(self, cells_min, cells_max):
+        """Returns, for each rectangle of grid cells, the indices of the junctions inside it. Output is a pair of
+        arrays: the rectangle each candidate belongs to and the junction index."""
+        spans = cells_max - cells_min + 1
+        rectangles = np.repeat(np.arange(len(cells_min)), spans[:, 0] * spans[:, 1])
+        first = np.cumsum(spans[:, 0] * spans[:, 1]) - spans[:, 0] * spans[:, 1]
+        step = np.arange(len(rectangles)) - first[rectangles]
+        cells = cells_min[rectangles] + np.stack([step // spans[rectangles, 1], step % spans[rectangles, 1]], axis=1)
+
+        keys = self.cell_keys(cells)
+        found = np.searchsorted(self.keys, keys)
+        found_valid = found < len(self.keys)
+        hit = np.zeros(len(keys), dtype=bool)
+        hit[found_valid] = self.keys[found[found_valid]] == keys[found_valid]
+        rectangles, found = rectangles[hit], found[hit]
+
+        starts, ends = self.starts[found], self.ends[found]
+        counts = ends - starts
+        owners = np.repeat(rectangles, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return owners, self.order[np.repeat(starts, counts) + offsets]
+
+    def query_batch(self, points, radius):
+        """Finds the junctions within radius (distance <= radius, like ST_DWithin) of each input point. Returns a list
+        with an array of junction ids per point."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        cells_min = np.floor((points - radius) / self.cell_size).astype(np.int64)
+        cells_max = np.floor((points + radius) / self.cell_size).astype(np.int64)
+        owners, junctions = self.candidates(cells_min, cells_max)
+
+        distances = np.hypot(*(self.xy[junctions] - points[owners]).T)
+        within = distances <= radius
+        owners, junctions = owners[within], junctions[within]
+        order = np.lexsort((self.ids[junctions], owners))
+        owners, junctions = owners[order], junctions[order]
+        splits = np.searchsorted(owners, np.arange(1, len(points)))
+        return [self.ids[part] for part in np.split(junctions, splits)]
+
+    def query_radius(self, x, y, radius):
+        """Finds the ids of the junctions within radius of the point (x, y), ordered by id."""
+        column_min, column_max = int(np.floor((x - radius) / self.cell_size)), int(np.floor((x + radius) / self.cell_size))
+        row_min, row_max = int(np.floor((y - radius) / self.cell_size)), int(np.floor((y + radius) / self.cell_size))
+        parts = []
+        for column in range(column_min, column_max + 1):
+            for row in range(row_min, row_max + 1):
+                cell = self.cells.get(((column + 2 ** 30) << 32) | (row + 2 ** 30))
+                if cell:
+                    parts.append(self.order[cell[0]:cell[1]])
+        if not parts:
+            return self.ids[:0]
+        junctions = np.concatenate(parts)
+        delta = self.xy[junctions] - (x, y)
+        return np.sort(self.ids[junctions[np.hypot(delta[:, 0], delta[:, 1]) <= radius]])
+
+    def near_line(self, coords, radius):
+        """Finds the ids of the junctions at a distance smaller than radius from the line through coords."""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        cells_min = np.floor((coords.min(axis=0) - radius) / self.cell_size).astype(np.int64)
+        cells_max = np.floor((coords.max(axis=0) + radius) / self.cell_size).astype(np.int64)
+        junctions = self.candidates(cells_min[None], cells_max[None])[1]
+        if len(junctions) == 0:
+            return set()
+        distances = point_line_distances(self.xy[junctions], coords)
+        return set(self.ids[junctions[distances < radius]].tolist())
+
+    def coordinates(self, junction_id):
+        """Returns the coordinates of the junction with the input id."""
+        return self.xy[self.position[junction_id]]
+
+
+def point_line_distances(points, coords):
+    """Calculates the distance of each point to the line through coords."""
+    if len(coords) == 1:
+        return np.hypot(*(points - coords[0]).T)
+    start, end = coords[:-1], coords[1:]
+    segment = end - start
+    squared_length = (segment ** 2).sum(axis=1)
+    relative = points[:, None, :] - start[None, :, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip((relative * segment[None]).sum(axis=2) / squared_length[None], 0, 1)
+    t = np.nan_to_num(t)
+    nearest = start[None] + t[..., None] * segment[None]
+    return np.hypot(*(points[:, None, :] - nearest).transpose(2, 0, 1)).min(axis=1)
+
+
+def load_junction_index(junction_class, cell_size, extent=None):
+    """Builds a JunctionIndex over all junctions of the input class, or only the junctions within the extent
+    (x_min, y_min, x_max, y_max), with a single select."""
+    rows = session.query(junction_class.id, func.st_x(junction_class.geom), func.st_y(junction_class.geom))
+    if extent is not None:
+        rows = rows.filter(junction_class.geom.intersects(func.st_makeenvelope(*extent, srid)))
+    rows = rows.all()
+    return JunctionIndex([row[0] for row in rows], [(row[1], row[2]) for row in rows], cell_size)
+
+
+def graph_junction_index(graph, cell_size):
+    """Builds a JunctionIndex over the junctions of a RoadGraph."""
+    return JunctionIndex(graph.junction_ids, graph.junction_xy, cell_size)
@@ -5,11 +5,17 @@ import itertools  # standard library
 
 from sqlalchemy.ext.declarative import declarative_base  # 3rd party packages
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, ForeignKey, Integer, Float, func
+from sqlalchemy import event
+from sqlalchemy import Column, ForeignKey, Integer, Float
+from sqlalchemy.exc import DBAPIError
 from geoalchemy2 import Geometry
 
-from dso import session, tolerance_area_normalized, tolerance_hausdorff, tolerance_length  # local source
-from helpers import length_difference, combine_geom, get_area, get_length
+import dso  # local source
+from membership import delimited_strokes_ref, delimited_strokes_target
+from helpers import length_difference, combine_geom, get_area, get_length, get_hausdorff_distance, \
+    get_hausdorff_distances_and_areas
+from metrics import geometry_changed
+from instrumentation import timed
 
 
 Base = declarative_base()
@@ -45,6 +51,8 @@ class JunctionRef(Base):
     degree = Column('cnt', Integer)
     type_k3 = Column(Integer)
     angle_k3 = Column(Float)
+    # the RoadGraph traversed instead of road_sections, see graph.RoadGraph.attach
+    road_graph = None
 
 
 class RoadSectionTarget(Base):
@@ -71,6 +79,8 @@ class JunctionTarget(Base):
     degree = Column('cnt', Integer)
     type_k3 = Column(Integer)
     angle_k3 = Column(Float)
+    # the RoadGraph traversed instead of road_sections, see graph.RoadGraph.attach
+    road_graph = None
 
 
 class DelimitedStrokeRef(Base):
@@ -83,6 +93,9 @@ class DelimitedStrokeRef(Base):
     end_junction_id = Column(Integer, ForeignKey(table_ref + junction_table + '.id'))
     match_id = Column(Integer)
     length = None
+    delimited_strokes = delimited_strokes_ref  # road section ids of each stroke, by stroke id
+    road_section_class = RoadSectionRef
+    junction_class = JunctionRef
 
     begin_junction = relationship("JunctionRef", foreign_keys=[begin_junction_id])
     end_junction = relationship("JunctionRef", foreign_keys=[end_junction_id])
@@ -97,6 +110,9 @@ class DelimitedStrokeTarget(Base):
     begin_junction_id = Column(Integer, ForeignKey(table_target + junction_table + '.id'))
     end_junction_id = Column(Integer, ForeignKey(table_target + junction_table + '.id'))
     match_id = Column(Integer)
+    delimited_strokes = delimited_strokes_target  # road section ids of each stroke, by stroke id
+    road_section_class = RoadSectionTarget
+    junction_class = JunctionTarget
 
     begin_junction = relationship("JunctionTarget", foreign_keys=[begin_junction_id])
     end_junction = relationship("JunctionTarget", foreign_keys=[end_junction_id])
@@ -112,36 +128,56 @@ class LinkingTable(Base):
     similarity_score = Column(Float)
 
 
+# cached metrics of strokes and road sections are invalidated when their geometry changes
+for mapped_class in (RoadSectionRef, RoadSectionTarget, DelimitedStrokeRef, DelimitedStrokeTarget):
+    event.listen(mapped_class.geom, 'set', geometry_changed)
+
+
 class Match:
-    """Local class used to save information related to a match of strokes."""
+    """Local class used to save information related to a match of strokes. The similarity score is calculated when it
+    is first used, or for many matches at once with score_matches."""
     id_iter = itertools.count()  # generates incremental ID
 
-    def __init__(self, ref, target):
-        """Set properties of the match according to input strokes."""
+    def __init__(self, ref, target, similarity_score=None):
+        """Set properties of the match according to input strokes. If the similarity_score is given, for example
+        when it is calculated by another process, it is not calculated again."""
         self.id = next(self.id_iter)
         self.strokes_ref = ref
         self.strokes_target = target
         self.geom_ref = None
         self.geom_target = None
-        self.set_combined_geom()
-        self.similarity_score = 0
-        if self.geom_ref is not None and self.geom_target is not None:
-            try:
-                self.similarity_score = self.set_similarity_score()
-            except TypeError as e:
-                print(e)
-                print('Could not calculate score for match', self.id)
+        self._similarity_score = similarity_score
+
+    @property
+    def similarity_score(self):
+        if self._similarity_score is None:
+            self.set_combined_geom()
+            self._similarity_score = 0
+            if self.geom_ref is not None and self.geom_target is not None:
+                try:
+                    self._similarity_score = self.set_similarity_score()
+                except TypeError as e:
+                    print(e)
+                    print('Could not calculate score for match', self.id)
+        return self._similarity_score
+
+    @similarity_score.setter
+    def similarity_score(self, score):
+        self._similarity_score = score
 
     def set_combined_geom(self):
-        """Combines the geometries of the strokes in the match, such that geometric properties can be calculated."""
-        if len(self.strokes_ref) > 1:
-            self.geom_ref = combine_geom(self.strokes_ref)
-        else:
-            self.geom_ref = self.strokes_ref[0].geom
-        if len(self.strokes_target) > 1:
-            self.geom_target = combine_geom(self.strokes_target)
-        else:
-            self.geom_target = self.strokes_target[0].geom
+        """Combines the geometries of the strokes in the match, such that geometric properties can be calculated. A
+        combined geometry that is already set, for example by extend_matching_pair, is kept."""
+        if self.geom_ref is None:
+            if len(self.strokes_ref) > 1:
+                self.geom_ref = combine_geom(self.strokes_ref)
+            else:
+                self.geom_ref = self.strokes_ref[0].geom
+        if self.geom_target is None:
+            if len(self.strokes_target) > 1:
+                self.geom_target = combine_geom(self.strokes_target)
+            else:
+                self.geom_target = self.strokes_target[0].geom
 
     def set_stroke_match_id(self):
         for stroke in self.strokes_ref:
@@ -150,25 +186,86 @@ class Match:
             stroke.match_id = self.id
 
     def set_area_difference(self):
-        """Calculates the difference in areas between the reference and target strokes."""
-        return abs(get_area(self.geom_ref) - get_area(self.geom_target))
-
+        """Calculates the difference in areas between the reference and target strokes. Returns None if the area of
+        one of the combined geometries can not be calculated."""
+        area_ref = get_area(self.geom_ref)
+        area_target = get_area(self.geom_target)
+        if area_ref is None or area_target is None:
+            return None
+        return abs(area_ref - area_target)
+
+    @timed
     def set_similarity_score(self):
         """Calculates the similarity score of the match. It is a weighted sum of scaled attributes, which are
         difference in length, difference in distance (hausdorff distance) and difference in area."""
         length_diff = length_difference(self.strokes_ref, self.strokes_target)
-        hausdorff = session.query(func.st_hausdorffdistance(self.geom_ref, self.geom_target))[0][0]
+        hausdorff = get_hausdorff_distance(self.geom_ref, self.geom_target)
         area_diff = self.set_area_difference()
+        if hausdorff is None or area_diff is None:
+            # like in match_metrics, a match with a geometry that is not a single line gets a score of 0
+            print('Could not calculate score for match', self.id)
+            return 0
         area_diff_normalized = area_diff/get_length(self.strokes_ref)
-
-        weights = [0.5, 0.35, 0.15]  # sum equal to 1
-        metrics = [length_diff/tolerance_length, hausdorff/tolerance_hausdorff, area_diff_normalized/tolerance_area_normalized]
-        score = 0
-
-        for index, metric in enumerate(metrics):
-            score += weights[index] * (1 - metric)
-
-        return score
-
-
-
+        return similarity_score(length_diff, hausdorff, area_diff_normalized)
+
+
+def similarity_score(length_diff, hausdorff, area_diff_normalized):
+    """Calculates the similarity score from the difference in length, the hausdorff distance and the normalized
+    difference in area of a match. The tolerances are read from the dso package on each call, such that a tolerance
+    sweep can change them."""
+    weights = [0.5, 0.35, 0.15]  # sum equal to 1
+    metrics = [length_diff/dso.tolerance_length, hausdorff/dso.tolerance_hausdorff,
+               area_diff_normalized/dso.tolerance_area_normalized]
+    score = 0
+
+    for index, metric in enumerate(metrics):
+        score += weights[index] * (1 - metric)
+
+    return score
+
+
+def match_metrics(matches):
+    """Calculates the difference in length, the Hausdorff distance and the normalized difference in area of all input
+    matches at once. The Hausdorff distances and areas are calculated in a single vectorized pass or a single query.
+    Returns a list with a tuple of the three metrics per match, or None for a match that can not be scored, like a
+    match with a geometry that is not a single line. If the query of a batch fails, the matches are scored one by one,
+    such that only the matches that can not be scored get None."""
+    metrics = [None] * len(matches)
+    combined = []
+    for index, match in enumerate(matches):
+        match.set_combined_geom()
+        if match.geom_ref is not None and match.geom_target is not None:
+            combined.append(index)
+    if not combined:
+        return metrics
+
+    try:
+        hausdorff_distances, areas_ref, areas_target = get_hausdorff_distances_and_areas(
+            [matches[index].geom_ref for index in combined], [matches[index].geom_target for index in combined])
+    except DBAPIError as e:
+        if len(matches) == 1:
+            print(e)
+            print('Could not calculate score for match', matches[0].id)
+            return metrics
+        return [match_metrics([match])[0] for match in matches]
+    for index, hausdorff, area_ref, area_target in zip(combined, hausdorff_distances, areas_ref, areas_target):
+        match = matches[index]
+        if hausdorff is None or area_ref is None or area_target is None:
+            print('Could not calculate score for match', match.id)
+            continue
+        try:
+            length_diff = length_difference(match.strokes_ref, match.strokes_target)
+            area_diff_normalized = abs(area_ref - area_target)/get_length(match.strokes_ref)
+            metrics[index] = length_diff, hausdorff, area_diff_normalized
+        except TypeError as e:
+            print(e)
+            print('Could not calculate score for match', match.id)
+    return metrics
+
+
+@timed
+def score_matches(matches):
+    """Calculates the similarity score of all input matches that are not scored yet at once, see match_metrics."""
+    unscored = [match for match in matches if match._similarity_score is None]
+    for match, metrics in zip(unscored, match_metrics(unscored)):
+        match.similarity_score = 0 if metrics is None else similarity_score(*metrics)
@@ -0,0 +1,216 @@
+"""Module sweep.py runs the matching process on files for a grid of tolerance settings, with one preprocessing of the
+networks. The candidates of the strokes of level 1 depend on the tolerance distance, which decides at which junction
+the search starts and which pairs are extended, so they are generated once for each tolerance distance in the grid, in
+the same way as in a full run with that distance. The length filter is the only part of the search that depends on
+the length tolerance, so the candidates are generated without it and filtered again for each setting. The Hausdorff
+distance and difference in area of a candidate do not depend on the tolerances, so they are calculated once for all
+settings. For each setting the difference in length, which is normalized with the tolerance distance, is calculated
+from the cached lengths of the strokes, the candidates are scored again, and the matches are selected in order of
+stroke id like matching.find_best_match does.
+
+The strokes of level 2 depend on the matches of level 1, so they are constructed and matched for each setting, after
+which the networks are restored. A sweep of n settings with d different tolerance distances therefore costs one
+preprocessing, d candidate searches of level 1, the Hausdorff distances and areas of the distinct candidates, and for
+each setting the scoring and selection of level 1 and a complete construction and matching of level 2. A linking
+table is written for each setting, and a summary with a row per setting.
+
+The deviation angle can not be part of the grid, because it changes the classification of the junctions and the
+continuity of the strokes, so it needs its own preprocessing."""
+
+import csv  # standard library
+import itertools
+import json
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from math import inf
+
+import dso  # local source
+from structure import Match, match_metrics, similarity_score
+from helpers import length_difference
+from prefilter import length_compatible, passes
+from matching import find_matching_candidates, select_best_match, match_exists, match_links
+from bulk import LinkWriter
+import files
+import local_geometry
+from metrics import metric_cache
+from instrumentation import profile
+
+tolerance_names = ['tolerance_distance', 'tolerance_length', 'tolerance_hausdorff', 'tolerance_area_normalized']
+
+Candidate = namedtuple('Candidate', ['strokes_ref', 'strokes_target', 'metrics'])
+
+
+def read_grid(file_path):
+    """Reads the tolerance settings of a sweep from a JSON file with a list of objects. Tolerances that are not given
+    in a setting keep their value of the dso package."""
+    with open(file_path) as file:
+        settings = json.load(file)
+    for setting in settings:
+        unknown = set(setting) - set(tolerance_names)
+        assert not unknown, 'Tolerances that can not be swept: ' + ', '.join(sorted(unknown))
+    return [{name: setting.get(name, getattr(dso, name)) for name in tolerance_names} for setting in settings]
+
+
+@contextmanager
+def tolerances(setting):
+    """Sets the tolerances of the dso package to those of the setting, and restores them afterwards."""
+    previous = {name: getattr(dso, name) for name in setting}
+    for name, value in setting.items():
+        setattr(dso, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(dso, name, value)
+
+
+def generate_candidates(network_ref, junction_index, tolerance_distance, metrics_cache):
+    """Finds the candidates of all strokes of level 1 in the reference network with the tolerance distance and no
+    matches set, like matching.find_best_match, but without the length filter. The metrics of candidates that are not
+    in the metrics cache, keyed by the ids of their reference and target strokes, are calculated and added to it.
+    Returns a dictionary from reference stroke id to the list of candidates, in the order in which they are found."""
+    candidates = {}
+    # with an infinite length tolerance, the length filter passes all candidates
+    with tolerances({'tolerance_distance': tolerance_distance, 'tolerance_length': inf}):
+        for stroke in [stroke for stroke in network_ref.strokes.values() if stroke.level == 1]:
+            try:
+                matches = find_matching_candidates(stroke, tolerance_distance, junction_index)
+            except AssertionError as e:
+                print(e)
+                print('Something went wrong trying to find a match for stroke', stroke.id)
+                matches = []
+            keys = [candidate_key(match) for match in matches]
+            new_matches = {key: match for key, match in zip(keys, matches) if key not in metrics_cache}
+            metrics_cache.update(zip(new_matches, match_metrics(list(new_matches.values()))))
+            candidates[stroke.id] = [Candidate(match.strokes_ref, match.strokes_target, metrics_cache[key])
+                                     for key, match in zip(keys, matches)]
+    profile.count('sweep_candidates', sum(len(stroke_candidates) for stroke_candidates in candidates.values()))
+    return candidates
+
+
+def candidate_key(match):
+    """Returns the ids of the reference and target strokes of a match, which determine its metrics. Only the difference
+    in length of the metrics depends on the tolerance distance, it is calculated again by select_matches."""
+    return tuple(stroke.id for stroke in match.strokes_ref), tuple(stroke.id for stroke in match.strokes_target)
+
+
+def select_matches(network_ref, candidates):
+    """Selects the matches of level 1 from the candidates, filtered and scored with the tolerances of the dso package,
+    like files.matching_process. Candidates that start with a target stroke that already has the match of the reference
+    stroke are skipped, which find_matching_candidates does during a full run, and then the length filter is
+    applied."""
+    all_matches = []
+    for stroke in [stroke for stroke in network_ref.strokes.values() if stroke.level == 1]:
+        matches = []
+        for candidate in candidates.get(stroke.id, []):
+            if stroke.match_id is not None and stroke.match_id == candidate.strokes_target[0].match_id:
+                continue
+            if not passes('length', length_compatible(candidate.strokes_ref, candidate.strokes_target)):
+                continue
+            # matches that can not be scored get a score of 0, like in score_matches
+            matches.append(Match(list(candidate.strokes_ref), list(candidate.strokes_target),
+                                 similarity_score=0 if candidate.metrics is None else
+                                 similarity_score(length_difference(candidate.strokes_ref, candidate.strokes_target),
+                                                  *candidate.metrics[1:])))
+        best_match = select_best_match(matches) if matches else None
+        if best_match:
+            best_match.set_stroke_match_id()
+            all_matches.append(best_match)
+    return all_matches
+
+
+class NetworkState:
+    """Strokes of a preprocessed network, the stroke of each road section, also in the graph of the network, and the
+    road sections of each stroke, saved such that the network can be restored after the strokes of level 2 of a
+    setting are constructed."""
+
+    def __init__(self, network):
+        self.network = network
+        self.strokes = dict(network.strokes)
+        self.section_strokes = {section_id: road_section.delimited_stroke
+                                for section_id, road_section in network.road_sections.items()}
+        self.membership = network.delimited_stroke_class.delimited_strokes.arrays()
+        self.graph_strokes = network.graph.section_stroke.copy()
+        self.next_stroke_id = max(self.strokes, default=0) + 1
+
+    def restore(self):
+        """Restores the network and removes the match ids of all strokes. The strokes of level 2 get the same ids for
+        each setting, like in a run of file_process, so their cached metrics are removed."""
+        for stroke_id, stroke in self.network.strokes.items():
+            if stroke_id not in self.strokes:
+                metric_cache.invalidate(stroke)
+        self.network.strokes = dict(self.strokes)
+        self.network.stroke_ids = itertools.count(self.next_stroke_id)
+        for section_id, road_section in self.network.road_sections.items():
+            road_section.delimited_stroke = self.section_strokes[section_id]
+        self.network.delimited_stroke_class.delimited_strokes.set_arrays(self.membership)
+        self.network.graph.section_stroke[:] = self.graph_strokes
+        for stroke in self.strokes.values():
+            stroke.match_id = None
+
+
+def sweep(network_ref, network_target, settings, output_directory):
+    """Runs the matching process for each tolerance setting on preprocessed networks, see the module description.
+    Writes linking_table_<number>.csv for each setting and summary.csv to the output directory. Returns the rows of
+    the summary."""
+    os.makedirs(output_directory, exist_ok=True)
+    largest_distance = max(setting['tolerance_distance'] for setting in settings)
+    junction_index = network_target.junction_index(largest_distance)
+    metrics_cache = {}
+    candidates = {}
+
+    states = [NetworkState(network_ref), NetworkState(network_target)]
+    summary = []
+    for number, setting in enumerate(settings):
+        with tolerances(setting):
+            for state in states:
+                state.restore()
+            key = setting['tolerance_distance']
+            if key not in candidates:
+                with profile.stage('sweep_candidates'):
+                    candidates[key] = generate_candidates(network_ref, junction_index, key, metrics_cache)
+            with profile.stage('sweep_setting'):
+                Match.id_iter = itertools.count()
+                matches = select_matches(network_ref, candidates[key])
+                match_count_lvl1 = len(matches)
+                files.prepare_strokes_lvl2(network_ref)
+                files.prepare_strokes_lvl2(network_target)
+                matches += files.matching_process(network_ref, 2, junction_index, setting['tolerance_distance'])
+
+                scores = []
+                output_path = os.path.join(output_directory, 'linking_table_{}.csv'.format(number))
+                with LinkWriter(file_path=output_path, to_database=False) as link_writer:
+                    for match in matches:
+                        if match_exists(match):
+                            scores.append(match.similarity_score)
+                            for row in match_links(match):
+                                link_writer.write(*row)
+        summary.append(dict(setting, setting=number, matches_lvl1=match_count_lvl1,
+                            matches_lvl2=len(matches) - match_count_lvl1, matches=len(scores),
+                            links=link_writer.row_count, mean_score=sum(scores) / len(scores) if scores else 0,
+                            min_score=min(scores, default=inf), output=output_path))
+        print('Setting', number, setting, ':', len(scores), 'matches,', link_writer.row_count, 'links')
+    for state in states:
+        state.restore()
+
+    with open(os.path.join(output_directory, 'summary.csv'), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(summary[0]))
+        writer.writeheader()
+        writer.writerows(summary)
+    return summary
+
+
+def sweep_process(file_path_ref, file_path_target, settings, output_directory, id_column_ref='wvk_id',
+                  id_column_target='ogc_fid'):
+    """Reads and preprocesses the networks of the files once, and runs the sweep. Returns the rows of the summary."""
+    assert local_geometry.enabled(), 'The file backend requires the local geometry engine'
+    metric_cache.clear()
+    network_ref = files.read_network(file_path_ref, id_column_ref, files.RoadSectionRef, files.JunctionRef,
+                                     files.DelimitedStrokeRef)
+    network_target = files.read_network(file_path_target, id_column_target, files.RoadSectionTarget,
+                                        files.JunctionTarget, files.DelimitedStrokeTarget)
+    with profile.stage('preprocess'):
+        files.preprocess(network_ref)
+        files.preprocess(network_target)
+    return sweep(network_ref, network_target, settings, output_directory)
@@ -0,0 +1,150 @@
+"""Module synthetic.py generates pairs of reference and target road networks for benchmarks, without real data. The
+reference network is a grid of streets with degree-2 chains, dead ends, Y-, W- and T-junctions and roundabouts. The
+target network is a copy with positional noise, in which road sections are split and chains are merged. The networks
+are lists of (id, line geometry) rows, that can be read with files.create_network or written to a GeoPackage."""
+
+from math import cos, pi, sin, sqrt  # standard library
+
+import numpy as np  # 3rd party packages
+from shapely.geometry import LineString
+
+
+class NetworkGenerator:
+    """Seeded generator of a reference and target network with about section_count road sections in the reference
+    network. The rates are the fractions of grid streets that are removed (which creates T-junctions and dead ends),
+    split in a degree-2 chain, turned into a roundabout or given a diagonal branch (Y- and W-junctions)."""
+
+    def __init__(self, section_count, seed=0, spacing=100.0, remove_rate=0.1, chain_rate=0.2, roundabout_rate=0.02,
+                 branch_rate=0.05, noise=1.0, split_rate=0.05, merge_rate=0.5):
+        self.random = np.random.RandomState(seed)
+        self.size = max(2, int(sqrt(section_count / 2.2)))
+        self.spacing = spacing
+        self.remove_rate = remove_rate
+        self.chain_rate = chain_rate
+        self.roundabout_rate = roundabout_rate
+        self.branch_rate = branch_rate
+        self.noise = noise
+        self.split_rate = split_rate
+        self.merge_rate = merge_rate
+
+    def node(self, column, row):
+        """Returns the jittered position of a grid node, which gives a variety of junction angles."""
+        jitter = self.spacing * 0.1
+        offset = self.jitter[row, column]
+        return column * self.spacing + offset[0] * jitter, row * self.spacing + offset[1] * jitter
+
+    def street(self, point_a, point_b):
+        """Returns the coordinates of a slightly curved street between two points."""
+        bend = self.random.uniform(-0.05, 0.05) * self.spacing
+        dx, dy = point_b[0] - point_a[0], point_b[1] - point_a[1]
+        length = sqrt(dx * dx + dy * dy)
+        middle = (point_a[0] + dx / 2 - dy / length * bend, point_a[1] + dy / 2 + dx / length * bend)
+        return [point_a, middle, point_b]
+
+    def reference(self):
+        """Generates the reference network. Returns the rows and the chains, which are pairs of row indices of road
+        sections that form one street with a degree-2 junction in between."""
+        self.jitter = self.random.uniform(-1, 1, (self.size, self.size, 2))
+        roundabouts = {(column, row): 0.15 * self.spacing for column in range(1, self.size - 1)
+                       for row in range(1, self.size - 1) if self.random.random_sample() < self.roundabout_rate}
+        lines = []
+        chains = []
+
+        def approach(node, towards):
+            # streets end on the ring of a roundabout instead of at its centre
+            point = self.node(*node)
+            if node not in roundabouts:
+                return point
+            angle = np.arctan2(towards[1] - point[1], towards[0] - point[0])
+            return point[0] + roundabouts[node] * cos(angle), point[1] + roundabouts[node] * sin(angle)
+
+        for row in range(self.size):
+            for column in range(self.size):
+                for neighbour in ((column + 1, row), (column, row + 1)):
+                    if neighbour[0] >= self.size or neighbour[1] >= self.size:
+                        continue
+                    if self.random.random_sample() < self.remove_rate:
+                        continue
+                    point_a = approach((column, row), self.node(*neighbour))
+                    point_b = approach(neighbour, self.node(column, row))
+                    coords = self.street(point_a, point_b)
+                    if self.random.random_sample() < self.chain_rate:
+                        chains.append((len(lines), len(lines) + 1))
+                        lines.append(coords[:2])
+                        lines.append(coords[1:])
+                    else:
+                        lines.append(coords)
+
+                if (column, row) not in roundabouts and self.random.random_sample() < self.branch_rate:
+                    # a short branch at a sharp angle gives Y- and W-junctions
+                    point = self.node(column, row)
+                    angle = self.random.uniform(0, 2 * pi)
+                    lines.append([point, (point[0] + 0.4 * self.spacing * cos(angle),
+                                          point[1] + 0.4 * self.spacing * sin(angle))])
+
+        for (column, row), radius in sorted(roundabouts.items()):
+            centre = self.node(column, row)
+            approaches = sorted(np.arctan2(neighbour[1] - centre[1], neighbour[0] - centre[0]) for neighbour in (
+                self.node(column + 1, row), self.node(column, row + 1), self.node(column - 1, row),
+                self.node(column, row - 1)))
+            for index, start_angle in enumerate(approaches):
+                end_angle = approaches[(index + 1) % 4] + (2 * pi if index == 3 else 0)
+                angles = np.linspace(start_angle, end_angle, 6)
+                lines.append([(centre[0] + radius * cos(angle), centre[1] + radius * sin(angle)) for angle in angles])
+
+        rows = [(index + 1, LineString(coords)) for index, coords in enumerate(lines)]
+        return rows, chains
+
+    def target(self, reference_rows, chains):
+        """Generates the target network from the reference network. End points get the same offset wherever they
+        occur, such that the topology is kept. Chains are merged with merge_rate, other road sections are split
+        in their middle with split_rate."""
+        offsets = {}
+
+        def shift(point, shared):
+            if not shared:
+                return tuple(np.add(point, self.random.normal(0, self.noise, 2)))
+            key = (round(point[0], 3), round(point[1], 3))
+            if key not in offsets:
+                offsets[key] = self.random.normal(0, self.noise, 2)
+            return tuple(np.add(point, offsets[key]))
+
+        merged = {}
+        for first, second in chains:
+            if self.random.random_sample() < self.merge_rate:
+                merged[first] = second
+        skipped = set(merged.values())
+
+        lines = []
+        for index, (section_id, line) in enumerate(reference_rows):
+            if index in skipped:
+                continue
+            coords = list(line.coords)
+            if index in merged:
+                coords = coords + list(reference_rows[merged[index]][1].coords)[1:]
+            coords = [shift(point, position in (0, len(coords) - 1)) for position, point in enumerate(coords)]
+            if len(coords) > 2 and self.random.random_sample() < self.split_rate:
+                split = len(coords) // 2
+                coords[split] = shift(coords[split], True)
+                lines.append(coords[:split + 1])
+                lines.append(coords[split:])
+            else:
+                lines.append(coords)
+        return [(index + 1, LineString(coords)) for index, coords in enumerate(lines)]
+
+    def networks(self):
+        """Returns the rows of the reference and target network."""
+        reference_rows, chains = self.reference()
+        return reference_rows, self.target(reference_rows, chains)
+
+
+def write_file(rows, file_path, id_column='id', srid=28992):
+    """Writes the rows of a generated network to a GeoPackage, or a GeoParquet file if the extension is .parquet.
+    Requires GeoPandas."""
+    import geopandas
+    data = geopandas.GeoDataFrame({id_column: [row[0] for row in rows]}, geometry=[row[1] for row in rows],
+                                  crs=srid)
+    if file_path.endswith('.parquet'):
+        data.to_parquet(file_path)
+    else:
+        data.to_file(file_path, driver='GPKG')
@@ -0,0 +1,160 @@
+"""Module tiles.py runs the construction and matching process tile by tile, such that the memory use depends on the
+size of a tile instead of the size of the network. Tiles are squares of tile_size meters, processed in a fixed order.
+Each junction, stroke and road section is owned by exactly one tile: a junction by the tile of its point, a stroke by
+the tile of the lower left corner of its bounding box and a road section by the tile of its start point. A tile only
+starts strokes and matches from the elements it owns, but strokes are followed into the next tiles and the target
+junctions are indexed with a halo of the tolerance distance. After each tile the session is committed and emptied."""
+
+from sqlalchemy import func, and_, text  # 3rd party packages
+
+from dso import session, srid  # local source
+from membership import delimited_strokes_ref, delimited_strokes_target
+from structure import RoadSectionRef, RoadSectionTarget, JunctionTarget, DelimitedStrokeRef, DelimitedStrokeTarget, \
+    LinkingTable
+from construction import classify_junctions, classify_junctions_batch, construct_strokes, \
+    construct_stroke_from_section, load_delimited_strokes
+from graph import load_graph
+from spatial_index import load_junction_index
+from parallel import halo
+from bulk import StrokeWriter
+import local_geometry
+from metrics import metric_cache
+
+
+def tile_keys(junction_classes, tile_size, delimited_stroke_classes=()):
+    """Returns the (column, row) keys of the tiles that own at least one junction or stroke, in processing order. The
+    lower left corner of the bounding box of a stroke can be in a tile without junctions, so the tiles of the strokes
+    are added once they are constructed."""
+    keys = set()
+    for junction_class in junction_classes:
+        rows = session.query(func.floor(func.st_x(junction_class.geom) / tile_size),
+                             func.floor(func.st_y(junction_class.geom) / tile_size)).distinct()
+        keys.update((int(column), int(row)) for column, row in rows)
+    for delimited_stroke_class in delimited_stroke_classes:
+        rows = session.query(func.floor(func.st_xmin(delimited_stroke_class.geom) / tile_size),
+                             func.floor(func.st_ymin(delimited_stroke_class.geom) / tile_size)).distinct()
+        keys.update((int(column), int(row)) for column, row in rows)
+    return sorted(keys)
+
+
+def tile_extent(key, tile_size):
+    """Returns the extent (x_min, y_min, x_max, y_max) of a tile."""
+    return key[0] * tile_size, key[1] * tile_size, (key[0] + 1) * tile_size, (key[1] + 1) * tile_size
+
+
+def in_tile(x, y, extent):
+    """Returns a filter on the coordinates x and y, which are SQL expressions, for the half-open extent of a tile, such
+    that a point on the border between two tiles is owned by one of them."""
+    return and_(x >= extent[0], y >= extent[1], x < extent[2], y < extent[3])
+
+
+def point_in_tile(point, extent):
+    """Returns a filter for point geometries within a tile, which can use the spatial index of the geometry column."""
+    return and_(point.intersects(func.st_makeenvelope(*extent, srid)),
+                in_tile(func.st_x(point), func.st_y(point), extent))
+
+
+def stroke_in_tile(delimited_stroke_class, extent):
+    """Returns a filter for the strokes owned by a tile."""
+    return in_tile(func.st_xmin(delimited_stroke_class.geom), func.st_ymin(delimited_stroke_class.geom), extent)
+
+
+def release_tile():
+    """Commits the work of a tile and removes all objects from the session and the dictionaries and cache."""
+    session.commit()
+    session.expunge_all()
+    delimited_strokes_ref.clear()
+    delimited_strokes_target.clear()
+    metric_cache.clear()
+
+
+def classify_tile(road_section_class, junction_class, extent):
+    """Classifies the junctions owned by a tile."""
+    junction_filter = point_in_tile(junction_class.geom, extent)
+    if local_geometry.enabled():
+        classify_junctions_batch(load_graph(road_section_class, junction_class, junction_filter), junction_class)
+    else:
+        classify_junctions(session.query(junction_class).filter(junction_filter).order_by(junction_class.id))
+
+
+def construct_tile(junction_class, delimited_stroke_class, delimited_strokes, extent, stroke_writer=None):
+    """Constructs the level 1 strokes that start at a junction owned by a tile."""
+    junctions = session.query(junction_class).filter(point_in_tile(junction_class.geom, extent))\
+        .order_by(junction_class.id)
+    with session.no_autoflush:
+        construct_strokes(junctions, delimited_stroke_class, stroke_writer)
+    if stroke_writer:
+        stroke_writer.flush(delimited_strokes)
+
+
+def construct_remaining_tile(road_section_class, delimited_stroke_class, delimited_strokes, extent,
+                             stroke_writer=None):
+    """Constructs level 1 strokes for the road sections owned by a tile that are not part of a stroke yet."""
+    start_point = func.st_startpoint(road_section_class.geom)
+    remaining_sections = session.query(road_section_class)\
+        .filter(road_section_class.delimited_stroke_id == None, point_in_tile(start_point, extent))\
+        .order_by(road_section_class.id)
+    with session.no_autoflush:
+        for road_section in remaining_sections:
+            if road_section.delimited_stroke is None:
+                construct_stroke_from_section(road_section, delimited_stroke_class, stroke_writer=stroke_writer)
+    if stroke_writer:
+        stroke_writer.flush(delimited_strokes)
+
+
+def preprocess_tiled(road_section_class, junction_class, delimited_stroke_class, delimited_strokes, extents):
+    """Classifies the junctions and constructs the level 1 strokes of one database, tile by tile. Strokes are first
+    constructed from the junctions of all tiles, and then from the remaining road sections, like in the complete
+    process."""
+    session.query(delimited_stroke_class).delete()
+    session.query(road_section_class).update({road_section_class.delimited_stroke_id: None},
+                                             synchronize_session=False)
+    stroke_writer = StrokeWriter(delimited_stroke_class) if local_geometry.enabled() else None
+
+    for extent in extents:
+        classify_tile(road_section_class, junction_class, extent)
+        release_tile()
+    for extent in extents:
+        construct_tile(junction_class, delimited_stroke_class, delimited_strokes, extent, stroke_writer)
+        release_tile()
+    for extent in extents:
+        construct_remaining_tile(road_section_class, delimited_stroke_class, delimited_strokes, extent, stroke_writer)
+        release_tile()
+
+
+def owned_strokes(delimited_stroke_class, level, extent):
+    """Returns the ids of the unmatched strokes of a level that are owned by a tile."""
+    rows = session.query(delimited_stroke_class.id)\
+        .filter(delimited_stroke_class.level == level, delimited_stroke_class.match_id == None,
+                stroke_in_tile(delimited_stroke_class, extent))\
+        .order_by(delimited_stroke_class.id)
+    return [row[0] for row in rows]
+
+
+def tile_junction_index(stroke_ids, tolerance_distance):
+    """Builds a JunctionIndex over the target junctions within the extent of the input reference strokes plus the
+    tolerance distance, or returns None if the local geometry engine is not used."""
+    if not local_geometry.enabled():
+        return None
+    extent = func.st_extent(DelimitedStrokeRef.geom)
+    strokes_extent = session.query(func.st_xmin(extent), func.st_ymin(extent), func.st_xmax(extent),
+                                   func.st_ymax(extent)).filter(DelimitedStrokeRef.id.in_(stroke_ids)).one()
+    return load_junction_index(JunctionTarget, tolerance_distance, extent=halo(strokes_extent, tolerance_distance))
+
+
+def load_match_sections(matches):
+    """Loads the road section ids of the strokes of the input matches into the delimited strokes stores, such that
+    the matches can be written to the linking table."""
+    load_delimited_strokes(RoadSectionRef, DelimitedStrokeRef,
+                           sorted({stroke.id for match in matches for stroke in match.strokes_ref}),
+                           delimited_strokes_ref)
+    load_delimited_strokes(RoadSectionTarget, DelimitedStrokeTarget,
+                           sorted({stroke.id for match in matches for stroke in match.strokes_target}),
+                           delimited_strokes_target)
+
+
+def remove_overwritten_matches():
+    """Removes the rows of the linking table of matches that no longer exist, because all their reference strokes were
+    matched again in a later tile."""
+    session.execute(text('DELETE FROM {0} WHERE NOT EXISTS (SELECT 1 FROM {1} WHERE {1}.match_id = {0}.match_id)'
+                         .format(LinkingTable.__tablename__, DelimitedStrokeRef.__tablename__)))
@@ -0,0 +1,93 @@
+"""Fixtures shared by the tests. The modules of the dso directory import each other by module name, so the directory
+is added to the path, next to the repository root for the dso package itself."""
+
+import os  # standard library
+import sys
+
+import pytest  # 3rd party packages
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dso'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dso import engine, session  # local source
+import files
+import local_geometry
+from structure import Base, RoadSectionRef, RoadSectionTarget, JunctionRef, JunctionTarget, DelimitedStrokeRef, \
+    DelimitedStrokeTarget
+
+# the classes of the file backend and the mapped classes of both databases
+network_classes = [(files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef, RoadSectionRef, JunctionRef,
+                    DelimitedStrokeRef),
+                   (files.RoadSectionTarget, files.JunctionTarget, files.DelimitedStrokeTarget, RoadSectionTarget,
+                    JunctionTarget, DelimitedStrokeTarget)]
+
+
+@pytest.fixture(scope='module')
+def postgis():
+    """A connection to the PostGIS database of __init__.py. The tests that use it are skipped if the database can not
+    be reached or has no PostGIS extension."""
+    try:
+        connection = engine.connect()
+    except DBAPIError as e:
+        pytest.skip('PostGIS database not available: ' + str(e).splitlines()[0])
+    try:
+        connection.execute(text('SELECT postgis_version()'))
+    except DBAPIError:
+        connection.close()
+        pytest.skip('PostGIS extension not installed')
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+def wkt(geom):
+    return local_geometry.to_shape(geom).wkt
+
+
+def write_network(connection, network, road_section_class, junction_class, delimited_stroke_class):
+    """Inserts the junctions, strokes and road sections of a preprocessed network in the tables of the mapped
+    classes."""
+    connection.execute(junction_class.__table__.insert(), [
+        {'id': junction.id, 'the_geom': wkt(junction.geom), 'cnt': junction.degree, 'type_k3': junction.type_k3,
+         'angle_k3': junction.angle_k3} for junction in network.junctions.values()])
+    connection.execute(delimited_stroke_class.__table__.insert(), [
+        {'id': stroke.id, 'geom': wkt(stroke.geom), 'level': stroke.level,
+         'begin_junction_id': stroke.begin_junction_id, 'end_junction_id': stroke.end_junction_id, 'match_id': None}
+        for stroke in network.strokes.values()])
+    connection.execute(road_section_class.__table__.insert(), [
+        {'id': road_section.id, 'geom': wkt(road_section.geom), 'begin_junction_id': road_section.begin_junction_id,
+         'end_junction_id': road_section.end_junction_id, 'delimited_stroke_id': road_section.delimited_stroke_id}
+        for road_section in network.road_sections.values()])
+
+
+@pytest.fixture(scope='module')
+def network_schema(postgis):
+    """A small generated network pair, preprocessed with the file backend and written to the mapped tables in a
+    temporary schema, which is removed when the transaction of the postgis fixture is rolled back. The session is
+    bound to the connection of the fixture."""
+    pytest.importorskip('shapely')
+    from synthetic import NetworkGenerator
+    postgis.execute(text('CREATE SCHEMA dso_test'))
+    postgis.execute(text('SET LOCAL search_path TO dso_test, public'))
+    Base.metadata.create_all(postgis)
+    # the tables created by the SQL scripts have no foreign keys, strokes are removed before their road sections
+    for table, constraint in postgis.execute(text(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE contype = 'f' "
+            "AND connamespace = 'dso_test'::regnamespace")).fetchall():
+        postgis.execute(text('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, constraint)))
+    for rows, classes in zip(NetworkGenerator(500, seed=1).networks(), network_classes):
+        network = files.create_network(rows, *classes[:3])
+        files.preprocess(network)
+        write_network(postgis, network, *classes[3:])
+        # the ids were inserted explicitly, new strokes get ids after them
+        table = classes[5].__tablename__
+        postgis.execute(text("SELECT setval(pg_get_serial_sequence('{0}', 'id'), max(id)) FROM {0}".format(table)))
+    session.close()
+    bind = session.bind
+    session.bind = postgis
+    yield postgis
+    session.close()
+    session.bind = bind
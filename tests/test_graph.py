@@ -0,0 +1,117 @@
+"""The array-backed RoadGraph gives the same angles, junction classifications and strokes as the functions that walk
+the road_sections of the junction objects, compared on generated networks of the file backend."""
+
+import pytest  # 3rd party packages
+
+pytest.importorskip('shapely')
+import numpy as np
+
+from construction import classify_graph, classify_junctions, construct_strokes, construct_stroke_from_section, \
+    stroke_chains  # local source
+from helpers import angle_at_junction
+from synthetic import NetworkGenerator
+from snapshot import write_snapshot, write_membership, open_snapshot, section_strokes
+from membership import StrokeMembership
+import files
+
+
+@pytest.fixture(scope='module')
+def rows():
+    return NetworkGenerator(3000, seed=1).networks()[0]
+
+
+def create_network(rows):
+    return files.create_network(rows, files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef)
+
+
+def test_adjacency_angles_equal_angle_at_junction(rows):
+    network = create_network(rows)
+    graph = network.graph
+    for junction_index, junction_id in enumerate(graph.junction_ids.tolist()):
+        junction = network.junctions[junction_id]
+        sections, angles = graph.junction_sections(junction_id)
+        assert [network.road_sections[int(graph.section_ids[section])] for section in sections] == \
+            junction.road_sections
+        for section, angle in zip(sections, angles):
+            assert angle == angle_at_junction(network.road_sections[int(graph.section_ids[section])], junction)
+
+
+def test_classify_graph_equals_classify_junctions(rows):
+    network = create_network(rows)
+    graph = network.graph
+    classify_graph(graph)
+    classify_junctions(network.junctions[junction_id] for junction_id in sorted(network.junctions))
+    for junction_index, junction_id in enumerate(graph.junction_ids.tolist()):
+        junction = network.junctions[junction_id]
+        if junction.type_k3 is None:
+            continue
+        assert graph.type_k3[junction_index] == junction.type_k3
+        if junction.angle_k3 is not None:
+            assert graph.angle_k3[junction_index] == junction.angle_k3
+
+
+def test_stroke_chains_equal_construct_strokes(rows):
+    network = create_network(rows)
+    files.classify_network(network)
+    files.construct_network(network)
+    graph_strokes = [(stroke.begin_junction_id, stroke.end_junction_id,
+                      files.DelimitedStrokeRef.delimited_strokes[stroke.id]) for stroke in network.strokes.values()]
+
+    network = create_network(rows)
+    files.classify_network(network)
+    junctions = [network.junctions[junction_id] for junction_id in sorted(network.junctions)]
+    construct_strokes(junctions, files.DelimitedStrokeRef, stroke_writer=network)
+    for section_id in sorted(network.road_sections):
+        if network.road_sections[section_id].delimited_stroke is None:
+            construct_stroke_from_section(network.road_sections[section_id], files.DelimitedStrokeRef,
+                                          stroke_writer=network)
+    strokes = [(stroke.begin_junction_id, stroke.end_junction_id,
+                files.DelimitedStrokeRef.delimited_strokes[stroke.id]) for stroke in network.strokes.values()]
+    assert graph_strokes == strokes
+    assert len(stroke_chains(network.graph)) == len(strokes)
+
+
+def test_snapshot_graph_equals_graph(rows, tmp_path):
+    network = create_network(rows)
+    files.classify_network(network)
+    graph = network.graph
+    write_snapshot(str(tmp_path), {'ref': graph}, 10)
+    snapshot_graph = open_snapshot(str(tmp_path))['ref'].graph()
+    for name, array in graph.arrays().items():
+        assert np.array_equal(getattr(snapshot_graph, name), array, equal_nan=True)
+    for junction_id in graph.junction_ids.tolist():
+        assert snapshot_graph.junction_sections(junction_id) == graph.junction_sections(junction_id)
+
+
+def test_strokes_lvl2_split_strokes_lvl1(rows):
+    network = create_network(rows)
+    files.preprocess(network)
+    delimited_strokes = files.DelimitedStrokeRef.delimited_strokes
+    strokes_lvl1 = {section_id: stroke.id for stroke in network.strokes.values()
+                    for section_id in delimited_strokes[stroke.id]}
+    files.prepare_strokes_lvl2(network)
+    assert all(stroke.level == 2 for stroke in network.strokes.values())
+    section_ids = [section_id for stroke in network.strokes.values() for section_id in delimited_strokes[stroke.id]]
+    assert sorted(section_ids) == sorted(network.road_sections)
+    for stroke in network.strokes.values():
+        # like construction.construct_strokes_lvl2_batch, a stroke of level 2 is part of a single stroke of level 1
+        assert len({strokes_lvl1[section_id] for section_id in delimited_strokes[stroke.id]}) == 1
+        for section_id in delimited_strokes[stroke.id]:
+            assert network.road_sections[section_id].delimited_stroke is stroke
+            assert network.graph.stroke(network.graph.section_index[section_id]) is stroke
+
+
+def test_snapshot_membership_equals_strokes(rows, tmp_path):
+    network = create_network(rows)
+    files.preprocess(network)
+    delimited_strokes = files.DelimitedStrokeRef.delimited_strokes
+    graph = network.graph
+    write_snapshot(str(tmp_path), {'ref': graph}, 10)
+    write_membership(str(tmp_path), 1, {'ref': delimited_strokes})
+    membership = open_snapshot(str(tmp_path))['ref'].memberships[1]
+    assert isinstance(membership['sections'], np.memmap)
+    assert np.array_equal(section_strokes(graph.section_ids, membership), graph.section_stroke)
+
+    snapshot_strokes = StrokeMembership()
+    snapshot_strokes.set_arrays(membership)
+    assert dict(snapshot_strokes.items()) == dict(delimited_strokes.items())
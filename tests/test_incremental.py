@@ -0,0 +1,55 @@
+"""An incremental update after a change in only the target database gives the same linking table as a complete run on
+the changed database, on the generated network pair of the network_schema fixture. Skipped if no PostGIS database is
+available."""
+
+import itertools  # standard library
+
+import pytest  # 3rd party packages
+from sqlalchemy import text
+
+pytest.importorskip('shapely')
+
+from dso import session, tolerance_distance  # local source
+from membership import delimited_strokes_ref, delimited_strokes_target
+from structure import JunctionRef, JunctionTarget, LinkingTable, Match
+from core import run_stage, stages, incremental_update
+from metrics import metric_cache
+
+
+def complete_run():
+    """Runs all stages of the matching process and returns the rows of the linking table."""
+    metric_cache.clear()
+    Match.id_iter = itertools.count()
+    matches = []
+    for stage in stages:
+        run_stage(stage, matches, tolerance_distance)
+        session.flush()
+    return linking_rows()
+
+
+def linking_rows():
+    session.expire_all()
+    return sorted((row.nwb_id, row.top10nl_id, round(row.similarity_score, 6)) for row in session.query(LinkingTable))
+
+
+def test_incremental_update_of_target_equals_complete_run(network_schema, monkeypatch):
+    rows_before = complete_run()
+    assert rows_before
+
+    # the middle points of a few target road sections are moved, their end points stay at their junctions
+    network_schema.execute(text(
+        'UPDATE top10nl_area SET geom = ST_SetPoint(geom, 1, ST_Translate(ST_PointN(geom, 2), 15, 15)) '
+        'WHERE id IN (SELECT id FROM top10nl_area WHERE ST_NumPoints(geom) = 3 ORDER BY id LIMIT 5)'))
+
+    # the update runs like in a new process, without graphs, cached metrics or stored strokes
+    monkeypatch.setattr(JunctionRef, 'road_graph', None)
+    monkeypatch.setattr(JunctionTarget, 'road_graph', None)
+    metric_cache.clear()
+    delimited_strokes_ref.clear()
+    delimited_strokes_target.clear()
+    session.expire_all()
+    assert incremental_update(tolerance_distance)
+    session.flush()
+    rows_incremental = linking_rows()
+
+    assert rows_incremental == complete_run()
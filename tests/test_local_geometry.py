@@ -0,0 +1,151 @@
+"""Parity of the local geometry engine with PostGIS. The recorded values are those of the PostGIS functions that the
+local functions replace: ST_Length, ST_Distance, ST_HausdorffDistance, ST_Azimuth of the first or last segment, the
+area of ST_MakePolygon(ST_AddPoint(geom, ST_StartPoint(geom))) if ST_NumPoints(geom) > 2, and
+ST_LineMerge(ST_Collect(geoms)). NULL is recorded as None. If a PostGIS database is available, the same values are also
+calculated by the database."""
+
+from types import SimpleNamespace  # standard library
+
+import pytest  # 3rd party packages
+from geoalchemy2.elements import WKTElement
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+pytest.importorskip('shapely')
+
+import dso  # local source
+import local_geometry
+from helpers import combine_geom
+from structure import Match
+
+lines = {
+    'segment': 'LINESTRING (0 0, 3 4)',
+    'bend': 'LINESTRING (0 0, 4 0, 4 3)',
+    'zero_length': 'LINESTRING (1 1, 1 1)',
+    'multi_part': 'MULTILINESTRING ((0 0, 1 0), (5 5, 6 5))',
+}
+
+# name: (length, area, azimuth at the start point, azimuth at the end point)
+recorded_lines = {
+    'segment': (5.0, 0, 0.6435011087932844, 3.7850937623830774),
+    'bend': (7.0, 6.0, 1.5707963267948966, 3.141592653589793),
+    'zero_length': (0.0, 0, None, None),
+    'multi_part': (2.0, None, None, None),
+}
+
+# (geometry a, geometry b, distance, Hausdorff distance)
+recorded_pairs = [
+    ('LINESTRING (0 0, 3 4)', 'LINESTRING (0 0, 4 0, 4 3)', 0.0, 3.2),
+    ('MULTILINESTRING ((0 0, 1 0), (5 5, 6 5))', 'LINESTRING (0 0, 1 0)', 0.0, 7.0710678118654755),
+    ('MULTILINESTRING ((0 0, 1 0), (5 5, 6 5))', 'POINT (0 1)', 1.0, 7.211102550927978),
+    ('LINESTRING (1 1, 1 1)', 'POINT (1 2)', 1.0, 1.0),
+]
+
+# (geometries, ST_AsText(ST_LineMerge(ST_Collect(geometries))))
+recorded_merges = [
+    (['LINESTRING (0 0, 1 0)', 'LINESTRING (1 0, 2 0)'], 'LINESTRING (0 0, 1 0, 2 0)'),
+    (['LINESTRING (1 0, 2 0)', 'LINESTRING (1 0, 0 0)'], 'LINESTRING (0 0, 1 0, 2 0)'),
+    (['LINESTRING (0 0, 1 0)', 'LINESTRING (5 5, 6 5)'], 'MULTILINESTRING ((0 0, 1 0), (5 5, 6 5))'),
+    (['MULTILINESTRING ((0 0, 1 0), (5 5, 6 5))', 'LINESTRING (1 0, 5 5)'], 'LINESTRING (0 0, 1 0, 5 5, 6 5)'),
+]
+
+
+@pytest.fixture(autouse=True)
+def local_engine(monkeypatch):
+    monkeypatch.setattr(dso, 'use_local_geometry', True)
+
+
+def local_azimuths(geom):
+    """Returns the local angles at the start and end point of a line, as recorded."""
+    coords = local_geometry.coordinates(geom)
+    if coords is None:
+        return None, None
+    return local_geometry.angle_at_junction(geom, 'POINT ({} {})'.format(*coords[0])), \
+        local_geometry.angle_at_junction(geom, 'POINT ({} {})'.format(*coords[-1]))
+
+
+@pytest.mark.parametrize('name', sorted(lines))
+def test_line_properties(name):
+    length, area, start_azimuth, end_azimuth = recorded_lines[name]
+    assert local_geometry.get_length(lines[name]) == pytest.approx(length)
+    assert local_geometry.get_area(lines[name]) == (None if area is None else pytest.approx(area))
+    assert local_azimuths(lines[name]) == (start_azimuth, end_azimuth)
+
+
+def test_multi_part_line_has_no_points():
+    assert local_geometry.coordinates(lines['multi_part']) is None
+    assert local_geometry.get_area(lines['multi_part']) is None
+
+
+def test_multi_part_match_scores_zero():
+    strokes = [SimpleNamespace(id=1, geom=lines['multi_part']), SimpleNamespace(id=2, geom=lines['segment'])]
+    assert Match([strokes[0]], [strokes[1]]).similarity_score == 0
+
+
+def test_vectorized_areas_equal_recorded():
+    names = sorted(lines)
+    hausdorff_distances, areas, _ = local_geometry.get_hausdorff_distances_and_areas(
+        [lines[name] for name in names], [lines[name] for name in names])
+    assert hausdorff_distances == [0.0] * len(names)
+    for name, area in zip(names, areas):
+        assert area == (None if recorded_lines[name][1] is None else pytest.approx(recorded_lines[name][1]))
+
+
+@pytest.mark.parametrize('geom_a, geom_b, distance, hausdorff', recorded_pairs)
+def test_distances(geom_a, geom_b, distance, hausdorff):
+    assert local_geometry.get_distance(geom_a, geom_b) == pytest.approx(distance)
+    assert local_geometry.get_hausdorff_distance(geom_a, geom_b) == pytest.approx(hausdorff)
+
+
+@pytest.mark.parametrize('geoms, merged', recorded_merges)
+def test_merge(geoms, merged):
+    assert local_geometry.merge(geoms).wkt == merged
+
+
+@pytest.mark.parametrize('geoms, merged', recorded_merges)
+def test_combine_geom(geoms, merged):
+    strokes = [type('Stroke', (), {'geom': geom}) for geom in geoms]
+    assert combine_geom(strokes) == merged
+
+
+def postgis_line_properties(connection, geom):
+    return connection.execute(text(
+        'SELECT ST_Length(g), CASE WHEN ST_NumPoints(g) > 2 THEN ST_Area(ST_MakePolygon(ST_AddPoint(g, '
+        'ST_StartPoint(g)))) WHEN ST_NumPoints(g) IS NOT NULL THEN 0 END, '
+        'ST_Azimuth(ST_StartPoint(g), ST_PointN(g, 2)), ST_Azimuth(ST_EndPoint(g), ST_PointN(g, -2)) '
+        'FROM (SELECT ST_GeomFromText(:geom, :srid) AS g) AS geometries'), {'geom': geom, 'srid': dso.srid}).one()
+
+
+@pytest.mark.parametrize('name', sorted(lines))
+def test_line_properties_postgis(postgis, name):
+    length, area, start_azimuth, end_azimuth = postgis_line_properties(postgis, lines[name])
+    assert local_geometry.get_length(lines[name]) == pytest.approx(length)
+    assert local_geometry.get_area(lines[name]) == (None if area is None else pytest.approx(area))
+    local_start_azimuth, local_end_azimuth = local_azimuths(lines[name])
+    assert local_start_azimuth == (None if start_azimuth is None else pytest.approx(start_azimuth))
+    assert local_end_azimuth == (None if end_azimuth is None else pytest.approx(end_azimuth))
+
+
+@pytest.mark.parametrize('geom_a, geom_b, distance, hausdorff', recorded_pairs)
+def test_distances_postgis(postgis, geom_a, geom_b, distance, hausdorff):
+    sql_distance, sql_hausdorff = postgis.execute(text(
+        'SELECT ST_Distance(a, b), ST_HausdorffDistance(a, b) FROM (SELECT ST_GeomFromText(:a, :srid) AS a, '
+        'ST_GeomFromText(:b, :srid) AS b) AS geometries'), {'a': geom_a, 'b': geom_b, 'srid': dso.srid}).one()
+    assert local_geometry.get_distance(geom_a, geom_b) == pytest.approx(sql_distance)
+    assert local_geometry.get_hausdorff_distance(geom_a, geom_b) == pytest.approx(sql_hausdorff)
+
+
+@pytest.mark.parametrize('geoms, merged', recorded_merges)
+def test_merge_postgis(postgis, geoms, merged):
+    sql_merged = postgis.execute(text(
+        'SELECT ST_AsText(ST_LineMerge(ST_Collect(ST_GeomFromText(geom, :srid)))) FROM unnest(CAST(:geoms AS text[])) '
+        'AS geometries(geom)'), {'geoms': geoms, 'srid': dso.srid}).scalar()
+    assert local_geometry.merge(geoms).equals(local_geometry.to_shape(sql_merged))
+
+
+def test_parity_check_postgis(postgis):
+    junction = SimpleNamespace(id=1, geom=WKTElement('POINT (0 0)', srid=dso.srid))
+    road_sections = [SimpleNamespace(id=section_id, geom=WKTElement(lines[name], srid=dso.srid),
+                                     begin_junction=junction, end_junction=None)
+                     for section_id, name in enumerate(sorted(lines))]
+    assert local_geometry.parity_check(Session(bind=postgis), road_sections) == []
@@ -0,0 +1,46 @@
+"""The length filter of find_matching_candidates is applied once to each candidate match, and the profile counts each
+candidate that it removes once, compared on a generated network pair of the file backend."""
+
+import pytest  # 3rd party packages
+
+pytest.importorskip('shapely')
+
+from dso import tolerance_distance  # local source
+import files
+import matching
+import prefilter
+from synthetic import NetworkGenerator
+from metrics import metric_cache
+from instrumentation import profile
+
+
+def test_length_filter_applied_once(monkeypatch):
+    metric_cache.clear()
+    rows_ref, rows_target = NetworkGenerator(1000, seed=1).networks()
+    network_ref = files.create_network(rows_ref, files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef)
+    network_target = files.create_network(rows_target, files.RoadSectionTarget, files.JunctionTarget,
+                                          files.DelimitedStrokeTarget)
+    files.preprocess(network_ref)
+    files.preprocess(network_target)
+    junction_index = network_target.junction_index(tolerance_distance)
+
+    results = []
+
+    def length_compatible(strokes_ref, strokes_target):
+        results.append(prefilter.length_compatible(strokes_ref, strokes_target))
+        return results[-1]
+
+    monkeypatch.setattr(matching, 'length_compatible', length_compatible)
+    # a small length tolerance, such that the filter removes candidates
+    monkeypatch.setattr('dso.tolerance_length', 0.05)
+    profile.enable()
+    try:
+        removed = profile.counters.get('removed_by_length', 0)
+        candidates = sum(len(matching.find_matching_candidates(stroke_ref, tolerance_distance, junction_index))
+                         for stroke_ref in network_ref.strokes.values())
+        assert results.count(False) > 0
+        assert profile.counters['removed_by_length'] - removed == results.count(False)
+    finally:
+        profile.disable()
+    # every candidate that passes the length filter is returned, so none of them was checked twice
+    assert results.count(True) == candidates
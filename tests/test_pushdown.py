@@ -0,0 +1,91 @@
+"""The candidates that pushdown_matching_process generates in the database give the same matches as the junction
+searches of core.matching_process, on the generated network pair of the network_schema fixture, with and without the
+azimuth filter. These tests are skipped if no PostGIS database is available. The filters of best_candidate are also
+tested on candidate rows of the file backend."""
+
+import itertools  # standard library
+
+import pytest  # 3rd party packages
+
+pytest.importorskip('shapely')
+
+from dso import session, tolerance_distance  # local source
+import files
+import prefilter
+from structure import DelimitedStrokeRef, DelimitedStrokeTarget, JunctionRef, JunctionTarget, Match
+from core import matching_process
+from pushdown import pushdown_matching_process, best_candidate, parity_check
+from matching import find_best_match
+from helpers import get_distance
+from synthetic import NetworkGenerator
+from metrics import metric_cache
+from instrumentation import profile
+
+
+def reset_matches():
+    session.query(DelimitedStrokeRef).update({DelimitedStrokeRef.match_id: None}, synchronize_session=False)
+    session.query(DelimitedStrokeTarget).update({DelimitedStrokeTarget.match_id: None}, synchronize_session=False)
+    session.expire_all()
+    metric_cache.clear()
+    Match.id_iter = itertools.count()
+
+
+def matches_of(matching_function):
+    """Returns the reference stroke ids, target stroke ids and score of all matches of level 1 found by the function,
+    starting without matches."""
+    reset_matches()
+    return [([stroke.id for stroke in match.strokes_ref], [stroke.id for stroke in match.strokes_target],
+             round(match.similarity_score, 9)) for match in matching_function(1, tolerance_distance)]
+
+
+def test_pushdown_equals_matching_process(network_schema):
+    matches = matches_of(matching_process)
+    assert matches
+    assert matches_of(pushdown_matching_process) == matches
+
+
+@pytest.mark.parametrize('use_azimuth_filter', [False, True])
+def test_candidate_sql_equals_find_best_match(network_schema, monkeypatch, use_azimuth_filter):
+    monkeypatch.setattr('dso.use_azimuth_filter', use_azimuth_filter)
+    reset_matches()
+    assert parity_check(1, tolerance_distance) == []
+
+
+def direct_match(network_ref, network_target, junction_index):
+    """Returns a reference stroke of which the best match is a single target stroke that starts and ends within the
+    tolerance distance of its junctions, and the candidate row of the pair as candidate_rows gives it."""
+    for stroke_ref in network_ref.strokes.values():
+        match = find_best_match(stroke_ref, tolerance_distance, junction_index)
+        if match is None or len(match.strokes_ref) != 1 or len(match.strokes_target) != 1:
+            continue
+        stroke_target = match.strokes_target[0]
+        for junction_target, junction_target_other in ((stroke_target.begin_junction, stroke_target.end_junction),
+                                                       (stroke_target.end_junction, stroke_target.begin_junction)):
+            if get_distance(stroke_ref.begin_junction, junction_target) < tolerance_distance and \
+                    get_distance(stroke_ref.end_junction, junction_target_other) < tolerance_distance:
+                return stroke_ref, (stroke_ref.id, stroke_target.id, 'match', stroke_ref.begin_junction_id,
+                                    junction_target.id)
+
+
+def test_best_candidate_applies_azimuth_filter(monkeypatch):
+    metric_cache.clear()
+    rows_ref, rows_target = NetworkGenerator(500, seed=1).networks()
+    network_ref = files.create_network(rows_ref, files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef)
+    network_target = files.create_network(rows_target, files.RoadSectionTarget, files.JunctionTarget,
+                                          files.DelimitedStrokeTarget)
+    files.preprocess(network_ref)
+    files.preprocess(network_target)
+    stroke_ref, row = direct_match(network_ref, network_target, network_target.junction_index(tolerance_distance))
+    junctions = {JunctionRef: network_ref.junctions, JunctionTarget: network_target.junctions}
+
+    assert best_candidate(stroke_ref, [row], network_target.strokes, junctions, tolerance_distance)
+    # with a negative deviation angle, the azimuth filter removes every direct match
+    monkeypatch.setattr('dso.use_azimuth_filter', True)
+    monkeypatch.setattr(prefilter, 'deviation_angle', -1)
+    profile.enable()
+    try:
+        removed = profile.counters.get('removed_by_azimuth', 0)
+        assert best_candidate(stroke_ref, [row], network_target.strokes, junctions, tolerance_distance) is None
+        assert profile.counters['removed_by_azimuth'] == removed + 1
+    finally:
+        profile.disable()
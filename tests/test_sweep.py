@@ -0,0 +1,89 @@
+"""A tolerance sweep gives the same linking table for each setting as a separate run of the file backend in a new
+process, in which the tolerances of the setting are set before the modules are imported, compared on a generated
+network pair."""
+
+import csv  # standard library
+import json
+import os
+import subprocess
+import sys
+
+import pytest  # 3rd party packages
+
+pytest.importorskip('shapely')
+
+import dso  # local source
+import files
+import sweep
+from synthetic import NetworkGenerator
+from metrics import metric_cache
+
+
+@pytest.fixture(scope='module')
+def rows():
+    return NetworkGenerator(3000, seed=1).networks()
+
+
+def preprocessed_networks(rows):
+    rows_ref, rows_target = rows
+    network_ref = files.create_network(rows_ref, files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef)
+    network_target = files.create_network(rows_target, files.RoadSectionTarget, files.JunctionTarget,
+                                          files.DelimitedStrokeTarget)
+    files.preprocess(network_ref)
+    files.preprocess(network_target)
+    return network_ref, network_target
+
+
+# a separate run in a new process, with the tolerances set in the dso package before the other modules are imported
+separate_run_script = '''
+import json
+import sys
+
+sys.path[:0] = sys.argv[1:3]
+import dso
+setting = json.loads(sys.argv[3])
+for name, value in setting.items():
+    setattr(dso, name, value)
+
+import files
+from synthetic import NetworkGenerator
+
+rows_ref, rows_target = NetworkGenerator(3000, seed=1).networks()
+network_ref = files.create_network(rows_ref, files.RoadSectionRef, files.JunctionRef, files.DelimitedStrokeRef)
+network_target = files.create_network(rows_target, files.RoadSectionTarget, files.JunctionTarget,
+                                      files.DelimitedStrokeTarget)
+files.preprocess(network_ref)
+files.preprocess(network_target)
+junction_index = network_target.junction_index(dso.tolerance_distance)
+matches = files.matching_process(network_ref, 1, junction_index, dso.tolerance_distance)
+files.prepare_strokes_lvl2(network_ref)
+files.prepare_strokes_lvl2(network_target)
+matches += files.matching_process(network_ref, 2, junction_index, dso.tolerance_distance)
+print(json.dumps([[section_ref, section_target, score] for match in matches if files.match_exists(match)
+                  for section_ref, section_target, _, score in files.match_links(match)]))
+'''
+
+
+def separate_run(setting):
+    """Returns the links of a full run of the file backend in a new process, configured with the tolerances of the
+    setting."""
+    dso_directory = os.path.dirname(os.path.abspath(files.__file__))
+    output = subprocess.run([sys.executable, '-c', separate_run_script, dso_directory, os.path.dirname(dso_directory),
+                             json.dumps(setting)], check=True, capture_output=True, text=True).stdout
+    return {(section_ref, section_target, round(score, 9))
+            for section_ref, section_target, score in json.loads(output.splitlines()[-1])}
+
+
+def test_sweep_equals_separate_runs(rows, tmp_path):
+    defaults = {name: getattr(dso, name) for name in sweep.tolerance_names}
+    settings = [dict(defaults, tolerance_distance=20), dict(defaults, tolerance_distance=10),
+                dict(defaults, tolerance_distance=10, tolerance_length=defaults['tolerance_length'] / 2),
+                dict(defaults, tolerance_distance=20, tolerance_hausdorff=defaults['tolerance_hausdorff'] / 2)]
+    metric_cache.clear()
+    network_ref, network_target = preprocessed_networks(rows)
+    summary = sweep.sweep(network_ref, network_target, settings, str(tmp_path))
+    for setting, row in zip(settings, summary):
+        with open(row['output']) as file:
+            links = {(int(section_ref), int(section_target), round(float(score), 9))
+                     for section_ref, section_target, _, score in list(csv.reader(file))[1:]}
+        assert links == separate_run(setting)